@@ -1,3 +1,4 @@
+import io
 from argparse import ArgumentParser
 from functools import lru_cache
 from pathlib import Path
@@ -10,13 +11,15 @@ from av2.structures.sweep import Sweep
 from kiss_icp.config import KISSConfig
 from kiss_icp.kiss_icp import KissICP
 from liso.datasets.argoverse2.av2_classes import AV2_MOVABLE_CLASSES
-from liso.jcp.jcp import JPCGroundRemove
+from liso.jcp.fast_jcp import JPCGroundRemove
 from liso.kabsch.box_groundtruth_matching import (
     slow_greedy_match_boxes_by_desending_confidence_by_dist,
 )
 from liso.kabsch.shape_utils import Shape
 from liso.tracker.tracking_helpers import accumulate_pcl
 from liso.transformations.transformations import decompose_matrix
+from liso.utils.file_utils import atomic_write_bytes, atomic_write_json
+from liso.utils.timing_utils import StageTimer, set_active_stage_timer, timed_stage
 from liso.utils.torch_transformation import homogenize_pcl
 from liso.visu.pcl_image import create_topdown_f32_pcl_image_variable_extent
 from PIL import Image
@@ -98,6 +101,12 @@ def main():
         type=Path,
         required=True,
     )
+    parser.add_argument(
+        "--progress_interval_s",
+        type=float,
+        default=60.0,
+        help="seconds between throughput lines in the log",
+    )
     args = parser.parse_args()
 
     WORLD_SIZE = args.world_size
@@ -105,6 +114,8 @@ def main():
 
     data_src_root_dir: Path = args.av2_root
     data_target_dir: Path = args.target_dir
+    stage_timer = StageTimer(f"create_av2_worker_{WORKER_ID}", args.progress_interval_s)
+    set_active_stage_timer(stage_timer)
 
     for split_name in ("train", "val"):
         data_loader = AV2SensorDataLoader(
@@ -129,7 +140,8 @@ def main():
             for timestamp_ns in tqdm(timestamps_in_seq, disable=False):
                 lidar_fpath = data_loader.get_lidar_fpath(seq_id, timestamp_ns)
 
-                sweep = Sweep.from_feather(lidar_fpath)
+                with timed_stage("read"):
+                    sweep = Sweep.from_feather(lidar_fpath)
                 vehicle_T_lidar = sweep.ego_SE3_up_lidar.transform_matrix
                 # vehicle_Tdown_lidar = sweep.ego_SE3_down_lidar.transform_matrix
                 world_T_vehicle = data_loader.get_city_SE3_ego(
@@ -156,10 +168,11 @@ def main():
                 per_point_timestamps_normalized = (
                     sweep.offset_ns - sweep.offset_ns.min()
                 ) / (np.ptp(sweep.offset_ns))
-                kiss_odom.register_frame(
-                    homog_pcl_lidar[:, :3],
-                    per_point_timestamps_normalized,
-                )
+                with timed_stage("odometry"):
+                    kiss_odom.register_frame(
+                        homog_pcl_lidar[:, :3],
+                        per_point_timestamps_normalized,
+                    )
 
             world_Tkiss_lidar = kiss_odom.poses
 
@@ -348,11 +361,21 @@ def main():
                     "lidar_rows_t0": sweep_t0.laser_number.astype(np.uint8),
                     "lidar_rows_t1": sweep_t1.laser_number.astype(np.uint8),
                 }
-                np.savez_compressed(target_fname, data_dict)
+                with timed_stage("serialization"):
+                    buffer = io.BytesIO()
+                    np.savez_compressed(buffer, data_dict)
+                with timed_stage("write"):
+                    atomic_write_bytes(target_fname, buffer.getvalue())
+                stage_timer.add_frames()
 
                 if verbose:
                     print(f"Saved {target_fname}")
 
+    stage_timer.print_progress()
+    timing_summary_file = data_target_dir / f"timing_summary_{WORKER_ID}.json"
+    atomic_write_json(timing_summary_file, stage_timer.get_summary())
+    print(f"Wrote per stage timings to {timing_summary_file}")
+
 
 def update_dynamic_flow(
     homog_pcl_ta, flow_ta_tb, matched_boxes_of_cat_ta, matched_boxes_of_cat_tb
@@ -412,15 +435,17 @@ def get_boxes_for_timestamp(timestamp_ns, per_timestamp_box_labels, lidar_T_vehi
 
 @lru_cache(maxsize=3)
 def get_sweep_and_ground_label(lidar_fpath_t0):
-    sweep_t0 = Sweep.from_feather(lidar_fpath_t0)
-
-    is_ground_t0 = JPCGroundRemove(
-        pcl=sweep_t0.xyz[:, :3],
-        range_img_width=2000,
-        range_img_height=64,
-        sensor_height=1.8,
-        delta_R=2,
-    )
+    with timed_stage("read"):
+        sweep_t0 = Sweep.from_feather(lidar_fpath_t0)
+
+    with timed_stage("ground_segmentation"):
+        is_ground_t0 = JPCGroundRemove(
+            pcl=sweep_t0.xyz[:, :3],
+            range_img_width=2000,
+            range_img_height=64,
+            sensor_height=1.8,
+            delta_R=2,
+        )
     return sweep_t0, is_ground_t0
 
 
@@ -0,0 +1,122 @@
+import hashlib
+import json
+import zipfile
+from functools import lru_cache
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+from liso.datasets.columnar_samples import (
+    read_columnar_sample,
+    save_columnar_sample,
+    unflatten_sample,
+)
+from liso.kabsch.shape_utils import Shape
+
+# sample_data_ta, sample_data_tb, meta as returned by LidarDataset.__getitem__,
+# before conversion to torch
+AssembledSampleDatas = Tuple[Dict, Dict, Dict]
+LAYOUT_KEY = "layout"
+LISO_PACKAGE_DIR = Path(__file__).resolve().parents[1]
+
+
+@lru_cache(maxsize=None)
+def get_package_source_hash(package_dir: Path = LISO_PACKAGE_DIR) -> str:
+    # loaders, ground labels, bev utils, ...: any module of the package may take
+    # part in assembling a sample, so every source change invalidates the cache
+    key = hashlib.sha256()
+    for source_file in sorted(package_dir.rglob("*.py")):
+        key.update(source_file.relative_to(package_dir).as_posix().encode("utf-8"))
+        key.update(source_file.read_bytes())
+    return key.hexdigest()
+
+
+def get_assembled_sample_key(
+    *,
+    input_fingerprints: Sequence[str],
+    time_keys: Sequence[str],
+    config: Dict,
+    code_hash: str,
+) -> str:
+    key = hashlib.sha256()
+    key.update(
+        json.dumps(
+            {
+                "inputs": list(input_fingerprints),
+                "time_keys": list(time_keys),
+                "config": config,
+                "code": code_hash,
+            },
+            sort_keys=True,
+            default=str,
+        ).encode("utf-8")
+    )
+    return key.hexdigest()
+
+
+def _encode(value, path: List[str], layout: Dict[str, List[List[str]]]):
+    # the columnar format stores nested dicts of arrays only
+    if isinstance(value, Shape):
+        layout["shapes"].append(path)
+        return dict(value.__dict__)
+    if isinstance(value, dict):
+        if len(value) == 0:
+            layout["empty_dicts"].append(path)
+        return {k: _encode(v, path + [k], layout) for k, v in value.items()}
+    return value
+
+
+def _get_parent(sample: Dict, path: List[str]) -> Dict:
+    for key in path[:-1]:
+        sample = sample.setdefault(key, {})
+    return sample
+
+
+class AssembledSampleCache:
+    """Persistent sample datas of samples that are assembled without augmentation.
+
+    Entries are columnar samples in <cache_dir>/<key[:2]>/<key>.npy, keyed by
+    the input files, time keys, config and the source of the liso package
+    (see LidarDataset.get_assembled_sample_cache_key). They are written
+    atomically, so all dataloader workers may share one cache directory.
+    Without a cache_dir, nothing is cached.
+    """
+
+    def __init__(self, cache_dir: Optional[Union[Path, str]] = None):
+        self.cache_dir = None if cache_dir is None else Path(cache_dir)
+        self.num_not_cached = 0
+
+    def get_cache_file(self, key: str) -> Path:
+        return self.cache_dir / key[:2] / f"{key}.npy"
+
+    def load(self, key: str) -> Optional[AssembledSampleDatas]:
+        try:
+            with open(self.get_cache_file(key), "rb") as f:
+                # read into private arrays, torch.from_numpy needs writable ones
+                sample = unflatten_sample(read_columnar_sample(f))
+        except (FileNotFoundError, zipfile.BadZipFile):
+            return None
+        layout = json.loads(sample.pop(LAYOUT_KEY))
+        for path in layout["empty_dicts"]:
+            _get_parent(sample, path).setdefault(path[-1], {})
+        for path in layout["shapes"]:
+            parent = _get_parent(sample, path)
+            parent[path[-1]] = Shape(**parent[path[-1]])
+        return sample["ta"], sample["tb"], sample["meta"]
+
+    def save(self, key: str, sample_datas: AssembledSampleDatas) -> None:
+        layout = {"shapes": [], "empty_dicts": []}
+        sample = _encode(dict(zip(("ta", "tb", "meta"), sample_datas)), [], layout)
+        sample[LAYOUT_KEY] = np.array(json.dumps(layout))
+        cache_file = self.get_cache_file(key)
+        cache_file.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            save_columnar_sample(cache_file, sample)
+        except ValueError as e:
+            # e.g. object arrays, these samples are assembled every time
+            self.num_not_cached += 1
+            if self.num_not_cached == 1:
+                print(
+                    f"Warning: not caching sample datas {key}: {e}. "
+                    "Further samples that cannot be cached are not reported."
+                )
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+import time
+from argparse import ArgumentParser
+
+import numpy as np
+from liso.datasets.free_space_sampler import FreeSpaceSampler
+from skimage.morphology import binary_dilation, disk
+
+
+def get_random_occupancy(rng, img_size: int, occupied_ratio: float) -> np.ndarray:
+    # lidar like: dense around the sensor in the image center, sparse far away
+    num_pillars = int(occupied_ratio * img_size**2)
+    dist_px = 0.5 * img_size * rng.uniform(0.0, 1.0, num_pillars) ** 2
+    angle = rng.uniform(-np.pi, np.pi, num_pillars)
+    direction = np.stack([np.cos(angle), np.sin(angle)], axis=-1)
+    coors = np.clip(
+        (0.5 * img_size + direction * dist_px[:, None]).astype(int), 0, img_size - 1
+    )
+    occupancy = np.zeros((img_size, img_size), dtype=bool)
+    occupancy[coors[:, 0], coors[:, 1]] = True
+    return occupancy
+
+
+def main():
+    argparser = ArgumentParser(
+        description="Benchmark distance transform against dilation box placement."
+    )
+    argparser.add_argument("--num_samples", type=int, default=3)
+    argparser.add_argument("--img_sizes", type=int, nargs="+", default=[512, 1024])
+    argparser.add_argument("--num_boxes", type=int, default=15)
+    argparser.add_argument("--occupied_ratio", type=float, default=0.1)
+    argparser.add_argument("--min_clearance_px", type=int, default=10)
+    argparser.add_argument("--max_clearance_px", type=int, default=40)
+    argparser.add_argument("--seed", type=int, default=0)
+    args = argparser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    for img_size in args.img_sizes:
+        durations_s = {
+            "dilation, min radius": 0.0,
+            "dilation per box": 0.0,
+            "distance transform": 0.0,
+        }
+        for _ in range(args.num_samples):
+            occupancy = get_random_occupancy(rng, img_size, args.occupied_ratio)
+            min_clearance_px = rng.integers(
+                args.min_clearance_px, args.max_clearance_px + 1, args.num_boxes
+            )
+
+            # previous placement: one dilation, every box gets the min clearance
+            start = time.perf_counter()
+            free = ~binary_dilation(
+                occupancy, footprint=disk(radius=args.min_clearance_px)
+            )
+            rng.choice(np.flatnonzero(free), size=args.num_boxes, replace=False)
+            durations_s["dilation, min radius"] += time.perf_counter() - start
+
+            # the same per box clearances by dilation need a dilation per radius
+            start = time.perf_counter()
+            for radius in np.unique(min_clearance_px):
+                free = ~binary_dilation(occupancy, footprint=disk(radius=radius))
+                rng.choice(np.flatnonzero(free))
+            durations_s["dilation per box"] += time.perf_counter() - start
+
+            start = time.perf_counter()
+            sampler = FreeSpaceSampler(
+                occupancy,
+                np.random.default_rng(args.seed),
+                max_clearance_px=args.max_clearance_px,
+            )
+            placements = sampler.sample_placements(min_clearance_px)
+            durations_s["distance transform"] += time.perf_counter() - start
+
+            # a clearance threshold frees the same cells as a dilation
+            clearance_sq_px = sampler.get_full_clearance_sq_px()
+            for radius in (args.min_clearance_px, args.max_clearance_px):
+                assert np.array_equal(
+                    clearance_sq_px > radius**2,
+                    ~binary_dilation(occupancy, footprint=disk(radius=radius)),
+                ), f"thresholded distance differs from dilation, radius {radius}"
+            repeated = FreeSpaceSampler(
+                occupancy,
+                np.random.default_rng(args.seed),
+                max_clearance_px=args.max_clearance_px,
+            ).sample_placements(min_clearance_px)
+            assert np.array_equal(placements, repeated), "placements not reproducible"
+
+        print(
+            f"{img_size}x{img_size}, {args.num_boxes} boxes "
+            f"({np.count_nonzero(placements[:, 0] >= 0)} placed in the last sample):"
+        )
+        for name, duration_s in durations_s.items():
+            print(
+                f"{name:>20}: {1_000 * duration_s / args.num_samples:8.2f} ms/sample "
+                f"({durations_s['dilation, min radius'] / duration_s:5.1f}x)"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+import io
+import mmap
+import struct
+import zipfile
+from argparse import ArgumentParser
+from pathlib import Path
+from typing import BinaryIO, Callable, Dict, Optional, Union
+
+import numpy as np
+from liso.utils.cloud_utils import CloudLoaderSaver
+from liso.utils.file_utils import atomic_write_bytes, sha256_hexdigest
+from liso.utils.timing_utils import timed_stage
+from tqdm import tqdm
+
+# Columnar sample format: an uncompressed npz archive with one member per
+# sample key, nested dicts are flattened to "<key>/<subkey>". Nothing is
+# pickled, load_sample_content only reads the members a dataset needs and
+# np.load can still open the files.
+# Samples keep their .npy file names and the formats are told apart by
+# content, so sample lists, indices and sharded archives stay valid when a
+# dataset is converted in place.
+COLUMNAR_KEY_SEPARATOR = "/"
+ZIP_MAGIC = b"PK\x03\x04"
+ZIP_LOCAL_HEADER_SIZE = 30
+NPY_HEADER_READERS = {
+    (1, 0): np.lib.format.read_array_header_1_0,
+    (2, 0): np.lib.format.read_array_header_2_0,
+}
+
+
+def flatten_sample(sample: Dict, prefix="") -> Dict[str, np.ndarray]:
+    flat_sample = {}
+    for key, value in sample.items():
+        assert COLUMNAR_KEY_SEPARATOR not in key, key
+        flat_key = prefix + key
+        if isinstance(value, dict):
+            flat_sample.update(
+                flatten_sample(value, prefix=flat_key + COLUMNAR_KEY_SEPARATOR)
+            )
+            continue
+        value = np.asarray(value)
+        if value.dtype.hasobject:
+            raise ValueError(f"{flat_key}: object arrays cannot be stored unpickled")
+        flat_sample[flat_key] = value
+    return flat_sample
+
+
+def unflatten_sample(flat_sample: Dict[str, np.ndarray]) -> Dict:
+    sample = {}
+    for flat_key, value in flat_sample.items():
+        *parent_keys, key = flat_key.split(COLUMNAR_KEY_SEPARATOR)
+        parent = sample
+        for parent_key in parent_keys:
+            parent = parent.setdefault(parent_key, {})
+        if value.ndim == 0 and value.dtype.kind == "U":
+            # sample names were plain python strings in the pickled format
+            value = str(value)
+        parent[key] = value
+    return sample
+
+
+def columnar_sample_bytes(sample: Dict) -> bytes:
+    buffer = io.BytesIO()
+    np.savez(buffer, **flatten_sample(sample))
+    return buffer.getvalue()
+
+
+def save_columnar_sample(path: Union[Path, str], sample: Dict) -> str:
+    """Counterpart of atomic_save_npy for samples, returns the sha256 of the file."""
+    with timed_stage("serialization"):
+        content = columnar_sample_bytes(sample)
+    with timed_stage("write"):
+        atomic_write_bytes(path, content)
+    return sha256_hexdigest(content)
+
+
+def _seek_member_array_data(sample_file: BinaryIO, info: zipfile.ZipInfo):
+    """Position sample_file at the array data of a member, returns its header.
+
+    None is returned for members that cannot be read in place.
+    """
+    sample_file.seek(info.header_offset)
+    local_header = sample_file.read(ZIP_LOCAL_HEADER_SIZE)
+    name_len, extra_len = struct.unpack("<HH", local_header[26:30])
+    sample_file.seek(info.header_offset + ZIP_LOCAL_HEADER_SIZE + name_len + extra_len)
+    version = np.lib.format.read_magic(sample_file)
+    if info.compress_type != zipfile.ZIP_STORED or version not in NPY_HEADER_READERS:
+        return None
+    return NPY_HEADER_READERS[version](sample_file)
+
+
+def _read_member(
+    sample_file: BinaryIO,
+    zip_file: zipfile.ZipFile,
+    info: zipfile.ZipInfo,
+    buffer: Optional[memoryview],
+) -> np.ndarray:
+    header = _seek_member_array_data(sample_file, info)
+    if header is None:
+        with zip_file.open(info) as member_file:
+            return np.lib.format.read_array(member_file, allow_pickle=False)
+    shape, fortran_order, dtype = header
+    count = int(np.prod(shape))
+    if buffer is not None:
+        array = np.frombuffer(buffer, dtype, count=count, offset=sample_file.tell())
+    else:
+        # one read into the final array, np.fromfile goes through small stdio reads
+        array = np.empty(count, dtype)
+        num_bytes = sample_file.readinto(array.view(np.uint8))
+        assert num_bytes == array.nbytes, (info.filename, num_bytes, array.nbytes)
+    return array.reshape(shape, order="F" if fortran_order else "C")
+
+
+def read_columnar_sample(
+    sample_file: BinaryIO,
+    keep_key: Optional[Callable[[str], bool]] = None,
+    mmap_mode: Optional[str] = None,
+) -> Dict[str, np.ndarray]:
+    """Read the kept members of a columnar sample straight from their offsets.
+
+    np.load(...)[key] streams each member through zipfile in small chunks
+    with CRC checks, which is slower than unpickling the whole sample. Members
+    are stored uncompressed, so each one is a single read instead, or with
+    mmap_mode="r" a read only view into the memory mapped file. Samples held
+    in memory (sharded archive members) are always viewed.
+    """
+    if isinstance(sample_file, io.BytesIO):
+        buffer = sample_file.getbuffer()
+    elif mmap_mode is not None:
+        assert mmap_mode == "r", mmap_mode
+        buffer = mmap.mmap(sample_file.fileno(), 0, access=mmap.ACCESS_READ)
+    else:
+        buffer = None
+    with zipfile.ZipFile(sample_file) as zip_file:
+        return {
+            info.filename[: -len(".npy")]: _read_member(
+                sample_file, zip_file, info, buffer
+            )
+            for info in zip_file.infolist()
+            if keep_key is None or keep_key(info.filename[: -len(".npy")])
+        }
+
+
+def _load_sample_file(
+    sample_file: Union[BinaryIO, Path, str],
+    keep_key: Optional[Callable[[str], bool]] = None,
+    mmap_mode: Optional[str] = None,
+) -> Union[Dict, np.ndarray]:
+    if isinstance(sample_file, (Path, str)):
+        with open(sample_file, "rb") as f:
+            return _load_sample_file(f, keep_key, mmap_mode)
+    magic = sample_file.read(len(ZIP_MAGIC))
+    sample_file.seek(0)
+    if magic == ZIP_MAGIC:
+        return unflatten_sample(read_columnar_sample(sample_file, keep_key, mmap_mode))
+    content = np.load(sample_file, allow_pickle=True)
+    if content.dtype == object and content.shape == ():
+        # legacy format: one pickled dict per sample
+        return content.item()
+    return content
+
+
+def load_sample_content(
+    sample_file: Union[Path, str],
+    loader_saver_helper: CloudLoaderSaver,
+    keep_key: Optional[Callable[[str], bool]] = None,
+    mmap_mode: Optional[str] = None,
+) -> Union[Dict, np.ndarray]:
+    """Load a columnar or legacy pickled sample as nested dict.
+
+    For columnar samples, flattened keys for which keep_key returns False are
+    never read. Pickled samples are always deserialized completely. Samples
+    that are a single plain array (e.g. tartu sample records) are returned
+    as is.
+    """
+    return loader_saver_helper.load_sample(
+        sample_file, _load_sample_file, keep_key=keep_key, mmap_mode=mmap_mode
+    )
+
+
+def is_columnar_sample_file(sample_file: Path) -> bool:
+    with open(sample_file, "rb") as f:
+        return f.read(len(ZIP_MAGIC)) == ZIP_MAGIC
+
+
+def main():
+    argparser = ArgumentParser(
+        description="Convert pickled dict samples into the columnar sample format."
+    )
+    argparser.add_argument("dataset_dir", type=Path)
+    argparser.add_argument(
+        "--target_dir",
+        type=Path,
+        default=None,
+        help="write converted samples here instead of replacing them in place",
+    )
+    argparser.add_argument("--pattern", default="*.npy")
+    args = argparser.parse_args()
+
+    target_dir = args.target_dir or args.dataset_dir
+    sample_files = sorted(args.dataset_dir.glob(args.pattern))
+    num_converted = 0
+    unconvertible = []
+    for sample_file in tqdm(sample_files):
+        if is_columnar_sample_file(sample_file):
+            continue
+        sample = np.load(sample_file, allow_pickle=True)
+        if sample.dtype != object or sample.shape != ():
+            # not a pickled dict, e.g. a tartu sample record
+            continue
+        try:
+            content = columnar_sample_bytes(sample.item())
+        except ValueError as e:
+            unconvertible.append(sample_file)
+            tqdm.write(f"Keeping {sample_file} pickled: {e}")
+            continue
+        target_file = target_dir / sample_file.relative_to(args.dataset_dir)
+        target_file.parent.mkdir(parents=True, exist_ok=True)
+        atomic_write_bytes(target_file, content)
+        num_converted += 1
+    print(
+        "Converted {0} of {1} samples, kept {2} pickled".format(
+            num_converted, len(sample_files), len(unconvertible)
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
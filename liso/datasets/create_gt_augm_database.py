@@ -5,6 +5,10 @@ from pathlib import Path
 import numpy as np
 import torch
 from liso.datasets.torch_dataset_commons import lidar_dataset_collate_fn, worker_init_fn
+from liso.kabsch.points_in_boxes import (
+    count_points_in_boxes,
+    get_points_in_boxes_sparse,
+)
 from liso.kabsch.shape_utils import Shape
 from liso.tracker.augm_box_db_utils import (
     get_empty_augm_box_db,
@@ -70,22 +74,31 @@ def build_augmentation_db_from_actual_groundtruth(
         pcl = sample_data_t0["pcl_ta"]["pcl"]
         lidar_row_idxs = sample_data_t0["lidar_rows_ta"][0].detach().cpu()
 
+        assert len(all_gt_boxes.valid.shape) == 2, "need batched data here:"
+        assert all_gt_boxes.shape[0] == pcl.shape[0] == 1, (
+            all_gt_boxes.shape,
+            pcl.shape,
+        )
         (
-            all_point_is_in_box_mask,
+            all_point_idxs,
+            all_box_idxs,
             all_pts_in_box_homog,
-        ) = all_gt_boxes.get_points_in_box_bool_mask(
-            pcl[..., :3], return_points_in_box_coords=True
+        ) = get_points_in_boxes_sparse(
+            all_gt_boxes[0],
+            pcl[0, :, :3],
+            use_double_precision=False,
+            return_points_in_box_coords=True,
         )
         enough_points_in_boxes_mask = (
-            all_point_is_in_box_mask.sum(dim=1) >= min_num_points_in_box
-        )
+            count_points_in_boxes(all_box_idxs, all_gt_boxes.shape[1])
+            >= min_num_points_in_box
+        )[None]
 
         if enough_points_in_boxes_mask.sum() == 0:
             # no boxes with enough points found
             pass
         else:
             all_gt_boxes.valid = enough_points_in_boxes_mask & all_gt_boxes.valid
-            assert len(all_gt_boxes.valid.shape) == 2, "need batched data here:"
             pcl = pcl[0]
             assert len(pcl.shape) == 2, "need batched data here:"
 
@@ -94,22 +107,13 @@ def build_augmentation_db_from_actual_groundtruth(
             enough_points_in_boxes_mask = enough_points_in_boxes_mask[0]
             all_sensor_T_box = all_sensor_T_box[enough_points_in_boxes_mask]
             all_box_T_sensor = torch.linalg.inv(all_sensor_T_box)
-            all_point_is_in_box_mask = all_point_is_in_box_mask[0][
-                :, enough_points_in_boxes_mask
-            ]
-            all_pts_in_box_homog = all_pts_in_box_homog[
-                0, :, enough_points_in_boxes_mask
-            ]
+            src_box_idxs = torch.nonzero(enough_points_in_boxes_mask)[:, 0]
 
             for box_idx in range(all_gt_boxes.shape[0]):
                 this_box = all_gt_boxes[box_idx]
-                point_is_in_this_box_mask = all_point_is_in_box_mask[:, box_idx]
-                rows_box = (
-                    lidar_row_idxs[point_is_in_this_box_mask].detach().cpu().numpy()
-                )
-                pts_in_this_box_homog = all_pts_in_box_homog[:, box_idx][
-                    point_is_in_this_box_mask
-                ]
+                pair_is_this_box = all_box_idxs == src_box_idxs[box_idx]
+                point_idxs_in_this_box = all_point_idxs[pair_is_this_box]
+                pts_in_this_box_homog = all_pts_in_box_homog[pair_is_this_box]
                 assert (
                     0.6 * this_box.dims[None, ...]
                     >= np.abs(pts_in_this_box_homog[:, :3])
@@ -117,9 +121,9 @@ def build_augmentation_db_from_actual_groundtruth(
                 this_box_T_sensor = all_box_T_sensor[box_idx]
 
                 intensity = (
-                    pcl[point_is_in_this_box_mask, 3].cpu().numpy().astype(np.float32)
+                    pcl[point_idxs_in_this_box, 3].cpu().numpy().astype(np.float32)
                 )
-                rows_box = lidar_row_idxs[point_is_in_this_box_mask].cpu().numpy()
+                rows_box = lidar_row_idxs[point_idxs_in_this_box].cpu().numpy()
 
                 assert (
                     rows_box.shape[0]
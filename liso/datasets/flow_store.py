@@ -0,0 +1,318 @@
+#!/usr/bin/env python3
+import os
+import tempfile
+from argparse import ArgumentParser
+from collections import defaultdict
+from collections.abc import Mapping
+from pathlib import Path
+from typing import Dict, List, Optional, Union
+
+import numpy as np
+from liso.utils.cloud_utils import CloudLoaderSaver
+from liso.utils.file_utils import atomic_write_json, load_json
+from tqdm import tqdm
+
+# Flow store: alternative to reading one np.savez_compressed SLIM export per
+# sample (see SLIMExperiment.slim_inference_and_save_result). The
+# bev_raw_flow_* grids of all samples of a sequence are stacked into one
+# uncompressed array per flow key, <export_dir>/flow_store/<sequence>.<key>.npy,
+# either as float16 or as int16 fixed point. Readers memory map these arrays,
+# so loading the flow of a sample reads only its own grids and decompresses
+# nothing. The grids are stored after
+# expand_valid_bev_flow_to_zero_flow_neighbor_pillars, as bev_expanded_flow_*,
+# so the expansion does not run per sample either. index.json maps sample
+# names (export file path relative to the export dir, without suffix) to
+# (sequence, row) and holds the error of the conversion against float32.
+FLOW_STORE_DIR_NAME = "flow_store"
+FLOW_STORE_INDEX_NAME = "index.json"
+FLOW_KEY_PREFIX = "bev_raw_flow_"
+EXPANDED_FLOW_KEY_PREFIX = "bev_expanded_flow_"
+FLOW_STORE_ENCODINGS = ("float16", "int16")
+# int16 fixed point: flow = value * resolution, this value marks NaN
+INT16_NAN = np.iinfo(np.int16).min
+INT16_MAX = np.iinfo(np.int16).max
+DEFAULT_INT16_RESOLUTION_M = 1e-3
+
+
+def get_flow_store_dir(export_dir: Union[Path, str]) -> Path:
+    return Path(export_dir).joinpath(FLOW_STORE_DIR_NAME)
+
+
+def get_sequence_name(sample_name: str) -> str:
+    # tartu (<date>_0_<frame>) and kitti raw sample names end with the frame
+    return sample_name.rsplit("_", 1)[0]
+
+
+def expand_valid_bev_flow_to_zero_flow_neighbor_pillars(
+    bev_flow: np.ndarray,
+) -> np.ndarray:
+    """Copy valid flow into 4-neighbor pillars without flow, i.e. zero flow.
+
+    This should fix any small numerical imprecisions during pillarization but
+    not change flow of occupied cells. The shifts wrap around the grid and run
+    one after another, so pillars filled by a shift are sources for the next.
+    """
+    pillar_has_flow = bev_flow[..., 0] != 0.0
+    for channel in range(1, bev_flow.shape[-1]):
+        pillar_has_flow |= bev_flow[..., channel] != 0.0
+    bev_flow = np.array(bev_flow, order="C")
+    # one opaque element per pillar, so that pillars are copied with 2D masks
+    pillar_flow = bev_flow.view(
+        np.dtype((np.void, bev_flow.dtype.itemsize * bev_flow.shape[-1]))
+    )[..., 0]
+    for shift in (-1, 1):
+        for axis in (0, 1):
+            fill = np.roll(pillar_has_flow, shift=shift, axis=axis)
+            fill &= ~pillar_has_flow
+            np.copyto(
+                pillar_flow, np.roll(pillar_flow, shift=shift, axis=axis), where=fill
+            )
+            pillar_has_flow |= fill
+    return bev_flow
+
+
+def encode_flow(flow: np.ndarray, encoding: str, resolution_m: float) -> np.ndarray:
+    if encoding == "float16":
+        return flow.astype(np.float16)
+    assert encoding == "int16", encoding
+    is_finite = np.isfinite(flow)
+    fixed_point = np.clip(
+        np.round(np.where(is_finite, flow, 0.0) / resolution_m), -INT16_MAX, INT16_MAX
+    )
+    return np.where(is_finite, fixed_point, INT16_NAN).astype(np.int16)
+
+
+def decode_flow(encoded: np.ndarray, resolution_m: float) -> np.ndarray:
+    if encoded.dtype == np.float16:
+        return encoded.astype(np.float32)
+    assert encoded.dtype == np.int16, encoded.dtype
+    flow = encoded.astype(np.float32) * np.float32(resolution_m)
+    flow[encoded == INT16_NAN] = np.nan
+    return flow
+
+
+class _ConversionError:
+    def __init__(self):
+        self.max_abs_error = 0.0
+        self.sum_squared_error = 0.0
+        self.num_values = 0
+        self.num_non_finite_mismatches = 0
+
+    def update(self, flow: np.ndarray, decoded: np.ndarray):
+        both_finite = np.isfinite(flow) & np.isfinite(decoded)
+        # e.g. float16 overflows to inf
+        self.num_non_finite_mismatches += int(
+            np.count_nonzero(np.isfinite(flow) != np.isfinite(decoded))
+        )
+        abs_error = np.abs(decoded[both_finite] - flow[both_finite]).astype(np.float64)
+        if abs_error.size > 0:
+            self.max_abs_error = max(self.max_abs_error, float(abs_error.max()))
+        self.sum_squared_error += float(np.sum(abs_error**2))
+        self.num_values += abs_error.size
+
+    def to_dict(self) -> Dict:
+        return {
+            "max_abs_m": self.max_abs_error,
+            "rms_m": float(np.sqrt(self.sum_squared_error / max(self.num_values, 1))),
+            "num_non_finite_mismatches": self.num_non_finite_mismatches,
+        }
+
+
+def _write_stacked_flow(
+    path: Path,
+    sample_files: List[Path],
+    flow_key: str,
+    encoding: str,
+    resolution_m: float,
+    conversion_error: _ConversionError,
+):
+    """Write the expanded, encoded flow grids of sample_files to one .npy."""
+    fd, tmp_path = tempfile.mkstemp(
+        dir=path.parent, prefix=f".{path.name}.", suffix=".tmp"
+    )
+    os.close(fd)
+    try:
+        stacked = None
+        for row, sample_file in enumerate(sample_files):
+            flow = expand_valid_bev_flow_to_zero_flow_neighbor_pillars(
+                np.load(sample_file)[flow_key]
+            )
+            encoded = encode_flow(flow, encoding, resolution_m)
+            conversion_error.update(flow, decode_flow(encoded, resolution_m))
+            if stacked is None:
+                stacked = np.lib.format.open_memmap(
+                    tmp_path,
+                    mode="w+",
+                    dtype=encoded.dtype,
+                    shape=(len(sample_files),) + encoded.shape,
+                )
+            stacked[row] = encoded
+        stacked.flush()
+        del stacked
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def convert_npz_exports(
+    export_dir: Path,
+    encoding: str = "float16",
+    resolution_m: float = DEFAULT_INT16_RESOLUTION_M,
+) -> Dict:
+    """Build the flow store of all .npz SLIM exports below export_dir."""
+    assert encoding in FLOW_STORE_ENCODINGS, encoding
+    store_dir = get_flow_store_dir(export_dir)
+    store_dir.mkdir(parents=True, exist_ok=True)
+    sample_files_per_sequence = defaultdict(list)
+    for sample_file in sorted(export_dir.rglob("*.npz")):
+        sample_name = sample_file.relative_to(export_dir).with_suffix("").as_posix()
+        sample_files_per_sequence[get_sequence_name(sample_name)].append(sample_file)
+
+    index = {
+        "encoding": encoding,
+        "resolution_m": resolution_m if encoding == "int16" else None,
+        "sequences": {},
+        "samples": {},
+    }
+    conversion_errors = defaultdict(_ConversionError)
+    for sequence, sample_files in tqdm(sorted(sample_files_per_sequence.items())):
+        first_content = np.load(sample_files[0])
+        flow_keys = sorted(k for k in first_content if k.startswith(FLOW_KEY_PREFIX))
+        bev_range_m = first_content["bev_range_m"]
+        for row, sample_file in enumerate(sample_files):
+            # members of an npz are only decompressed on access
+            content = np.load(sample_file)
+            assert np.array_equal(content["bev_range_m"], bev_range_m), sample_file
+            assert sorted(content.files) == sorted(first_content.files), sample_file
+            sample_name = sample_file.relative_to(export_dir).with_suffix("").as_posix()
+            index["samples"][sample_name] = [sequence, row]
+        stored_flow_keys = []
+        for flow_key in flow_keys:
+            stored_flow_key = flow_key.replace(
+                FLOW_KEY_PREFIX, EXPANDED_FLOW_KEY_PREFIX
+            )
+            _write_stacked_flow(
+                store_dir.joinpath(
+                    f"{sequence.replace('/', '.')}.{stored_flow_key}.npy"
+                ),
+                sample_files,
+                flow_key,
+                encoding=encoding,
+                resolution_m=resolution_m,
+                conversion_error=conversion_errors[stored_flow_key],
+            )
+            stored_flow_keys.append(stored_flow_key)
+        index["sequences"][sequence] = {
+            "bev_range_m": bev_range_m.tolist(),
+            "flow_keys": stored_flow_keys,
+            "num_samples": len(sample_files),
+        }
+    index["error_vs_float32"] = {k: v.to_dict() for k, v in conversion_errors.items()}
+    # written last: a store without index is incomplete and not used
+    atomic_write_json(store_dir.joinpath(FLOW_STORE_INDEX_NAME), index)
+    return index
+
+
+def describe_conversion_error(index: Dict) -> str:
+    lines = [f"Flow store encoding {index['encoding']}, error against float32:"]
+    for flow_key, error in sorted(index["error_vs_float32"].items()):
+        lines.append(
+            f"  {flow_key}: max {error['max_abs_m']:.2e} m, "
+            f"rms {error['rms_m']:.2e} m, "
+            f"{error['num_non_finite_mismatches']} non finite mismatches"
+        )
+    return "\n".join(lines)
+
+
+class _FlowStoreSample(Mapping):
+    """Content of one sample, decodes flow grids on access like an NpzFile."""
+
+    def __init__(self, flow_store: "FlowStore", sequence: str, row: int):
+        self.flow_store = flow_store
+        self.sequence = sequence
+        self.row = row
+        self.sequence_info = flow_store.index["sequences"][sequence]
+
+    def __getitem__(self, key):
+        if key == "bev_range_m":
+            return np.array(self.sequence_info["bev_range_m"], dtype=np.float32)
+        if key not in self.sequence_info["flow_keys"]:
+            raise KeyError(key)
+        encoded = self.flow_store.get_stacked_flow(self.sequence, key)[self.row]
+        return decode_flow(encoded, self.flow_store.index["resolution_m"])
+
+    def __contains__(self, key):
+        return key == "bev_range_m" or key in self.sequence_info["flow_keys"]
+
+    def __iter__(self):
+        return iter(["bev_range_m"] + self.sequence_info["flow_keys"])
+
+    def __len__(self):
+        return 1 + len(self.sequence_info["flow_keys"])
+
+
+class FlowStore:
+    def __init__(
+        self,
+        export_dir: Union[Path, str],
+        loader_saver_helper: Optional[CloudLoaderSaver] = None,
+    ):
+        self.store_dir = get_flow_store_dir(export_dir)
+        self.index = load_json(self.store_dir.joinpath(FLOW_STORE_INDEX_NAME))
+        if self.index is None:
+            raise FileNotFoundError(
+                f"No flow store in {export_dir}, create it with "
+                f"python -m liso.datasets.flow_store {export_dir}"
+            )
+        self.loader_saver_helper = loader_saver_helper or CloudLoaderSaver()
+        self.stacked_flows = {}
+
+    def get_stacked_flow(self, sequence: str, flow_key: str) -> np.ndarray:
+        if (sequence, flow_key) not in self.stacked_flows:
+            self.stacked_flows[
+                (sequence, flow_key)
+            ] = self.loader_saver_helper.load_sample(
+                self.store_dir.joinpath(f"{sequence.replace('/', '.')}.{flow_key}.npy"),
+                np.load,
+                mmap_mode="r",
+            )
+        return self.stacked_flows[(sequence, flow_key)]
+
+    def has_sample(self, sample_name: str) -> bool:
+        return sample_name in self.index["samples"]
+
+    def load_sample(self, sample_name: str) -> Optional[Mapping]:
+        if not self.has_sample(sample_name):
+            return None
+        sequence, row = self.index["samples"][sample_name]
+        return _FlowStoreSample(self, sequence, row)
+
+
+def main():
+    argparser = ArgumentParser(
+        description="Convert .npz SLIM flow exports into a memory mapped flow store."
+    )
+    argparser.add_argument("export_dir", type=Path)
+    argparser.add_argument(
+        "--encoding", choices=FLOW_STORE_ENCODINGS, default="float16"
+    )
+    argparser.add_argument(
+        "--resolution_m",
+        type=float,
+        default=DEFAULT_INT16_RESOLUTION_M,
+        help="int16 fixed point resolution, flows beyond +-32767 of it are clipped",
+    )
+    args = argparser.parse_args()
+
+    index = convert_npz_exports(args.export_dir, args.encoding, args.resolution_m)
+    print(
+        f"Stored {len(index['samples'])} samples of {len(index['sequences'])} "
+        f"sequences in {get_flow_store_dir(args.export_dir)}"
+    )
+    print(describe_conversion_error(index))
+
+
+if __name__ == "__main__":
+    main()
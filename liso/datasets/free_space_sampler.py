@@ -0,0 +1,214 @@
+from typing import Optional
+
+import numpy as np
+from scipy.ndimage import distance_transform_edt
+
+# Box augmentation placements in free BEV space. A cell is free for a box if
+# its Euclidean distance (clearance) to the closest occupied pillar is above
+# the box's threshold, exactly the cells that binary_dilation with disk(r)
+# leaves free, so boxes of any size are placed by thresholding instead of
+# dilating once per radius. The distance transform is separable: one pass
+# over the rows gives the horizontal clearance, the clearance of a cell is
+# the minimum of dy**2 + horizontal clearance**2 over the cells of its column.
+# Clearances are only needed up to the largest threshold, so the column pass
+# only looks max_clearance_px far. It runs for drawn cells only, the full
+# transform is only computed if draws keep being rejected. Placed boxes
+# block the cells of a coarse bitmap, later boxes are not placed near them.
+DEFAULT_COARSE_CELL_SIZE_PX = 4
+# uniform draws over the candidates before falling back to an exact (full
+# transform) draw over the cells that fit a box
+MAX_NUM_REJECTION_TRIALS = 32
+
+
+class FreeSpaceSampler:
+    def __init__(
+        self,
+        occupancy: np.ndarray,
+        rng: np.random.Generator,
+        max_clearance_px: float,
+        coarse_cell_size_px: int = DEFAULT_COARSE_CELL_SIZE_PX,
+    ):
+        assert occupancy.ndim == 2 and occupancy.dtype == bool, (
+            occupancy.shape,
+            occupancy.dtype,
+        )
+        self.rng = rng
+        self.img_shape = occupancy.shape
+        self.max_clearance_px = int(np.ceil(max_clearance_px))
+        # clearances beyond max_clearance_px are clipped to this
+        far_px = self.max_clearance_px + 1
+        # horizontal pass first, numpy accumulates along the last axis much faster
+        cols = np.arange(occupancy.shape[1], dtype=np.int32)
+        occupied_col_left = np.maximum.accumulate(
+            np.where(occupancy, cols, -far_px), axis=1
+        )
+        occupied_col_right = np.minimum.accumulate(
+            np.where(occupancy, cols, occupancy.shape[1] + far_px)[:, ::-1], axis=1
+        )[:, ::-1]
+        row_clearance_px = np.minimum(
+            np.minimum(cols - occupied_col_left, occupied_col_right - cols), far_px
+        )
+        self.row_clearance_sq_px = row_clearance_px**2
+        self.clearance_sq_px = None
+
+        self.coarse_cell_size_px = coarse_cell_size_px
+        self.placement_is_blocked = np.zeros(
+            (
+                -(-occupancy.shape[0] // coarse_cell_size_px),
+                -(-occupancy.shape[1] // coarse_cell_size_px),
+            ),
+            dtype=bool,
+        )
+
+    def get_full_clearance_sq_px(self) -> np.ndarray:
+        """Squared clearance [H, W], exact up to max_clearance_px**2."""
+        if self.clearance_sq_px is None:
+            clearance_sq_px = self.row_clearance_sq_px.copy()
+            for dy in range(1, self.max_clearance_px + 1):
+                np.minimum(
+                    clearance_sq_px[dy:],
+                    self.row_clearance_sq_px[:-dy] + dy**2,
+                    out=clearance_sq_px[dy:],
+                )
+                np.minimum(
+                    clearance_sq_px[:-dy],
+                    self.row_clearance_sq_px[dy:] + dy**2,
+                    out=clearance_sq_px[:-dy],
+                )
+            self.clearance_sq_px = clearance_sq_px
+        return self.clearance_sq_px
+
+    def get_clearance_sq_px(self, flat_idxs: np.ndarray) -> np.ndarray:
+        """Squared clearance of some cells, exact up to max_clearance_px**2."""
+        if self.clearance_sq_px is not None:
+            return self.clearance_sq_px.ravel()[flat_idxs]
+        rows, cols = np.divmod(flat_idxs, self.img_shape[1])
+        dy = np.arange(-self.max_clearance_px, self.max_clearance_px + 1)
+        neighbor_rows = rows[..., None] + dy
+        neighbor_is_inside = (neighbor_rows >= 0) & (neighbor_rows < self.img_shape[0])
+        neighbor_clearance_sq_px = (
+            self.row_clearance_sq_px[
+                np.clip(neighbor_rows, 0, self.img_shape[0] - 1), cols[..., None]
+            ]
+            + dy**2
+        )
+        return np.where(
+            neighbor_is_inside,
+            neighbor_clearance_sq_px,
+            np.iinfo(neighbor_clearance_sq_px.dtype).max,
+        ).min(axis=-1)
+
+    def block(self, pixel_coors: np.ndarray, radius_px: float):
+        # all coarse cells that hold pixels within radius_px of pixel_coors
+        cell_size = self.coarse_cell_size_px
+        half_cell_diagonal = cell_size * np.sqrt(0.5)
+        lower = np.maximum(
+            ((pixel_coors - radius_px - half_cell_diagonal) // cell_size).astype(int),
+            0,
+        )
+        upper = np.minimum(
+            ((pixel_coors + radius_px + half_cell_diagonal) // cell_size).astype(int)
+            + 1,
+            self.placement_is_blocked.shape,
+        )
+        cell_center_offset = 0.5 * (cell_size - 1)
+        center_dist_px = np.hypot(
+            np.arange(lower[0], upper[0])[:, None] * cell_size
+            + cell_center_offset
+            - pixel_coors[0],
+            np.arange(lower[1], upper[1])[None, :] * cell_size
+            + cell_center_offset
+            - pixel_coors[1],
+        )
+        self.placement_is_blocked[lower[0] : upper[0], lower[1] : upper[1]] |= (
+            center_dist_px <= radius_px + half_cell_diagonal
+        )
+
+    def get_blocking_radius_cells(self, radius_px: float) -> float:
+        # a pixel is more than radius_px away from the blocked pixels if no
+        # blocked coarse cell is within radius_px + one cell diagonal of the
+        # coarse cell of the pixel
+        return radius_px / self.coarse_cell_size_px + np.sqrt(2.0)
+
+    def get_coarse_disk(self, radius_px: float) -> np.ndarray:
+        radius_cells = self.get_blocking_radius_cells(radius_px)
+        offsets = np.arange(-int(radius_cells), int(radius_cells) + 1)
+        return np.hypot(offsets[:, None], offsets[None, :]) <= radius_cells
+
+    def is_blocked(self, cell: int, radius_px: float) -> bool:
+        coarse_disk = self.get_coarse_disk(radius_px)
+        radius_cells = coarse_disk.shape[0] // 2
+        coarse_coors = np.array(divmod(cell, self.img_shape[1])) // (
+            self.coarse_cell_size_px
+        )
+        lower = np.maximum(coarse_coors - radius_cells, 0)
+        upper = np.minimum(
+            coarse_coors + radius_cells + 1, self.placement_is_blocked.shape
+        )
+        disk_lower = lower - (coarse_coors - radius_cells)
+        disk_upper = disk_lower + upper - lower
+        return bool(
+            (
+                self.placement_is_blocked[lower[0] : upper[0], lower[1] : upper[1]]
+                & coarse_disk[
+                    disk_lower[0] : disk_upper[0], disk_lower[1] : disk_upper[1]
+                ]
+            ).any()
+        )
+
+    def sample_cell(
+        self, candidates: np.ndarray, min_clearance_px: float
+    ) -> Optional[int]:
+        """Uniform draw of a candidate cell that fits, None if there is none."""
+        if candidates.shape[0] == 0:
+            return None
+        for _ in range(MAX_NUM_REJECTION_TRIALS):
+            cell = candidates[self.rng.integers(candidates.shape[0])]
+            if self.get_clearance_sq_px(
+                cell
+            ) > min_clearance_px**2 and not self.is_blocked(cell, min_clearance_px):
+                return int(cell)
+        self.get_full_clearance_sq_px()
+        # same test as is_blocked, for all candidates at once
+        if self.placement_is_blocked.any():
+            coarse_cell_is_blocked = distance_transform_edt(
+                ~self.placement_is_blocked
+            ) <= self.get_blocking_radius_cells(min_clearance_px)
+        else:
+            coarse_cell_is_blocked = self.placement_is_blocked
+        rows, cols = np.divmod(candidates, self.img_shape[1])
+        cell_fits = (self.get_clearance_sq_px(candidates) > min_clearance_px**2) & (
+            ~coarse_cell_is_blocked[
+                rows // self.coarse_cell_size_px, cols // self.coarse_cell_size_px
+            ]
+        )
+        if not cell_fits.any():
+            return None
+        return int(self.rng.choice(candidates[cell_fits]))
+
+    def sample_placements(self, min_clearance_px: np.ndarray) -> np.ndarray:
+        """Pixel coordinates [N, 2] of box centers, -1 for boxes that did not fit.
+
+        Boxes are placed in the given order. A center is more than
+        min_clearance_px away from occupied pillars and from the circles of
+        min_clearance_px around earlier boxes.
+        """
+        placements = np.full((min_clearance_px.shape[0], 2), -1, dtype=np.int64)
+        if min_clearance_px.shape[0] == 0:
+            return placements
+        max_clearance_px = min_clearance_px.max()
+        assert max_clearance_px <= self.max_clearance_px, (
+            max_clearance_px,
+            self.max_clearance_px,
+        )
+        # the horizontal clearance is an upper bound of the clearance
+        candidates = np.flatnonzero(
+            self.row_clearance_sq_px > min_clearance_px.min() ** 2
+        )
+        for box_idx, box_clearance_px in enumerate(min_clearance_px):
+            cell = self.sample_cell(candidates, box_clearance_px)
+            if cell is None:
+                continue
+            placements[box_idx] = divmod(cell, self.img_shape[1])
+            self.block(placements[box_idx], box_clearance_px)
+        return placements
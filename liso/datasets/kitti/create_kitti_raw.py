@@ -2,24 +2,30 @@
 from argparse import ArgumentParser
 from functools import lru_cache
 from pathlib import Path
+from typing import Dict, List, Tuple
 
 import numpy as np
 import pykitti
-from liso.jcp.jcp import JPCGroundRemove
+from liso.datasets.columnar_samples import save_columnar_sample
+from liso.jcp.fast_jcp import JPCGroundRemove
+from liso.utils.file_utils import atomic_save_npy, atomic_write_json
+from liso.utils.timing_utils import StageTimer, set_active_stage_timer, timed_stage
 from tqdm import tqdm
 
 
 @lru_cache(maxsize=32)
 def load_kitti_pcl_image_projection_get_ground_label(velo_file: str, kitti_desc="raw"):
     assert kitti_desc in ("raw", "tracking", "object"), kitti_desc
-    kitti_pcl = pykitti.utils.load_velo_scan(velo_file)
-    is_ground = JPCGroundRemove(
-        pcl=kitti_pcl[:, :3],
-        range_img_width=2083,
-        range_img_height=64,
-        sensor_height=1.73,
-        delta_R=1,
-    )
+    with timed_stage("read"):
+        kitti_pcl = pykitti.utils.load_velo_scan(velo_file)
+    with timed_stage("ground_segmentation"):
+        is_ground = JPCGroundRemove(
+            pcl=kitti_pcl[:, :3],
+            range_img_width=2083,
+            range_img_height=64,
+            sensor_height=1.73,
+            delta_R=1,
+        )
     homog_pcl = np.copy(kitti_pcl)
     assert len(homog_pcl.shape) == 2, homog_pcl.shape
     assert homog_pcl.shape[-1] == 4, homog_pcl.shape
@@ -36,11 +42,89 @@ def correct_kitti_scan(frame: np.ndarray):
     )
 
 
-def main():
+def compute_kiss_icp_poses(velo_files: List[str]) -> np.ndarray:
     from kiss_icp.config import KISSConfig
     from kiss_icp.datasets.kitti_raw import KITTIRawDataset
     from kiss_icp.kiss_icp import KissICP
 
+    kiss_config = KISSConfig()
+    kiss_config.mapping.voxel_size = 0.01 * kiss_config.data.max_range
+    odometry = KissICP(config=kiss_config)
+    for velo_file in velo_files:
+        with timed_stage("read"):
+            kitti_pcl = pykitti.utils.load_velo_scan(velo_file)
+        with timed_stage("odometry"):
+            timestamps = KITTIRawDataset.get_timestamps(kitti_pcl).astype(np.float64)
+            odometry.register_frame(
+                correct_kitti_scan(np.copy(kitti_pcl[:, :3]).astype(np.float64)),
+                timestamps=timestamps,
+            )
+    return np.asarray(odometry.poses)
+
+
+def get_kiss_odometry(w_Ts_si: np.ndarray, idx: int) -> Dict[str, np.ndarray]:
+    kiss_odom_t0_t1 = np.linalg.inv(w_Ts_si[idx]) @ w_Ts_si[idx + 1]
+    kiss_odom_t0_t2 = np.linalg.inv(w_Ts_si[idx]) @ w_Ts_si[idx + 2]
+    kiss_odom_t1_t2 = np.linalg.inv(w_Ts_si[idx + 1]) @ w_Ts_si[idx + 2]
+    return {
+        "kiss_odom_t0_t1": kiss_odom_t0_t1,
+        "kiss_odom_t1_t0": np.linalg.inv(kiss_odom_t0_t1),
+        "kiss_odom_t0_t2": kiss_odom_t0_t2,
+        "kiss_odom_t2_t0": np.linalg.inv(kiss_odom_t0_t2),
+        "kiss_odom_t1_t2": kiss_odom_t1_t2,
+        "kiss_odom_t2_t1": np.linalg.inv(kiss_odom_t1_t2),
+    }
+
+
+def create_kitti_raw_sample(
+    kitti, date: str, drive_str: str, idx: int, w_Ts_si: np.ndarray
+) -> Tuple[str, Dict[str, np.ndarray]]:
+    idx_str_t0 = Path(kitti.velo_files[idx]).stem
+
+    (
+        pcl_t0,
+        _,
+        is_ground_t0,
+    ) = load_kitti_pcl_image_projection_get_ground_label(kitti.velo_files[idx])
+    (
+        pcl_t1,
+        _,
+        is_ground_t1,
+    ) = load_kitti_pcl_image_projection_get_ground_label(kitti.velo_files[idx + 1])
+    (
+        pcl_t2,
+        _,
+        is_ground_t2,
+    ) = load_kitti_pcl_image_projection_get_ground_label(kitti.velo_files[idx + 2])
+
+    w_T_imu_t0 = kitti.oxts[idx].T_w_imu.astype(np.float64)
+    w_T_imu_t1 = kitti.oxts[idx + 1].T_w_imu.astype(np.float64)
+    w_T_imu_t2 = kitti.oxts[idx + 2].T_w_imu.astype(np.float64)
+    imu_T_velo = np.linalg.inv(kitti.calib.T_velo_imu.astype(np.float64))
+
+    w_T_velo_t0 = np.matmul(w_T_imu_t0, imu_T_velo)
+    w_T_velo_t1 = np.matmul(w_T_imu_t1, imu_T_velo)
+    w_T_velo_t2 = np.matmul(w_T_imu_t2, imu_T_velo)
+
+    odom_t0_t1 = np.matmul(np.linalg.inv(w_T_velo_t0), w_T_velo_t1)
+    odom_t0_t2 = np.matmul(np.linalg.inv(w_T_velo_t0), w_T_velo_t2)
+    sample_name = "{0}_{1}_{2}".format(date, drive_str, idx_str_t0)
+    data_dict = {
+        "pcl_t0": pcl_t0.astype(np.float32),
+        "pcl_t1": pcl_t1.astype(np.float32),
+        "pcl_t2": pcl_t2.astype(np.float32),
+        "is_ground_t0": is_ground_t0,
+        "is_ground_t1": is_ground_t1,
+        "is_ground_t2": is_ground_t2,
+        "odom_t0_t1": odom_t0_t1.astype(np.float64),
+        "odom_t0_t2": odom_t0_t2.astype(np.float64),
+        "name": sample_name,
+        **get_kiss_odometry(w_Ts_si, idx),
+    }
+    return sample_name, data_dict
+
+
+def main():
     argparser = ArgumentParser(description="Convert kitti raw data to training format.")
     argparser.add_argument(
         "--target_dir",
@@ -52,14 +136,25 @@ def main():
         required=True,
         type=Path,
     )
+    argparser.add_argument(
+        "--progress_interval_s",
+        default=60.0,
+        type=float,
+        help="seconds between throughput lines in the log",
+    )
     args = argparser.parse_args()
 
     target_dir = args.target_dir / "kitti_raw"
 
     target_dir.mkdir(parents=True, exist_ok=True)
+    pose_table_dir = target_dir / "poses"
+    pose_table_dir.mkdir(parents=True, exist_ok=True)
 
     dates = ["2011_09_26", "2011_09_28", "2011_09_29", "2011_09_30", "2011_10_03"]
 
+    stage_timer = StageTimer("create_kitti_raw", args.progress_interval_s)
+    set_active_stage_timer(stage_timer)
+
     skipped_sequences = 0
     success = 0
     for date in tqdm(dates):
@@ -71,110 +166,32 @@ def main():
             except FileNotFoundError:
                 skipped_sequences += 1
                 continue
-            kiss_config = KISSConfig()
-            kiss_config.mapping.voxel_size = 0.01 * kiss_config.data.max_range
-            odometry = KissICP(config=kiss_config)
+            if len(kitti.velo_files) < 3:
+                continue
+
+            # phase 1: streaming odometry pass over the raw points only
+            w_Ts_si = compute_kiss_icp_poses(kitti.velo_files)
+            atomic_save_npy(
+                pose_table_dir / f"{date}_{drive_str}.npy",
+                w_Ts_si,
+                allow_pickle=False,
+            )
+
+            # phase 2: every sample is written exactly once, odometry included
             seq_idxs = list(range(0, len(kitti.velo_files) - 2, 1))
-            fnames = []
             for idx in tqdm(seq_idxs, leave=False):
-                idx_str_t0 = Path(kitti.velo_files[idx]).stem
-
-                (
-                    pcl_t0,
-                    _,
-                    is_ground_t0,
-                ) = load_kitti_pcl_image_projection_get_ground_label(
-                    kitti.velo_files[idx]
+                sample_name, data_dict = create_kitti_raw_sample(
+                    kitti, date, drive_str, idx, w_Ts_si
                 )
-                timestamps = KITTIRawDataset.get_timestamps(pcl_t0).astype(np.float64)
-                odometry.register_frame(
-                    correct_kitti_scan(np.copy(pcl_t0[:, :3]).astype(np.float64)),
-                    timestamps=timestamps,
-                )
-                (
-                    pcl_t1,
-                    _,
-                    is_ground_t1,
-                ) = load_kitti_pcl_image_projection_get_ground_label(
-                    kitti.velo_files[idx + 1]
-                )
-                (
-                    pcl_t2,
-                    _,
-                    is_ground_t2,
-                ) = load_kitti_pcl_image_projection_get_ground_label(
-                    kitti.velo_files[idx + 2]
-                )
-
-                w_T_imu_t0 = kitti.oxts[idx].T_w_imu.astype(np.float64)
-                w_T_imu_t1 = kitti.oxts[idx + 1].T_w_imu.astype(np.float64)
-                w_T_imu_t2 = kitti.oxts[idx + 2].T_w_imu.astype(np.float64)
-                imu_T_velo = np.linalg.inv(kitti.calib.T_velo_imu.astype(np.float64))
-
-                w_T_velo_t0 = np.matmul(w_T_imu_t0, imu_T_velo)
-                w_T_velo_t1 = np.matmul(w_T_imu_t1, imu_T_velo)
-                w_T_velo_t2 = np.matmul(w_T_imu_t2, imu_T_velo)
-
-                odom_t0_t1 = np.matmul(np.linalg.inv(w_T_velo_t0), w_T_velo_t1)
-                odom_t0_t2 = np.matmul(np.linalg.inv(w_T_velo_t0), w_T_velo_t2)
-                sample_name = "{0}_{1}_{2}".format(date, drive_str, idx_str_t0)
-                data_dict = {
-                    "pcl_t0": pcl_t0.astype(np.float32),
-                    "pcl_t1": pcl_t1.astype(np.float32),
-                    "pcl_t2": pcl_t2.astype(np.float32),
-                    "is_ground_t0": is_ground_t0,
-                    "is_ground_t1": is_ground_t1,
-                    "is_ground_t2": is_ground_t2,
-                    "odom_t0_t1": odom_t0_t1.astype(np.float64),
-                    "odom_t0_t2": odom_t0_t2.astype(np.float64),
-                    "name": sample_name,
-                }
-
-                target_fname = target_dir / Path(sample_name)
-                fnames.append(target_fname)
-                np.save(
-                    target_fname,
-                    data_dict,
-                )
-                if idx == seq_idxs[-1]:
-                    timestamps = KITTIRawDataset.get_timestamps(pcl_t1).astype(
-                        np.float64
-                    )
-                    odometry.register_frame(
-                        correct_kitti_scan(np.copy(pcl_t1[:, :3]).astype(np.float64)),
-                        timestamps=timestamps,
-                    )
-                    timestamps = KITTIRawDataset.get_timestamps(pcl_t2).astype(
-                        np.float64
-                    )
-                    odometry.register_frame(
-                        correct_kitti_scan(np.copy(pcl_t2[:, :3]).astype(np.float64)),
-                        timestamps=timestamps,
-                    )
-
+                save_columnar_sample(target_dir / f"{sample_name}.npy", data_dict)
                 success += 1
-            w_Ts_si = odometry.poses
-            for file_idx, fname in enumerate(fnames):
-                content = np.load(fname.with_suffix(".npy"), allow_pickle=True).item()
-                kiss_odom_t0_t1 = (
-                    np.linalg.inv(w_Ts_si[file_idx]) @ w_Ts_si[file_idx + 1]
-                )
-                kiss_odom_t0_t2 = (
-                    np.linalg.inv(w_Ts_si[file_idx]) @ w_Ts_si[file_idx + 2]
-                )
-                kiss_odom_t1_t2 = (
-                    np.linalg.inv(w_Ts_si[file_idx + 1]) @ w_Ts_si[file_idx + 2]
-                )
-                content["kiss_odom_t0_t1"] = kiss_odom_t0_t1
-                content["kiss_odom_t1_t0"] = np.linalg.inv(kiss_odom_t0_t1)
-                content["kiss_odom_t0_t2"] = kiss_odom_t0_t2
-                content["kiss_odom_t2_t0"] = np.linalg.inv(kiss_odom_t0_t2)
-                content["kiss_odom_t1_t2"] = kiss_odom_t1_t2
-                content["kiss_odom_t2_t1"] = np.linalg.inv(kiss_odom_t1_t2)
-
-                np.save(fname, content)
+                stage_timer.add_frames()
 
     print("Skipped: {0} Success: {1}".format(skipped_sequences, success))
+    stage_timer.print_progress()
+    timing_summary_file = target_dir / "timing_summary.json"
+    atomic_write_json(timing_summary_file, stage_timer.get_summary())
+    print(f"Wrote per stage timings to {timing_summary_file}")
 
 
 if __name__ == "__main__":
@@ -119,16 +119,15 @@ class KittiObjectDataset(LidarDataset):
         self.initialize_loader_saver_if_necessary()
         self.initialize_dbs_if_necessary()
         fname = self.sample_files[index]
-        sample_content = self.loader_saver_helper.load_sample(
-            fname, np.load, allow_pickle=True
-        ).item()
-
         src_key, target_key, delete_target_key, src_trgt_time_delta_s = (
             "t0",
             "t1",
             "t2",
             0.1,
         )
+        sample_content = self.load_sample_content(
+            fname, src_key, target_key, delete_target_key
+        )
 
         add_lidar_rows_to_kitti_sample(sample_content, time_keys=(src_key, target_key))
 
@@ -13,6 +13,7 @@ from liso.datasets.torch_dataset_commons import (
     LidarDataset,
     LidarSample,
     add_lidar_rows_to_kitti_sample,
+    get_lidar_data_loader,
     get_weighted_random_sampler_dropping_samples_without_boxes,
     lidar_dataset_collate_fn,
     recursive_npy_dict_to_torch,
@@ -139,7 +140,7 @@ class KittiRawDataset(LidarDataset):
 
         print("sequence lengths: ", self.sequence_lens)
 
-        assert self.data_use_skip_frames in ("only", "both", "never")
+        assert self.data_use_skip_frames in ("only", "both", "never", "multi_pair")
 
         if self.mode == "train" and self.cfg.data.flow_source != "gt":
             pred_flow_path = Path(
@@ -198,36 +199,17 @@ class KittiRawDataset(LidarDataset):
         )
         return samples_in_sequence
 
-    def __getitem__(self, index):
-        self.initialize_loader_saver_if_necessary()
-        self.initialize_dbs_if_necessary()
-        fname = str(self.sample_files[index], encoding="utf-8")
-        sample_content = self.loader_saver_helper.load_sample(
-            fname, np.load, allow_pickle=True
-        ).item()
+    def prepare_sample_content(self, fname, target_keys_per_frame, drop_time_keys):
+        sample_content = self.load_sample_content(fname, *drop_time_keys)
         if not self.cfg.data.use_lidar_intensity:
             self.drop_intensities_from_pcls_in_sample(sample_content)
-
-        if self.for_tracking:
-            src_key = "t0"
-            target_key = "t1"
-            src_trgt_time_delta_s = 0.1
-            self.drop_unused_timed_keys_from_sample(sample_content, "foo", "bar", "baz")
-        else:
-            (
-                src_key,
-                target_key,
-                delete_target_key,
-                src_trgt_time_delta_s,
-            ) = self.select_time_keys()
-
-            self.drop_unused_timed_keys_from_sample(
-                sample_content, src_key, target_key, delete_target_key
-            )
+        self.drop_unused_timed_keys_from_sample(sample_content, *drop_time_keys)
         # KITTI (RAW) SPECIFIC: only needed to create tracking DB (raydrop augmentation)
-        add_lidar_rows_to_kitti_sample(sample_content, time_keys=(src_key, target_key))
-        sample_content = self.drop_points_on_kitti_vehicle(
-            sample_content, src_key, target_key
+        add_lidar_rows_to_kitti_sample(
+            sample_content, time_keys=tuple(target_keys_per_frame)
+        )
+        sample_content = self.drop_frame_points_on_kitti_vehicle(
+            sample_content, target_keys_per_frame
         )
         # restructure_sample
         sample_content = self.move_keys_to_subdict(
@@ -238,6 +220,14 @@ class KittiRawDataset(LidarDataset):
         )
         sample_content = self.move_keys_to_subdict(sample_content)
         self.add_reverse_odometry_to_sample(sample_content)
+        return sample_content
+
+    def assemble_sample_datas(
+        self, fname, src_key, target_key, src_trgt_time_delta_s, drop_time_keys
+    ):
+        sample_content = self.prepare_sample_content(
+            fname, {src_key: (target_key,), target_key: (src_key,)}, drop_time_keys
+        )
 
         if self.need_flow and self.training_target == "object":
             assert (
@@ -299,13 +289,6 @@ class KittiRawDataset(LidarDataset):
                     "tb",
                     "t0",  # stuff will have been remapped
                 )
-            return (
-                recursive_npy_dict_to_torch(sample_data_ta),
-                recursive_npy_dict_to_torch(sample_data_tb),
-                {},
-                meta,
-            )
-
         else:
             sample_data_ta = self.assemble_sample_data(
                 deepcopy(sample_content), src_key, target_key, src_trgt_time_delta_s
@@ -316,6 +299,50 @@ class KittiRawDataset(LidarDataset):
                 )
             else:
                 sample_data_tb = {"gt": {}}
+        return sample_data_ta, sample_data_tb, meta
+
+    def get_sample_sequence_names(self) -> List[str]:
+        # sample_name: 2011_09_26_0001_0000000000.npy
+        return [
+            "_".join(Path(str(sample_file, encoding="utf-8")).stem.split("_")[0:4])
+            for sample_file in self.sample_files
+        ]
+
+    def get_sample_ids(self) -> List[str]:
+        return [
+            Path(str(sample_file, encoding="utf-8")).stem
+            for sample_file in self.sample_files
+        ]
+
+    def __getitem__(self, index):
+        self.initialize_loader_saver_if_necessary()
+        self.initialize_dbs_if_necessary()
+        fname = str(self.sample_files[index], encoding="utf-8")
+        if self.data_use_skip_frames == "multi_pair":
+            return self.get_multi_pair_item(fname)
+        if self.for_tracking:
+            src_key = "t0"
+            target_key = "t1"
+            src_trgt_time_delta_s = 0.1
+            drop_time_keys = ("foo", "bar", "baz")
+        else:
+            (
+                src_key,
+                target_key,
+                delete_target_key,
+                src_trgt_time_delta_s,
+            ) = self.select_time_keys()
+            drop_time_keys = (src_key, target_key, delete_target_key)
+        sample_data_ta, sample_data_tb, meta = self.load_or_assemble_sample_datas(
+            fname, src_key, target_key, src_trgt_time_delta_s, drop_time_keys
+        )
+        if self.for_tracking:
+            return (
+                recursive_npy_dict_to_torch(sample_data_ta),
+                recursive_npy_dict_to_torch(sample_data_tb),
+                {},
+                meta,
+            )
 
         if self.verbose:
             print("Loaded sample: {0}".format(Path(fname).stem))
@@ -416,12 +443,11 @@ def get_kitti_train_dataset(
         )
 
         extra_loader_kwargs["sampler"] = weighted_random_sampler
-    train_loader = torch.utils.data.DataLoader(
+    train_loader = get_lidar_data_loader(
+        cfg,
         train_dataset,
-        pin_memory=True,
         batch_size=cfg.data.batch_size,
         num_workers=cfg.data.num_workers,
-        collate_fn=lidar_dataset_collate_fn,
         worker_init_fn=lambda id: np.random.seed(id + cfg.data.num_workers),
         **extra_loader_kwargs,
     )
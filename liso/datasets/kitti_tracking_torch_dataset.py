@@ -181,16 +181,15 @@ class KittiTrackingDataset(LidarDataset):
         self.initialize_loader_saver_if_necessary()
 
         fname = self.sample_files[index]
-        sample_content = self.loader_saver_helper.load_sample(
-            fname, np.load, allow_pickle=True
-        ).item()
-
         src_key, target_key, delete_target_key, src_trgt_time_delta_s = (
             "t0",
             "t1",
             "t2",
             0.1,
         )
+        sample_content = self.load_sample_content(
+            fname, src_key, target_key, delete_target_key
+        )
         if not self.cfg.data.use_lidar_intensity:
             self.drop_intensities_from_pcls_in_sample(sample_content)
 
@@ -18,7 +18,9 @@ from liso.datasets.nuscenes.trafo_conversion import (
     nusc_vehicle_pcl_to_kitti_lidar,
     nusc_vehicle_T_kitti_lidar,
 )
-from liso.jcp.jcp import JPCGroundRemove
+from liso.jcp.fast_jcp import JPCGroundRemove
+from liso.utils.file_utils import atomic_save_npy, atomic_write_json
+from liso.utils.timing_utils import StageTimer, set_active_stage_timer, timed_stage
 from nuscenes.utils.splits import create_splits_scenes
 from tqdm import tqdm
 
@@ -121,7 +123,7 @@ def create_and_write_sample(
 
     if force_write_file:
         # save early, so that we have at least the point cloud for inference available
-        np.save(filename + ".npy", inference_base_data_t0)
+        atomic_save_npy(filename + ".npy", inference_base_data_t0)
 
     nusc2carla_labelmap = get_label_map_from_file("nuscenes", "nuscenes2carla")
     nusc2statdynground_labelmap = get_label_map_from_file(
@@ -157,7 +159,7 @@ def create_and_write_sample(
         minimal_object_list = np.array(minimal_object_list)
         # save early, so that we have at least the point cloud for inference available
         val_base_data = {**inference_base_data_t0, "objects": minimal_object_list}
-        np.save(filename + ".npy", val_base_data)
+        atomic_save_npy(filename + ".npy", val_base_data)
     framerate__Hz = 10.0
     skip_frames_t0_t1 = 2
     skip_frames_t0_t2 = 4
@@ -468,7 +470,7 @@ def create_and_write_sample(
         data_dict["flow_t2_t1"] = lidar_flow_t2_t1[:, 0:3].astype(np.float32)
         data_dict["odom_t1_t2"] = odom_kitti_lidar_t1_t2.astype(np.float64)
         data_dict["kiss_odom_t1_t2"] = kiss_odom_kitti_lidar_t1_t2.astype(np.float64)
-    np.save(filename + ".npy", data_dict)
+    atomic_save_npy(filename + ".npy", data_dict)
 
     return "fine"
 
@@ -478,18 +480,20 @@ def load_convert_nusc_lidar_data_kitti_w_ground_labels(
     *,
     cur_sd,
 ):
-    pcl_t0_vehicle, ego_mask_t0 = nusc.get_pointcloud(cur_sd, ref_frame="ego")
+    with timed_stage("read"):
+        pcl_t0_vehicle, ego_mask_t0 = nusc.get_pointcloud(cur_sd, ref_frame="ego")
     assert cur_sd["channel"] == "LIDAR_TOP", cur_sd["channel"]
     pcl_filename = cur_sd["filename"]
     pcl_t0_3d, intensities, rows = transpose_split_nusc_pcl(pcl_t0_vehicle)
     pcl_t0_kitti_lidar = nusc_vehicle_pcl_to_kitti_lidar(pcl_t0_3d)
-    is_ground_label = JPCGroundRemove(
-        pcl=pcl_t0_kitti_lidar[:, :3],
-        range_img_width=1024,
-        range_img_height=32,
-        sensor_height=1.8,
-        delta_R=1,
-    )
+    with timed_stage("ground_segmentation"):
+        is_ground_label = JPCGroundRemove(
+            pcl=pcl_t0_kitti_lidar[:, :3],
+            range_img_width=1024,
+            range_img_height=32,
+            sensor_height=1.8,
+            delta_R=1,
+        )
     return (
         ego_mask_t0,
         pcl_t0_kitti_lidar,
@@ -506,8 +510,11 @@ def main(
     version="v1.0-mini",
     split=None,
     skip_existing_files=False,
+    progress_interval_s=60.0,
 ):
     Path(path_out).mkdir(parents=True, exist_ok=True)
+    stage_timer = StageTimer(f"create_nuscenes_{version}", progress_interval_s)
+    set_active_stage_timer(stage_timer)
     if split:
         map_scene_to_split = defaultdict(list)
         for data_category, scene_names in split.items():
@@ -557,8 +564,16 @@ def main(
         if cur_result not in count_results:
             count_results[cur_result] = 0
         count_results[cur_result] += 1
+        if cur_result == "fine":
+            stage_timer.add_frames()
         tqdm.write(str(count_results))
 
+    stage_timer.print_progress()
+    timing_summary_file = Path(path_out) / f"timing_summary_{version}.json"
+    atomic_write_json(timing_summary_file, stage_timer.get_summary())
+    print(f"Wrote per stage timings to {timing_summary_file}")
+    set_active_stage_timer(None)
+
 
 def try_load_or_compute_nuscenes_kiss_icp_lidar_poses_in_kitti_coordinates(
     nusc, poses_file_wo_ext
@@ -606,10 +621,11 @@ def try_load_or_compute_nuscenes_kiss_icp_lidar_poses_in_kitti_coordinates(
         )
         pcl_filenames.append(pcl_t0_filename)
 
-        odometry.register_frame(
-            pcl_t0_kitti_lidar[:, :3],
-            np.zeros(pcl_t0_kitti_lidar.shape[0]).astype(np.float64),
-        )
+        with timed_stage("odometry"):
+            odometry.register_frame(
+                pcl_t0_kitti_lidar[:, :3],
+                np.zeros(pcl_t0_kitti_lidar.shape[0]).astype(np.float64),
+            )
         while not sample_record_lidar["next"] == "":
             sample_record_lidar = nusc.get("sample_data", sample_record_lidar["next"])
             time_delta = sample_record_lidar["timestamp"] - lidar_timestamp_micros
@@ -630,14 +646,19 @@ def try_load_or_compute_nuscenes_kiss_icp_lidar_poses_in_kitti_coordinates(
             )
             pcl_filenames.append(pcl_t0_filename)
 
-            odometry.register_frame(
-                pcl_t0_kitti_lidar[:, :3],
-                np.zeros(pcl_t0_kitti_lidar.shape[0]).astype(np.float64),
-            )
+            with timed_stage("odometry"):
+                odometry.register_frame(
+                    pcl_t0_kitti_lidar[:, :3],
+                    np.zeros(pcl_t0_kitti_lidar.shape[0]).astype(np.float64),
+                )
 
         all_poses_w_T_lidar[scene_name] = dict(zip(pcl_filenames, odometry.poses))
 
-        np.save(poses_file_wo_ext, all_poses_w_T_lidar, allow_pickle=True)
+        atomic_save_npy(
+            poses_file_wo_ext.with_suffix(".npy"),
+            all_poses_w_T_lidar,
+            allow_pickle=True,
+        )
     return all_poses_w_T_lidar
 
 
@@ -651,6 +672,12 @@ if __name__ == "__main__":
         help="if path starts with /tmp, we will only process nuscenes-mini",
     )
     argparser.add_argument("--nusc_root", required=True, type=Path)
+    argparser.add_argument(
+        "--progress_interval_s",
+        type=float,
+        default=60.0,
+        help="seconds between throughput lines in the log",
+    )
     args = argparser.parse_args()
 
     prod = not str(args.target_dir).startswith("/tmp")
@@ -671,6 +698,7 @@ if __name__ == "__main__":
         version=version,
         split=split,
         skip_existing_files=args.skip_existing_files,
+        progress_interval_s=args.progress_interval_s,
     )
     if prod:
         split = {
@@ -683,4 +711,5 @@ if __name__ == "__main__":
             version=version,
             split=split,
             skip_existing_files=args.skip_existing_files,
+            progress_interval_s=args.progress_interval_s,
         )
@@ -0,0 +1,209 @@
+from copy import copy
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+import torch
+from liso.kabsch.shape_utils import Shape
+
+# Ragged batches (data.ragged_point_collate=True): instead of padding every
+# point cloud of a batch to the largest one, points are packed along the
+# first dim, sample b owns packed[offsets[b]:offsets[b + 1]]. Point cloud
+# dicts "pcl_ta", ... hold "pcl" [num_points, C], "pillar_coors",
+# "offsets" [batch_size + 1] and "batch_idx" [num_points] (the layout of
+# scatter ops and mmcv voxelization), other per point values hold "values"
+# and "offsets". pad_ragged_sample_data restores the padded layout of
+# lidar_dataset_collate_fn on the training device.
+RAGGED_OFFSETS_KEY = "offsets"
+RAGGED_POINT_PADDING_VALUES = {
+    "moving_mask": False,
+    "point_has_valid_flow_label": False,
+    "flow_ta_tb": float("nan"),
+    "flow_tb_ta": float("nan"),
+    "track_ids_mask": 0,
+}
+# pinned batch tensors start at multiples of this, so that they can be viewed
+# with any dtype
+PINNED_TENSOR_ALIGNMENT_BYTES = 64
+
+
+def pack_sequence(
+    sequence: Sequence[torch.Tensor],
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    lengths = torch.tensor([el.shape[0] for el in sequence], dtype=torch.long)
+    offsets = torch.zeros(len(sequence) + 1, dtype=torch.long)
+    offsets[1:] = torch.cumsum(lengths, dim=0)
+    return torch.cat(list(sequence), dim=0), offsets
+
+
+def pack_ragged_points(
+    pcls: Sequence[torch.Tensor], pillar_coors: Sequence[torch.Tensor]
+) -> Dict[str, torch.Tensor]:
+    packed_pcl, offsets = pack_sequence(pcls)
+    packed_pillar_coors, pillar_coors_offsets = pack_sequence(pillar_coors)
+    assert torch.equal(offsets, pillar_coors_offsets), (offsets, pillar_coors_offsets)
+    return {
+        "pcl": packed_pcl,
+        "pillar_coors": packed_pillar_coors,
+        RAGGED_OFFSETS_KEY: offsets,
+        "batch_idx": get_ragged_batch_idx(offsets),
+    }
+
+
+def pack_ragged_values(values: Sequence[torch.Tensor]) -> Dict[str, torch.Tensor]:
+    packed_values, offsets = pack_sequence(values)
+    return {"values": packed_values, RAGGED_OFFSETS_KEY: offsets}
+
+
+def get_ragged_batch_idx(offsets: torch.LongTensor) -> torch.LongTensor:
+    return torch.repeat_interleave(
+        torch.arange(offsets.shape[0] - 1, device=offsets.device),
+        offsets[1:] - offsets[:-1],
+    )
+
+
+def pad_ragged(
+    packed: torch.Tensor, offsets: torch.LongTensor, padding_value
+) -> torch.Tensor:
+    """Same result as pad_sequence(batch_first=True) on the unpacked sequence."""
+    batch_size = offsets.shape[0] - 1
+    lengths = offsets[1:] - offsets[:-1]
+    max_length = int(lengths.max()) if batch_size > 0 else 0
+    padded = torch.full(
+        (batch_size, max_length) + tuple(packed.shape[1:]),
+        padding_value,
+        dtype=packed.dtype,
+        device=packed.device,
+    )
+    batch_idx = get_ragged_batch_idx(offsets)
+    idx_in_sample = (
+        torch.arange(packed.shape[0], device=packed.device) - offsets[batch_idx]
+    )
+    padded[batch_idx, idx_in_sample] = packed
+    return padded
+
+
+def is_ragged(value) -> bool:
+    return isinstance(value, dict) and RAGGED_OFFSETS_KEY in value
+
+
+def pad_ragged_sample_data(sample_data, target_device: Optional[torch.device] = None):
+    """Replace all ragged entries of a collated sample data by padded ones.
+
+    The packed tensors are moved to target_device before padding, so only the
+    points themselves are transferred.
+    """
+    if not isinstance(sample_data, dict):
+        return sample_data
+    padded_sample_data = copy(sample_data)
+    for key, value in sample_data.items():
+        if is_ragged(value):
+            ragged = {
+                k: v if target_device is None else v.to(target_device)
+                for k, v in value.items()
+            }
+            offsets = ragged[RAGGED_OFFSETS_KEY]
+            if "pcl" in ragged:
+                padded_pcl = pad_ragged(ragged["pcl"], offsets, float("nan"))
+                padded_sample_data[key] = {
+                    "pcl": padded_pcl,
+                    "pcl_is_valid": torch.logical_not(torch.isnan(padded_pcl).sum(-1)),
+                    "pillar_coors": pad_ragged(ragged["pillar_coors"], offsets, -1),
+                }
+            else:
+                padding_value = RAGGED_POINT_PADDING_VALUES[
+                    "track_ids_mask" if "track_ids_mask" in key else key
+                ]
+                padded_sample_data[key] = pad_ragged(
+                    ragged["values"], offsets, padding_value
+                )
+        else:
+            padded_sample_data[key] = pad_ragged_sample_data(value, target_device)
+    return padded_sample_data
+
+
+def _map_tensors(obj, fn: Callable[[torch.Tensor], torch.Tensor]):
+    if torch.is_tensor(obj):
+        return fn(obj)
+    if isinstance(obj, Shape):
+        return Shape(**{k: _map_tensors(v, fn) for k, v in obj.__dict__.items()})
+    if isinstance(obj, dict):
+        mapped = copy(obj)
+        for key, value in obj.items():
+            mapped[key] = _map_tensors(value, fn)
+        return mapped
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_map_tensors(el, fn) for el in obj)
+    return obj
+
+
+class PinnedBufferRing:
+    """Pins collated batches into a ring of reused page locked host buffers.
+
+    A fresh pinned allocation per batch (pin_memory=True) is expensive; here
+    all tensors of a batch are copied into one buffer of the ring, which only
+    grows while batches get larger than any before. A buffer is overwritten
+    num_buffers batches later, so all host to device copies out of a batch
+    must have finished by then (always the case for blocking copies).
+    """
+
+    def __init__(self, num_buffers: int):
+        assert num_buffers > 0, num_buffers
+        self.buffers: List[Optional[torch.Tensor]] = [None] * num_buffers
+        self.next_buffer_idx = 0
+
+    def get_buffer(self, num_bytes: int) -> torch.Tensor:
+        buffer_idx = self.next_buffer_idx
+        self.next_buffer_idx = (buffer_idx + 1) % len(self.buffers)
+        buffer = self.buffers[buffer_idx]
+        if buffer is None or buffer.numel() < num_bytes:
+            # headroom, so that slightly larger batches do not reallocate
+            buffer = torch.empty(
+                int(1.25 * num_bytes), dtype=torch.uint8, pin_memory=True
+            )
+            self.buffers[buffer_idx] = buffer
+        return buffer
+
+    def pin(self, batch):
+        tensor_offsets = {}
+        num_bytes = 0
+
+        def reserve(tensor: torch.Tensor) -> torch.Tensor:
+            nonlocal num_bytes
+            tensor_offsets[id(tensor)] = num_bytes
+            tensor_num_bytes = tensor.numel() * tensor.element_size()
+            num_bytes += -(-tensor_num_bytes // PINNED_TENSOR_ALIGNMENT_BYTES) * (
+                PINNED_TENSOR_ALIGNMENT_BYTES
+            )
+            return tensor
+
+        _map_tensors(batch, reserve)
+        buffer = self.get_buffer(num_bytes)
+
+        def copy_to_buffer(tensor: torch.Tensor) -> torch.Tensor:
+            offset = tensor_offsets[id(tensor)]
+            pinned = (
+                buffer[offset : offset + tensor.numel() * tensor.element_size()]
+                .view(tensor.dtype)
+                .view(tensor.shape)
+            )
+            pinned.copy_(tensor)
+            return pinned
+
+        return _map_tensors(batch, copy_to_buffer)
+
+
+class PinnedRingLoader:
+    """Iterates a DataLoader (with pin_memory=False), pinning via a PinnedBufferRing."""
+
+    def __init__(self, loader: torch.utils.data.DataLoader, num_buffers: int):
+        self.loader = loader
+        self.pinned_buffer_ring = PinnedBufferRing(num_buffers)
+
+    def __iter__(self):
+        for batch in self.loader:
+            yield self.pinned_buffer_ring.pin(batch)
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __getattr__(self, name):
+        return getattr(self.loader, name)
@@ -0,0 +1,151 @@
+from pathlib import Path
+from typing import Iterator, List, Optional, Sequence, Union
+
+import numpy as np
+import torch
+from liso.datasets.ragged_points import PinnedRingLoader
+from liso.utils.file_utils import atomic_write_bytes
+
+# Rank shards for exports split over independent processes (--world_size,
+# --worker_id): every rank only loads its own shard instead of loading all
+# samples and skipping the ones of other ranks. Samples are ordered sequence
+# by sequence and split into world_size contiguous, equally sized shards, so
+# a rank reads a few runs of consecutive samples (which share their frames)
+# and only the sequences at the shard borders are read by two ranks.
+MISSING_OUTPUTS_FILE_NAME = "missing_outputs_rank_{rank}_of_{world_size}.txt"
+
+
+def get_rank_shard_sample_idxs(
+    num_samples: int,
+    world_size: int,
+    rank: int,
+    sequence_names: Optional[Sequence[str]] = None,
+) -> np.ndarray:
+    """Dataset indices of the shard of rank.
+
+    Without sequence_names the dataset order is assumed to be sequence by
+    sequence already. Otherwise samples are grouped by sequence (sequences in
+    the order of their first sample, samples in dataset order).
+    """
+    assert 0 <= rank < world_size, (rank, world_size)
+    if sequence_names is None:
+        sample_idxs = np.arange(num_samples)
+    else:
+        assert len(sequence_names) == num_samples, (len(sequence_names), num_samples)
+        _, first_sample_idxs, sequence_idxs = np.unique(
+            np.asarray(sequence_names), return_index=True, return_inverse=True
+        )
+        # rank of each sequence by its first sample
+        sequence_order = np.argsort(np.argsort(first_sample_idxs))
+        sample_idxs = np.argsort(sequence_order[sequence_idxs], kind="stable")
+    return np.array_split(sample_idxs, world_size)[rank]
+
+
+class RankShardSampler(torch.utils.data.Sampler):
+    """Iterates the dataset indices of one rank shard, in shard order."""
+
+    def __init__(self, sample_idxs: np.ndarray):
+        self.sample_idxs = sample_idxs
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self.sample_idxs.tolist())
+
+    def __len__(self) -> int:
+        return self.sample_idxs.shape[0]
+
+
+def get_rank_shard_loader(
+    loader: Union[torch.utils.data.DataLoader, PinnedRingLoader],
+    world_size: int,
+    rank: int,
+):
+    """Same loader as loader, but only over the samples of the shard of rank.
+
+    The shard follows the sequences of the dataset if it can name them (see
+    LidarDataset.get_sample_sequence_names).
+    """
+    if isinstance(loader, PinnedRingLoader):
+        return PinnedRingLoader(
+            get_rank_shard_loader(loader.loader, world_size, rank),
+            len(loader.pinned_buffer_ring.buffers),
+        )
+    dataset = loader.dataset
+    get_sample_sequence_names = getattr(dataset, "get_sample_sequence_names", None)
+    sample_idxs = get_rank_shard_sample_idxs(
+        len(dataset),
+        world_size,
+        rank,
+        sequence_names=(
+            None if get_sample_sequence_names is None else get_sample_sequence_names()
+        ),
+    )
+    worker_kwargs = {}
+    if loader.num_workers > 0:
+        worker_kwargs = {
+            "prefetch_factor": loader.prefetch_factor,
+            "persistent_workers": loader.persistent_workers,
+        }
+    return torch.utils.data.DataLoader(
+        dataset,
+        batch_size=loader.batch_size,
+        sampler=RankShardSampler(sample_idxs),
+        num_workers=loader.num_workers,
+        collate_fn=loader.collate_fn,
+        pin_memory=loader.pin_memory,
+        drop_last=loader.drop_last,
+        worker_init_fn=loader.worker_init_fn,
+        **worker_kwargs,
+    )
+
+
+def get_missing_output_files(
+    target_dir: Path, sample_ids: Sequence[str], suffix: str = ".npz"
+) -> List[Path]:
+    return [
+        target_file
+        for target_file in (
+            target_dir.joinpath(sample_id).with_suffix(suffix)
+            for sample_id in sample_ids
+        )
+        if not target_file.exists()
+    ]
+
+
+def check_outputs_complete(
+    target_dir: Path, sample_ids: Sequence[str], world_size: int, rank: int
+) -> List[Path]:
+    """List the outputs of sample_ids missing in target_dir, print and save them.
+
+    The list is (over)written to target_dir, empty if nothing is missing.
+    """
+    missing_files = get_missing_output_files(target_dir, sample_ids)
+    missing_outputs_file = target_dir.joinpath(
+        MISSING_OUTPUTS_FILE_NAME.format(rank=rank, world_size=world_size)
+    )
+    atomic_write_bytes(
+        missing_outputs_file,
+        "".join(f"{missing_file}\n" for missing_file in missing_files).encode("utf-8"),
+    )
+    if len(missing_files) > 0:
+        print(
+            f"WARNING: {len(missing_files)} of {len(sample_ids)} outputs missing, "
+            f"see {missing_outputs_file}:"
+        )
+        for missing_file in missing_files[:10]:
+            print(f"  {missing_file}")
+    else:
+        print(f"All {len(sample_ids)} outputs exist in {target_dir}")
+    return missing_files
+
+
+def get_loader_sample_ids(
+    loader: Union[torch.utils.data.DataLoader, PinnedRingLoader],
+) -> Optional[List[str]]:
+    """Sample ids the loader iterates, None if its dataset can't name them."""
+    if isinstance(loader, PinnedRingLoader):
+        loader = loader.loader
+    get_sample_ids = getattr(loader.dataset, "get_sample_ids", None)
+    sample_ids = None if get_sample_ids is None else get_sample_ids()
+    if sample_ids is None or not isinstance(loader.sampler, RankShardSampler):
+        return sample_ids
+    return [sample_ids[sample_idx] for sample_idx in loader.sampler.sample_idxs]
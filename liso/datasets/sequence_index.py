@@ -0,0 +1,137 @@
+import io
+from collections import defaultdict
+from pathlib import Path
+from typing import Callable, Optional, Sequence, Union
+
+import numpy as np
+from liso.utils.file_utils import atomic_write_bytes, sha256_hexdigest
+
+# Sequence index: the samples of a dataset grouped into sequences, saved next
+# to the data so that datasets neither regroup nor rechop all sample names on
+# every start. It is only reused for the same manifest hash (a hash of the
+# sample list it was built from) and the same max_sequence_len.
+SEQUENCE_INDEX_NAME = "sequence_index.npz"
+
+
+def get_manifest_hash(sample_paths: Sequence[str]) -> str:
+    return sha256_hexdigest("\n".join(sample_paths).encode("utf-8"))
+
+
+class SequenceIndex:
+    """Sequences with O(1) lookups of samples and sequence names.
+
+    sample_paths holds the samples sequence after sequence: sequence i owns
+    sample_paths[sequence_offsets[i]:sequence_offsets[i + 1]], the global
+    index of its j-th sample is sequence_offsets[i] + j.
+    """
+
+    def __init__(
+        self,
+        sequence_names: np.ndarray,
+        sequence_offsets: np.ndarray,
+        sample_paths: np.ndarray,
+        max_sequence_len: int,
+    ):
+        assert sequence_offsets.shape == (sequence_names.shape[0] + 1,), (
+            sequence_names.shape,
+            sequence_offsets.shape,
+        )
+        assert sequence_offsets[-1] == sample_paths.shape[0], sequence_offsets
+        self.sequence_names = sequence_names
+        self.sequence_offsets = sequence_offsets
+        self.sample_paths = sample_paths
+        self.max_sequence_len = max_sequence_len
+        self.sequence_idx_for_name = {
+            str(name): idx for idx, name in enumerate(sequence_names)
+        }
+
+    @classmethod
+    def from_sample_paths(
+        cls,
+        sample_paths: Sequence[str],
+        get_sequence_name: Callable[[str], str],
+        max_sequence_len: int,
+    ) -> "SequenceIndex":
+        # sequences longer than max_sequence_len are chopped into
+        # <sequence>chop0, <sequence>chop1, ... in the order of sample_paths
+        sample_paths_per_sequence = defaultdict(list)
+        for sample_path in sample_paths:
+            sequence_name = get_sequence_name(sample_path)
+            if len(sample_paths_per_sequence[sequence_name]) >= max_sequence_len:
+                subsection_idx = 0
+                chop_name = sequence_name + f"chop{subsection_idx}"
+                while len(sample_paths_per_sequence[chop_name]) >= max_sequence_len:
+                    subsection_idx += 1
+                    chop_name = sequence_name + f"chop{subsection_idx}"
+                sequence_name = chop_name
+            sample_paths_per_sequence[sequence_name].append(sample_path)
+        sequence_lens = [len(el) for el in sample_paths_per_sequence.values()]
+        sequence_offsets = np.zeros(len(sequence_lens) + 1, dtype=np.int64)
+        sequence_offsets[1:] = np.cumsum(sequence_lens)
+        return cls(
+            sequence_names=np.array(list(sample_paths_per_sequence), dtype=np.str_),
+            sequence_offsets=sequence_offsets,
+            sample_paths=np.array(
+                [
+                    sample_path
+                    for sequence_sample_paths in sample_paths_per_sequence.values()
+                    for sample_path in sorted(sequence_sample_paths)
+                ],
+                dtype=np.bytes_,
+            ),
+            max_sequence_len=max_sequence_len,
+        )
+
+    @property
+    def sequence_lens(self) -> np.ndarray:
+        return np.diff(self.sequence_offsets)
+
+    def __len__(self) -> int:
+        return self.sequence_names.shape[0]
+
+    def get_global_sample_idx(self, sequence_idx: int, idx_in_sequence: int) -> int:
+        return int(self.sequence_offsets[sequence_idx]) + idx_in_sequence
+
+    def get_sample_paths(self, sequence_idx: int) -> np.ndarray:
+        return self.sample_paths[
+            self.sequence_offsets[sequence_idx] : self.sequence_offsets[
+                sequence_idx + 1
+            ]
+        ]
+
+    def get_sequence_idx(self, sequence_name: str) -> Optional[int]:
+        return self.sequence_idx_for_name.get(sequence_name)
+
+    def save(self, path: Union[Path, str], manifest_hash: str) -> None:
+        buffer = io.BytesIO()
+        np.savez(
+            buffer,
+            sequence_names=self.sequence_names,
+            sequence_offsets=self.sequence_offsets,
+            sample_paths=self.sample_paths,
+            max_sequence_len=np.array(self.max_sequence_len),
+            manifest_hash=np.array(manifest_hash),
+        )
+        atomic_write_bytes(path, buffer.getvalue())
+
+    @classmethod
+    def load(
+        cls, path: Union[Path, str], manifest_hash: str, max_sequence_len: int
+    ) -> Optional["SequenceIndex"]:
+        """Returns None if there is no index for this manifest at path."""
+        try:
+            content = np.load(path)
+        except (ValueError, OSError):
+            return None
+        with content:
+            if (
+                str(content["manifest_hash"]) != manifest_hash
+                or int(content["max_sequence_len"]) != max_sequence_len
+            ):
+                return None
+            return cls(
+                sequence_names=content["sequence_names"],
+                sequence_offsets=content["sequence_offsets"],
+                sample_paths=content["sample_paths"],
+                max_sequence_len=max_sequence_len,
+            )
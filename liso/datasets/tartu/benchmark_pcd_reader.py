@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+import tempfile
+import time
+from argparse import ArgumentParser
+from pathlib import Path
+
+import numpy as np
+from liso.datasets.tartu.pcd_reader import (
+    XYZI_FIELDS,
+    read_pcd_xyzi,
+    read_pcd_xyzi_batch,
+)
+from pypcd4 import PointCloud
+
+
+def main():
+    argparser = ArgumentParser(
+        description="Benchmark the mmap PCD reader against pypcd4."
+    )
+    argparser.add_argument(
+        "--pcd_dir",
+        type=Path,
+        default=None,
+        help="directory with recorded scans, synthetic scans are used if not given",
+    )
+    argparser.add_argument("--num_frames", type=int, default=64)
+    argparser.add_argument("--num_points", type=int, default=130_000)
+    argparser.add_argument("--repeats", type=int, default=3)
+    args = argparser.parse_args()
+
+    rng = np.random.default_rng(0)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        tmp_dir = Path(tmp_dir)
+        if args.pcd_dir is not None:
+            pcd_files = sorted(args.pcd_dir.glob("*.pcd"))[: args.num_frames]
+        else:
+            pcd_files = []
+            for i in range(args.num_frames):
+                points = rng.uniform(-80, 80, (args.num_points, 4)).astype(np.float32)
+                pcd_files.append(tmp_dir / f"{i:06d}.pcd")
+                PointCloud.from_xyzi_points(points).save(pcd_files[-1])
+        pcd_files = [str(f) for f in pcd_files]
+
+        decoders = {
+            "pypcd4": lambda: [
+                PointCloud.from_path(f).numpy(XYZI_FIELDS) for f in pcd_files
+            ],
+            "mmap fused copy": lambda: [read_pcd_xyzi(f) for f in pcd_files],
+            "mmap batch": lambda: read_pcd_xyzi_batch(pcd_files),
+            "mmap view": lambda: [read_pcd_xyzi(f, copy=False) for f in pcd_files],
+        }
+        timings = {name: np.inf for name in decoders}
+        for _ in range(args.repeats):
+            for name, decode in decoders.items():
+                start = time.perf_counter()
+                decode()
+                timings[name] = min(timings[name], time.perf_counter() - start)
+
+    for name, duration_s in timings.items():
+        print(
+            f"{name:>16}: {1_000 * duration_s / len(pcd_files):7.3f} ms/file "
+            f"({timings['pypcd4'] / duration_s:5.1f}x)"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,27 +1,61 @@
 #!/usr/bin/env python3
+import json
+import os
 from argparse import ArgumentParser
-from functools import lru_cache
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
 from pathlib import Path
+from typing import Dict, List, Optional, Tuple
 
-from liso.jcp.jcp import JPCGroundRemove
-from pypcd4 import PointCloud
+import numpy as np
+from liso.datasets.tartu.pcd_reader import iter_pcd_xyzi, read_pcd_xyzi
+from liso.datasets.tartu.tartu_frame_store import (
+    TARTU_SAMPLE_RECORD_DTYPE,
+    create_tartu_sample_record,
+    get_frame_key,
+    get_tartu_frame_files,
+    save_tartu_frame,
+    save_tartu_sample_record,
+)
+from liso.jcp.ground_label_cache import GroundLabelCache
+from liso.utils.file_utils import (
+    atomic_save_npy,
+    atomic_write_json,
+    file_sha256_hexdigest,
+    load_json,
+    remove_stale_tmp_files,
+    sha256_hexdigest,
+)
+from liso.utils.timing_utils import (
+    StageTimer,
+    call_with_stage_timer,
+    set_active_stage_timer,
+    timed_stage,
+)
 from tqdm import tqdm
 
-import os
-import re
-import numpy as np
+TARTU_JCP_PARAMS = {
+    "range_img_width": 2083,
+    "range_img_height": 64,
+    "sensor_height": 1.73,
+    "delta_R": 1,
+}
+KISS_VOXEL_SIZE_PER_MAX_RANGE = 0.01
 
-@lru_cache(maxsize=32)
-def load_tartu_pcl_image_projection_get_ground_label(pcd_file: str):
-    tartu_pcl = PointCloud.from_path(pcd_file).numpy()[:, :4]
 
-    is_ground = JPCGroundRemove(
-        pcl=tartu_pcl[:, :3],
-        range_img_width=2083,
-        range_img_height=64,
-        sensor_height=1.73,
-        delta_R=1,
-    )
+def load_tartu_pcl(pcd_file: str) -> np.ndarray:
+    with timed_stage("read"):
+        return read_pcd_xyzi(pcd_file)
+
+
+def load_tartu_pcl_image_projection_get_ground_label(
+    pcd_file: str, ground_label_cache: GroundLabelCache
+):
+    tartu_pcl = load_tartu_pcl(pcd_file)
+
+    with timed_stage("ground_segmentation"):
+        is_ground = ground_label_cache.get_is_ground(
+            pcl=tartu_pcl[:, :3], **TARTU_JCP_PARAMS
+        )
 
     homog_pcl = np.copy(tartu_pcl)
     assert len(homog_pcl.shape) == 2, homog_pcl.shape
@@ -31,10 +65,248 @@ def load_tartu_pcl_image_projection_get_ground_label(pcd_file: str):
     return tartu_pcl, homog_pcl, is_ground
 
 
-def main():
+def get_num_workers() -> int:
+    # the slurm allocation, not the node size, is what we may use
+    slurm_cpus = os.environ.get("SLURM_CPUS_PER_TASK")
+    if slurm_cpus is not None:
+        return int(slurm_cpus)
+    return len(os.sched_getaffinity(0))
+
+
+def get_sample_name(date: str, pcd_file: str) -> str:
+    return "{0}_0_{1}".format(date, Path(pcd_file).stem)
+
+
+def get_tartu_frame_key(date: str, pcd_file: str) -> str:
+    return get_frame_key(date, Path(pcd_file).stem)
+
+
+def get_params_hash() -> str:
+    # everything that changes the content of frames, poses or sample records
+    params = {
+        "jcp": TARTU_JCP_PARAMS,
+        "kiss_voxel_size_per_max_range": KISS_VOXEL_SIZE_PER_MAX_RANGE,
+        "sample_record_dtype": str(TARTU_SAMPLE_RECORD_DTYPE.descr),
+    }
+    return sha256_hexdigest(json.dumps(params, sort_keys=True).encode("utf-8"))
+
+
+def get_frames_hash(pcd_files: List[str]) -> str:
+    # frame timestamps of a date, as encoded in the pcd file names
+    stems = "\n".join(Path(pcd_file).stem for pcd_file in pcd_files)
+    return sha256_hexdigest(stems.encode("utf-8"))
+
+
+def load_date_manifest(
+    manifest_file: Path, date: str, frames_hash: str, params_hash: str
+) -> Dict:
+    manifest = load_json(manifest_file)
+    if manifest is None or manifest.get("params_hash") != params_hash:
+        # nothing written with other (or unknown) parameters is reused
+        return {
+            "date": date,
+            "complete": False,
+            "frames": {},
+            "samples": {},
+            "frames_hash": frames_hash,
+            "params_hash": params_hash,
+        }
+    if manifest["frames_hash"] != frames_hash:
+        # frames were added or removed: written frames stay valid, but the
+        # trajectory and with it every sample record of the date changes
+        manifest["frames_hash"] = frames_hash
+        manifest["samples"] = {}
+        manifest.pop("poses", None)
+    manifest["complete"] = False
+    return manifest
+
+
+def write_dataset_index(
+    index_file: Path, dataset_manifest: Dict, manifest_dir: Path
+) -> int:
+    # the index lists complete dates only, TartuRawDataset never sees
+    # samples of a date that is still being processed
+    sample_names = []
+    for date, date_state in dataset_manifest["dates"].items():
+        if date_state["complete"]:
+            sample_names.extend(load_json(manifest_dir / f"{date}.json")["samples"])
+    atomic_write_json(
+        index_file,
+        {
+            "params_hash": dataset_manifest["params_hash"],
+            "samples": sorted(sample_names),
+        },
+    )
+    return len(sample_names)
+
+
+def compute_kiss_icp_poses(pcd_files: List[str]) -> np.ndarray:
     from kiss_icp.config import KISSConfig
     from kiss_icp.kiss_icp import KissICP
 
+    kiss_config = KISSConfig()
+    kiss_config.mapping.voxel_size = (
+        KISS_VOXEL_SIZE_PER_MAX_RANGE * kiss_config.data.max_range
+    )
+    odometry = KissICP(config=kiss_config)
+    pcls = iter_pcd_xyzi(pcd_files)
+    for _ in range(len(pcd_files)):
+        with timed_stage("read"):
+            pcl = next(pcls)
+        with timed_stage("odometry"):
+            # NOTE: tartu scans carry no per point timestamps
+            timestamps = np.zeros_like(pcl[:, :3]).astype(np.float64)
+            odometry.register_frame(
+                np.copy(pcl[:, :3].astype(np.float64)),
+                timestamps=timestamps,
+            )
+    return np.asarray(odometry.poses)
+
+
+def compute_save_kiss_icp_poses(
+    pcd_files: List[str], pose_table_file: Path
+) -> Tuple[np.ndarray, str]:
+    # streaming odometry pass: only reads points, writes one compact
+    # [num_frames, 4, 4] pose table per date
+    w_Ts_si = compute_kiss_icp_poses(pcd_files)
+    return w_Ts_si, atomic_save_npy(pose_table_file, w_Ts_si, allow_pickle=False)
+
+
+def load_pose_table_if_valid(
+    pose_table_file: Path, checksum: str, num_frames: int
+) -> Optional[np.ndarray]:
+    if checksum is None or not pose_table_file.exists():
+        return None
+    if file_sha256_hexdigest(pose_table_file) != checksum:
+        print(f"Checksum mismatch, redoing {pose_table_file}")
+        return None
+    w_Ts_si = np.load(pose_table_file, allow_pickle=False)
+    if w_Ts_si.shape[0] != num_frames:
+        return None
+    return w_Ts_si
+
+
+def get_kiss_odometry(w_Ts_si: np.ndarray, idx: int) -> Dict[str, np.ndarray]:
+    tartu_odom_t0_t1 = np.linalg.inv(w_Ts_si[idx]) @ w_Ts_si[idx + 1]
+    tartu_odom_t0_t2 = np.linalg.inv(w_Ts_si[idx]) @ w_Ts_si[idx + 2]
+    tartu_odom_t1_t2 = np.linalg.inv(w_Ts_si[idx + 1]) @ w_Ts_si[idx + 2]
+    return {
+        "kiss_odom_t0_t1": tartu_odom_t0_t1,
+        "kiss_odom_t1_t0": np.linalg.inv(tartu_odom_t0_t1),
+        "kiss_odom_t0_t2": tartu_odom_t0_t2,
+        "kiss_odom_t2_t0": np.linalg.inv(tartu_odom_t0_t2),
+        "kiss_odom_t1_t2": tartu_odom_t1_t2,
+        "kiss_odom_t2_t1": np.linalg.inv(tartu_odom_t1_t2),
+    }
+
+
+def write_tartu_frames(
+    date: str,
+    pcd_files: List[str],
+    frame_idxs: List[int],
+    frames_dir: Path,
+    ground_label_cache: GroundLabelCache,
+) -> Dict[str, Dict[str, str]]:
+    checksums = {}
+    for idx in frame_idxs:
+        pcl, _, is_ground = load_tartu_pcl_image_projection_get_ground_label(
+            pcd_files[idx], ground_label_cache
+        )
+        frame_key = get_tartu_frame_key(date, pcd_files[idx])
+        checksums[frame_key] = save_tartu_frame(frames_dir, frame_key, pcl, is_ground)
+    return checksums
+
+
+def write_tartu_sample_records(
+    date: str,
+    pcd_files: List[str],
+    seq_idxs: List[int],
+    w_Ts_si: np.ndarray,
+    target_dir: Path,
+) -> Dict[str, str]:
+    checksums = {}
+    for idx in seq_idxs:
+        sample_name = get_sample_name(date, pcd_files[idx])
+        record = create_tartu_sample_record(
+            tuple(
+                get_tartu_frame_key(date, pcd_file)
+                for pcd_file in pcd_files[idx : idx + 3]
+            ),
+            get_kiss_odometry(w_Ts_si, idx),
+        )
+        checksums[sample_name] = save_tartu_sample_record(
+            target_dir / f"{sample_name}.npy", record
+        )
+    return checksums
+
+
+def finish_tartu_date(
+    date: str,
+    pcd_files: List[str],
+    missing_seq_idxs: List[int],
+    w_Ts_si: Optional[np.ndarray],
+    manifest: Dict,
+    target_dir: Path,
+):
+    # sample emission pass: every record is written exactly once, poses included
+    if len(missing_seq_idxs) > 0:
+        manifest["samples"].update(
+            write_tartu_sample_records(
+                date, pcd_files, missing_seq_idxs, w_Ts_si, target_dir
+            )
+        )
+    manifest["complete"] = True
+
+
+def is_done(files_with_checksums: Dict[Path, str], verify_checksums: bool) -> bool:
+    for path, checksum in files_with_checksums.items():
+        if checksum is None or not path.exists():
+            return False
+        if verify_checksums and file_sha256_hexdigest(path) != checksum:
+            print(f"Checksum mismatch, redoing {path}")
+            return False
+    return True
+
+
+def get_missing_frame_idxs(
+    date: str,
+    pcd_files: List[str],
+    manifest: Dict,
+    frames_dir: Path,
+    verify_checksums: bool,
+) -> List[int]:
+    missing_frame_idxs = []
+    for idx, pcd_file in enumerate(pcd_files):
+        frame_key = get_tartu_frame_key(date, pcd_file)
+        checksums = manifest["frames"].get(frame_key, {})
+        pcl_file, is_ground_file = get_tartu_frame_files(frames_dir, frame_key)
+        files_with_checksums = {
+            pcl_file: checksums.get("pcl"),
+            is_ground_file: checksums.get("is_ground"),
+        }
+        if not is_done(files_with_checksums, verify_checksums):
+            missing_frame_idxs.append(idx)
+    return missing_frame_idxs
+
+
+def get_missing_seq_idxs(
+    date: str,
+    pcd_files: List[str],
+    manifest: Dict,
+    target_dir: Path,
+    verify_checksums: bool,
+) -> List[int]:
+    missing_seq_idxs = []
+    for idx in range(0, len(pcd_files) - 2, 1):
+        sample_name = get_sample_name(date, pcd_files[idx])
+        sample_file = target_dir / f"{sample_name}.npy"
+        files_with_checksums = {sample_file: manifest["samples"].get(sample_name)}
+        if not is_done(files_with_checksums, verify_checksums):
+            missing_seq_idxs.append(idx)
+    return missing_seq_idxs
+
+
+def main():
     argparser = ArgumentParser(description="Convert tartu pcl data to training format.")
     argparser.add_argument(
         "--target_dir",
@@ -47,127 +319,251 @@ def main():
         required=True,
         type=Path,
     )
+    argparser.add_argument(
+        "--num_workers",
+        default=get_num_workers(),
+        type=int,
+    )
+    argparser.add_argument(
+        "--chunk_size",
+        default=64,
+        type=int,
+        help="number of frames per task submitted to the process pool",
+    )
+    argparser.add_argument(
+        "--verify_checksums",
+        action="store_true",
+        help="rehash already written files instead of trusting the manifest",
+    )
+    argparser.add_argument(
+        "--ground_label_cache_dir",
+        default=None,
+        type=Path,
+        help="share JCP ground labels with other runs and loaders through this dir",
+    )
+    argparser.add_argument(
+        "--timing_summary_file",
+        default=None,
+        type=Path,
+        help="per stage timing report, defaults to <target_dir>/timing_summary.json",
+    )
+    argparser.add_argument(
+        "--progress_interval_s",
+        default=60.0,
+        type=float,
+        help="seconds between throughput lines in the log",
+    )
 
     args = argparser.parse_args()
 
     target_dir = args.target_dir / "tartu_raw"
     target_dir.mkdir(parents=True, exist_ok=True)
+    frames_dir = target_dir / "frames"
+    pose_table_dir = target_dir / "poses"
+    pose_table_dir.mkdir(parents=True, exist_ok=True)
+    manifest_dir = target_dir / "manifests"
+    manifest_dir.mkdir(parents=True, exist_ok=True)
+    for stale_dir in (
+        target_dir,
+        manifest_dir,
+        pose_table_dir,
+        *frames_dir.glob("*"),
+    ):
+        num_stale = remove_stale_tmp_files(stale_dir)
+        if num_stale > 0:
+            print(f"Removed {num_stale} partially written files from {stale_dir}")
+    ground_label_cache = GroundLabelCache(args.ground_label_cache_dir)
+    stage_timer = StageTimer("create_tartu", args.progress_interval_s)
+    set_active_stage_timer(stage_timer)
 
     dates = sorted(os.listdir(args.tartu_raw_root))
 
-    skipped_sequences = 0
-    success = 0
-    for date in tqdm(dates):
+    # dataset manifest: per date the frame timestamps it was processed with,
+    # complete dates whose timestamps did not change are not looked at again
+    params_hash = get_params_hash()
+    dataset_manifest_file = target_dir / "dataset_manifest.json"
+    dataset_manifest = load_json(
+        dataset_manifest_file, default={"params_hash": params_hash, "dates": {}}
+    )
+    if dataset_manifest["params_hash"] != params_hash:
+        print("Preprocessing parameters changed, reprocessing all dates")
+        dataset_manifest = {"params_hash": params_hash, "dates": {}}
 
+    skipped_sequences = 0
+    manifests = {}
+    pcd_files_per_date = {}
+    frames_hash_per_date = {}
+    missing_frame_idxs_per_date = {}
+    missing_seq_idxs_per_date = {}
+    for date in tqdm(dates, desc="checking manifests"):
         try:
             stem = f"{args.tartu_raw_root}/{date}/lidar_center"
-            tartu_pcd_files = [f"{stem}/{pcd}" for pcd in os.listdir(stem)]
-
-            target_files = list(filter(lambda f: re.match(f".*{date}.*", f), os.listdir(target_dir)))
-            if len(target_files) == len(tartu_pcd_files):
-                skipped_sequences += 1
-                continue
+            tartu_pcd_files = [f"{stem}/{pcd}" for pcd in sorted(os.listdir(stem))]
         except (FileNotFoundError, NotADirectoryError):
             skipped_sequences += 1
             continue
+        if len(tartu_pcd_files) < 3:
+            skipped_sequences += 1
+            continue
 
-        kiss_config = KISSConfig()
-        kiss_config.mapping.voxel_size = 0.01 * kiss_config.data.max_range
-        odometry = KissICP(config=kiss_config)
-
-        seq_idxs = list(range(0, len(tartu_pcd_files) - 2, 1))
-        fnames = []
-
-        for idx in tqdm(seq_idxs, leave=False):
-            idx_str_t0 = Path(tartu_pcd_files[idx]).stem
-
-            (
-                pcl_t0,
-                _,
-                is_ground_t0,
-            ) = load_tartu_pcl_image_projection_get_ground_label(
-                tartu_pcd_files[idx]
-            )
-
-            # NOTE: timestamps same as above
-            timestamps = np.zeros_like(pcl_t0[:, :3]).astype(np.float64)
-            odometry.register_frame(
-                np.copy(pcl_t0[:, :3].astype(np.float64)),
-                timestamps=timestamps,
-            )
-            (
-                pcl_t1,
-                _,
-                is_ground_t1,
-            ) = load_tartu_pcl_image_projection_get_ground_label(
-                tartu_pcd_files[idx + 1]
-            )
-            (
-                pcl_t2,
-                _,
-                is_ground_t2,
-            ) = load_tartu_pcl_image_projection_get_ground_label(
-                tartu_pcd_files[idx + 2]
-            )
+        frames_hash = get_frames_hash(tartu_pcd_files)
+        frames_hash_per_date[date] = frames_hash
+        if not args.verify_checksums and dataset_manifest["dates"].get(date) == {
+            "frames_hash": frames_hash,
+            "complete": True,
+        }:
+            skipped_sequences += 1
+            continue
 
-            sample_name = "{0}_0_{1}".format(date, idx_str_t0)
-            data_dict = {
-                "pcl_t0": pcl_t0.astype(np.float32),
-                "pcl_t1": pcl_t1.astype(np.float32),
-                "pcl_t2": pcl_t2.astype(np.float32),
-                "is_ground_t0": is_ground_t0,
-                "is_ground_t1": is_ground_t1,
-                "is_ground_t2": is_ground_t2,
-                "name": sample_name,
+        manifest = load_date_manifest(
+            manifest_dir / f"{date}.json", date, frames_hash, params_hash
+        )
+        missing_frame_idxs = get_missing_frame_idxs(
+            date, tartu_pcd_files, manifest, frames_dir, args.verify_checksums
+        )
+        missing_seq_idxs = get_missing_seq_idxs(
+            date, tartu_pcd_files, manifest, target_dir, args.verify_checksums
+        )
+        if len(missing_frame_idxs) == 0 and len(missing_seq_idxs) == 0:
+            skipped_sequences += 1
+            dataset_manifest["dates"][date] = {
+                "frames_hash": frames_hash,
+                "complete": True,
             }
+            continue
 
-            target_fname = target_dir / Path(sample_name)
-            fnames.append(target_fname)
-            np.save(
-                target_fname,
-                data_dict,
-            )
-
+        dataset_manifest["dates"][date] = {
+            "frames_hash": frames_hash,
+            "complete": False,
+        }
+        manifests[date] = manifest
+        pcd_files_per_date[date] = tartu_pcd_files
+        missing_frame_idxs_per_date[date] = missing_frame_idxs
+        missing_seq_idxs_per_date[date] = missing_seq_idxs
+    for date in sorted(set(dataset_manifest["dates"]) - set(frames_hash_per_date)):
+        print(f"Date {date} is no longer in the raw data, dropping it from the index")
+        del dataset_manifest["dates"][date]
+    atomic_write_json(dataset_manifest_file, dataset_manifest)
+
+    def mark_date_complete(date: str):
+        dataset_manifest["dates"][date]["complete"] = True
+        atomic_write_json(dataset_manifest_file, dataset_manifest)
 
-            if idx == seq_idxs[-1]:
-                # NOTE: timestamps same as above
-                timestamps = np.zeros_like(pcl_t1[:, :3]).astype(np.float64)
-                odometry.register_frame(
-                    np.copy(pcl_t1[:, :3].astype(np.float64)),
-                    timestamps=timestamps,
+    success = 0
+    failed_dates = []
+    num_frames_todo = sum(len(idxs) for idxs in missing_frame_idxs_per_date.values())
+    print(
+        f"Processing {num_frames_todo} frames from {len(manifests)} dates "
+        f"using {args.num_workers} workers"
+    )
+    with ProcessPoolExecutor(max_workers=args.num_workers) as pool, tqdm(
+        total=num_frames_todo
+    ) as progress:
+        # odometry is sequential within a date and runs in parallel to the
+        # frame chunks, sample records need both and are written last
+        pending = {}
+        num_pending_tasks = dict.fromkeys(manifests, 0)
+        poses_per_date = {}
+        for date in manifests:
+            if len(missing_seq_idxs_per_date[date]) > 0:
+                pose_table_file = pose_table_dir / f"{date}.npy"
+                w_Ts_si = load_pose_table_if_valid(
+                    pose_table_file,
+                    manifests[date].get("poses"),
+                    len(pcd_files_per_date[date]),
                 )
-
-                # NOTE: timestamps same as above
-                timestamps = np.zeros_like(pcl_t2[:, :3]).astype(np.float64)
-                odometry.register_frame(
-                    np.copy(pcl_t2[:, :3].astype(np.float64)),
-                    timestamps=timestamps,
+                if w_Ts_si is not None:
+                    poses_per_date[date] = w_Ts_si
+                else:
+                    pending[
+                        pool.submit(
+                            call_with_stage_timer,
+                            compute_save_kiss_icp_poses,
+                            pcd_files_per_date[date],
+                            pose_table_file,
+                        )
+                    ] = ("odometry", date)
+                    num_pending_tasks[date] += 1
+            missing_frame_idxs = missing_frame_idxs_per_date[date]
+            for chunk_start in range(0, len(missing_frame_idxs), args.chunk_size):
+                chunk = missing_frame_idxs[chunk_start : chunk_start + args.chunk_size]
+                pending[
+                    pool.submit(
+                        call_with_stage_timer,
+                        write_tartu_frames,
+                        date,
+                        pcd_files_per_date[date],
+                        chunk,
+                        frames_dir,
+                        ground_label_cache,
+                    )
+                ] = ("frames", date)
+                num_pending_tasks[date] += 1
+
+            if num_pending_tasks[date] == 0:
+                # only sample records are missing and the pose table is valid
+                finish_tartu_date(
+                    date,
+                    pcd_files_per_date[date],
+                    missing_seq_idxs_per_date[date],
+                    poses_per_date.pop(date),
+                    manifests[date],
+                    target_dir,
                 )
-
-            success += 1
-
-        w_Ts_si = odometry.poses
-        for file_idx, fname in enumerate(fnames):
-            content = np.load(fname.with_suffix(".npy"), allow_pickle=True).item()
-            tartu_odom_t0_t1 = (
-                np.linalg.inv(w_Ts_si[file_idx]) @ w_Ts_si[file_idx + 1]
-            )
-            tartu_odom_t0_t2 = (
-                np.linalg.inv(w_Ts_si[file_idx]) @ w_Ts_si[file_idx + 2]
-            )
-            tartu_odom_t1_t2 = (
-                np.linalg.inv(w_Ts_si[file_idx + 1]) @ w_Ts_si[file_idx + 2]
-            )
-            content["kiss_odom_t0_t1"] = tartu_odom_t0_t1
-            content["kiss_odom_t1_t0"] = np.linalg.inv(tartu_odom_t0_t1)
-            content["kiss_odom_t0_t2"] = tartu_odom_t0_t2
-            content["kiss_odom_t2_t0"] = np.linalg.inv(tartu_odom_t0_t2)
-            content["kiss_odom_t1_t2"] = tartu_odom_t1_t2
-            content["kiss_odom_t2_t1"] = np.linalg.inv(tartu_odom_t1_t2)
-
-            np.save(fname, content)
-
-    print("Skipped: {0} Success: {1}".format(skipped_sequences, success))
+                atomic_write_json(manifest_dir / f"{date}.json", manifests[date])
+                mark_date_complete(date)
+
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                task, date = pending.pop(future)
+                if date in failed_dates:
+                    continue
+                try:
+                    result, durations_s = future.result()
+                except Exception as e:
+                    print(f"Failed to process date {date}, rerun to resume: {e}")
+                    failed_dates.append(date)
+                    continue
+
+                manifest = manifests[date]
+                num_pending_tasks[date] -= 1
+                stage_timer.merge(durations_s)
+                if task == "odometry":
+                    poses_per_date[date], manifest["poses"] = result
+                else:
+                    manifest["frames"].update(result)
+                    success += len(result)
+                    progress.update(len(result))
+                    stage_timer.add_frames(len(result))
+
+                if num_pending_tasks[date] == 0:
+                    finish_tartu_date(
+                        date,
+                        pcd_files_per_date[date],
+                        missing_seq_idxs_per_date[date],
+                        poses_per_date.pop(date, None),
+                        manifest,
+                        target_dir,
+                    )
+                atomic_write_json(manifest_dir / f"{date}.json", manifest)
+                if manifest["complete"]:
+                    mark_date_complete(date)
+
+    num_indexed = write_dataset_index(
+        target_dir / "index.json", dataset_manifest, manifest_dir
+    )
+    stage_timer.print_progress()
+    timing_summary_file = args.timing_summary_file or (
+        target_dir / "timing_summary.json"
+    )
+    atomic_write_json(timing_summary_file, stage_timer.get_summary())
+    print(f"Wrote per stage timings to {timing_summary_file}")
+    print(
+        "Skipped: {0} Success: {1} Failed dates: {2} Indexed samples: {3}".format(
+            skipped_sequences, success, failed_dates, num_indexed
+        )
+    )
 
 
 if __name__ == "__main__":
@@ -0,0 +1,233 @@
+import mmap
+import os
+from typing import Dict, Iterator, List, NamedTuple, Optional, Sequence, Tuple
+
+import numpy as np
+
+# Reader for binary PCD (v0.7) files that decodes straight from a memory map.
+# ascii and binary_compressed files are delegated to pypcd4.
+
+XYZI_FIELDS = ("x", "y", "z", "intensity")
+
+PCD_TYPE_TO_NUMPY = {
+    ("F", 4): "<f4",
+    ("F", 8): "<f8",
+    ("I", 1): "<i1",
+    ("I", 2): "<i2",
+    ("I", 4): "<i4",
+    ("I", 8): "<i8",
+    ("U", 1): "<u1",
+    ("U", 2): "<u2",
+    ("U", 4): "<u4",
+    ("U", 8): "<u8",
+}
+MAX_PCD_HEADER_BYTES = 1 << 16
+
+
+class PcdHeader(NamedTuple):
+    fields: Tuple[str, ...]
+    sizes: Tuple[int, ...]
+    types: Tuple[str, ...]
+    counts: Tuple[int, ...]
+    num_points: int
+    data: str
+    data_offset: int
+
+
+def parse_pcd_header(buffer: bytes) -> PcdHeader:
+    entries: Dict[str, List[str]] = {}
+    offset = 0
+    while "DATA" not in entries:
+        line_end = buffer.find(b"\n", offset)
+        if line_end == -1:
+            raise ValueError("PCD header is not terminated by a DATA line")
+        line = buffer[offset:line_end].decode("ascii").strip()
+        offset = line_end + 1
+        if len(line) == 0 or line.startswith("#"):
+            continue
+        key, *values = line.split()
+        entries[key] = values
+
+    fields = tuple(entries["FIELDS"])
+    counts = tuple(int(c) for c in entries.get("COUNT", ["1"] * len(fields)))
+    if "POINTS" in entries:
+        num_points = int(entries["POINTS"][0])
+    else:
+        num_points = int(entries["WIDTH"][0]) * int(entries["HEIGHT"][0])
+    return PcdHeader(
+        fields=fields,
+        sizes=tuple(int(s) for s in entries["SIZE"]),
+        types=tuple(entries["TYPE"]),
+        counts=counts,
+        num_points=num_points,
+        data=entries["DATA"][0].lower(),
+        data_offset=offset,
+    )
+
+
+def get_pcd_record_dtype(header: PcdHeader) -> np.dtype:
+    names, formats, offsets = [], [], []
+    itemsize = 0
+    for field, size, pcd_type, count in zip(
+        header.fields, header.sizes, header.types, header.counts
+    ):
+        field_dtype = np.dtype(PCD_TYPE_TO_NUMPY[(pcd_type, size)])
+        # padding fields are all named "_" and only contribute to the stride
+        if field != "_":
+            names.append(field)
+            formats.append(field_dtype if count == 1 else (field_dtype, (count,)))
+            offsets.append(itemsize)
+        itemsize += size * count
+    return np.dtype(
+        {"names": names, "formats": formats, "offsets": offsets, "itemsize": itemsize}
+    )
+
+
+def _mmap_pcd(pcd_file: str) -> Tuple[PcdHeader, mmap.mmap]:
+    with open(pcd_file, "rb") as f:
+        file_mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    header = parse_pcd_header(file_mmap[:MAX_PCD_HEADER_BYTES])
+    return header, file_mmap
+
+
+def _get_records(header: PcdHeader, file_mmap: mmap.mmap) -> np.ndarray:
+    # the array keeps the mmap alive, it is unmapped once all views are gone
+    return np.frombuffer(
+        file_mmap,
+        dtype=get_pcd_record_dtype(header),
+        count=header.num_points,
+        offset=header.data_offset,
+    )
+
+
+def _load_xyzi_with_pypcd4(pcd_file: str, fields: Sequence[str]) -> np.ndarray:
+    from pypcd4 import PointCloud
+
+    # C order like the copies of the mmap path, pypcd4 returns fortran order
+    return np.ascontiguousarray(
+        PointCloud.from_path(pcd_file).numpy(fields), dtype=np.float32
+    )
+
+
+def _check_fields(pcd_file: str, header: PcdHeader, fields: Sequence[str]) -> None:
+    # fields are selected by name, a missing one must not shift the columns
+    for field in fields:
+        if field == "_" or field not in header.fields:
+            raise ValueError(
+                f"{pcd_file}: no field {field!r} in PCD fields {header.fields}"
+            )
+        count = header.counts[header.fields.index(field)]
+        if count != 1:
+            raise ValueError(f"{pcd_file}: field {field!r} has COUNT {count}, not 1")
+
+
+def read_pcd_records(pcd_file: str) -> np.ndarray:
+    """Zero-copy structured view of all points of a binary PCD file."""
+    header, file_mmap = _mmap_pcd(pcd_file)
+    if header.data != "binary":
+        raise ValueError(f"{pcd_file}: cannot memory map DATA {header.data}")
+    return _get_records(header, file_mmap)
+
+
+def _get_field_view(
+    header: PcdHeader, file_mmap: mmap.mmap, record_dtype: np.dtype, field: str
+) -> np.ndarray:
+    field_dtype, field_offset = record_dtype.fields[field][:2]
+    return np.ndarray(
+        shape=(header.num_points,),
+        dtype=field_dtype,
+        buffer=file_mmap,
+        offset=header.data_offset + field_offset,
+        strides=(record_dtype.itemsize,),
+    )
+
+
+def _get_fused_view(
+    header: PcdHeader,
+    file_mmap: mmap.mmap,
+    record_dtype: np.dtype,
+    fields: Sequence[str],
+) -> Optional[np.ndarray]:
+    first_offset = record_dtype.fields[fields[0]][1]
+    for i, field in enumerate(fields):
+        field_dtype, field_offset = record_dtype.fields[field][:2]
+        if field_dtype != np.float32 or field_offset != first_offset + 4 * i:
+            return None
+    return np.ndarray(
+        shape=(header.num_points, len(fields)),
+        dtype=np.float32,
+        buffer=file_mmap,
+        offset=header.data_offset + first_offset,
+        strides=(record_dtype.itemsize, 4),
+    )
+
+
+def read_pcd_xyzi(
+    pcd_file: str, copy=True, fields: Sequence[str] = XYZI_FIELDS
+) -> np.ndarray:
+    """Decode x, y, z, intensity of a PCD file into a float32 [N, 4] array.
+
+    With copy=True the four columns are gathered into one new array, nothing
+    else of the point record is touched. With copy=False a read only, strided
+    view into the file is returned, which requires the fields to be adjacent
+    float32 values in the record. Fields are selected by name, a field that is
+    missing from the file raises a ValueError.
+    """
+    header, file_mmap = _mmap_pcd(pcd_file)
+    try:
+        _check_fields(pcd_file, header, fields)
+    except ValueError:
+        file_mmap.close()
+        raise
+    if header.data != "binary":
+        file_mmap.close()
+        if not copy:
+            raise ValueError(f"{pcd_file}: cannot memory map DATA {header.data}")
+        return _load_xyzi_with_pypcd4(pcd_file, fields)
+
+    record_dtype = get_pcd_record_dtype(header)
+    fused_view = _get_fused_view(header, file_mmap, record_dtype, fields)
+    if not copy:
+        if fused_view is None:
+            raise ValueError(
+                f"{pcd_file}: fields {fields} are not adjacent float32 values"
+            )
+        return fused_view
+
+    if fused_view is not None:
+        points = np.array(fused_view)
+    else:
+        points = np.empty((header.num_points, len(fields)), dtype=np.float32)
+        for i, field in enumerate(fields):
+            points[:, i] = _get_field_view(header, file_mmap, record_dtype, field)
+    del fused_view
+    file_mmap.close()
+    return points
+
+
+def _advise_willneed(pcd_file: str) -> None:
+    if not hasattr(os, "posix_fadvise"):
+        return
+    fd = os.open(pcd_file, os.O_RDONLY)
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+    finally:
+        os.close(fd)
+
+
+def iter_pcd_xyzi(
+    pcd_files: Sequence[str], readahead=4, copy=True, fields=XYZI_FIELDS
+) -> Iterator[np.ndarray]:
+    """read_pcd_xyzi for many files, asking the kernel to prefetch the next ones."""
+    for pcd_file in pcd_files[:readahead]:
+        _advise_willneed(pcd_file)
+    for i, pcd_file in enumerate(pcd_files):
+        if i + readahead < len(pcd_files):
+            _advise_willneed(pcd_files[i + readahead])
+        yield read_pcd_xyzi(pcd_file, copy=copy, fields=fields)
+
+
+def read_pcd_xyzi_batch(
+    pcd_files: Sequence[str], readahead=4, copy=True, fields=XYZI_FIELDS
+) -> List[np.ndarray]:
+    return list(iter_pcd_xyzi(pcd_files, readahead=readahead, copy=copy, fields=fields))
@@ -0,0 +1,107 @@
+from pathlib import Path
+from typing import Callable, Dict, Optional, Tuple, Union
+
+import numpy as np
+from liso.datasets.columnar_samples import load_sample_content
+from liso.utils.cloud_utils import CloudLoaderSaver
+from liso.utils.file_utils import atomic_save_npy
+
+# Every lidar frame is stored exactly once below tartu_raw/frames/<date>/
+# as two plain (non pickled) arrays that can be memory mapped:
+#   <frame_stem>.pcl.npy         float32 [N, 4] x, y, z, intensity
+#   <frame_stem>.is_ground.npy   bool    [N]
+# A sample tartu_raw/<sample_name>.npy is a single structured record
+# referencing its three frames plus the KISS-ICP odometry between them.
+
+TIME_KEYS = ("t0", "t1", "t2")
+KISS_ODOM_KEYS = (
+    "kiss_odom_t0_t1",
+    "kiss_odom_t1_t0",
+    "kiss_odom_t0_t2",
+    "kiss_odom_t2_t0",
+    "kiss_odom_t1_t2",
+    "kiss_odom_t2_t1",
+)
+TARTU_SAMPLE_RECORD_DTYPE = np.dtype(
+    [(f"frame_{tk}", "U128") for tk in TIME_KEYS]
+    + [(odom_key, np.float64, (4, 4)) for odom_key in KISS_ODOM_KEYS]
+)
+
+
+def get_frame_key(date: str, frame_stem: str) -> str:
+    return f"{date}/{frame_stem}"
+
+
+def get_tartu_frame_files(frames_dir: Path, frame_key: str) -> Tuple[Path, Path]:
+    return (
+        frames_dir / f"{frame_key}.pcl.npy",
+        frames_dir / f"{frame_key}.is_ground.npy",
+    )
+
+
+def save_tartu_frame(
+    frames_dir: Path, frame_key: str, pcl: np.ndarray, is_ground: np.ndarray
+) -> Dict[str, str]:
+    assert pcl.shape[0] == is_ground.shape[0], (pcl.shape, is_ground.shape)
+    pcl_file, is_ground_file = get_tartu_frame_files(frames_dir, frame_key)
+    pcl_file.parent.mkdir(parents=True, exist_ok=True)
+    return {
+        "pcl": atomic_save_npy(
+            pcl_file, np.ascontiguousarray(pcl, dtype=np.float32), allow_pickle=False
+        ),
+        "is_ground": atomic_save_npy(
+            is_ground_file, is_ground.astype(bool), allow_pickle=False
+        ),
+    }
+
+
+def create_tartu_sample_record(
+    frame_keys: Tuple[str, str, str], kiss_odometry: Dict[str, np.ndarray]
+) -> np.ndarray:
+    record = np.zeros((), dtype=TARTU_SAMPLE_RECORD_DTYPE)
+    for time_key, frame_key in zip(TIME_KEYS, frame_keys):
+        record[f"frame_{time_key}"] = frame_key
+    for odom_key in KISS_ODOM_KEYS:
+        record[odom_key] = kiss_odometry[odom_key]
+    return record
+
+
+def save_tartu_sample_record(sample_file: Path, record: np.ndarray) -> str:
+    return atomic_save_npy(sample_file, record, allow_pickle=False)
+
+
+def load_tartu_sample(
+    sample_file: Union[Path, str],
+    loader_saver_helper: CloudLoaderSaver,
+    keep_key: Optional[Callable[[str], bool]] = None,
+) -> Dict[str, np.ndarray]:
+    record = load_sample_content(
+        sample_file, loader_saver_helper, keep_key=keep_key, mmap_mode="r"
+    )
+    if isinstance(record, dict):
+        # legacy pickled or columnar sample holding all three frames
+        return record
+
+    def is_kept(key: str) -> bool:
+        return keep_key is None or keep_key(key)
+
+    frames_dir = Path(sample_file).parent / "frames"
+    sample_content = {}
+    # keys in the order of the legacy pickled samples
+    for frame_idx, frame_name in enumerate(("pcl", "is_ground")):
+        for time_key in TIME_KEYS:
+            key = f"{frame_name}_{time_key}"
+            if not is_kept(key):
+                continue
+            frame_file = get_tartu_frame_files(
+                frames_dir, str(record[f"frame_{time_key}"])
+            )[frame_idx]
+            # memory mapped: frames that are dropped later are never read from disk
+            sample_content[key] = loader_saver_helper.load_sample(
+                frame_file, np.load, mmap_mode="r"
+            )
+    sample_content["name"] = Path(sample_file).stem
+    for odom_key in KISS_ODOM_KEYS:
+        if is_kept(odom_key):
+            sample_content[odom_key] = np.array(record[odom_key])
+    return sample_content
@@ -1,21 +1,34 @@
-from collections import defaultdict
-from copy import deepcopy
 from glob import glob
 from pathlib import Path
 from typing import Dict, List
 
 import numpy as np
 import torch
+from liso.datasets.sequence_index import (
+    SEQUENCE_INDEX_NAME,
+    SequenceIndex,
+    get_manifest_hash,
+)
+from liso.datasets.tartu.tartu_frame_store import load_tartu_sample
 from liso.datasets.torch_dataset_commons import (
     LidarDataset,
     LidarSample,
     add_lidar_rows_to_kitti_sample,
+    get_lidar_data_loader,
     get_weighted_random_sampler_dropping_samples_without_boxes,
     lidar_dataset_collate_fn,
+    read_only_view,
     recursive_npy_dict_to_torch,
     worker_init_fn,
 )
 from liso.kabsch.shape_utils import Shape
+from liso.utils.file_utils import file_sha256_hexdigest, load_json, sha256_hexdigest
+from liso.utils.shard_archive import ShardedArchiveReader, get_archive_dir
+
+
+def get_sequence_name(sample_path: str) -> str:
+    # sample_name: 2011_09_26_0001_0000000000.npy
+    return "_".join(Path(sample_path).stem.split("_")[0:4])
 
 
 class TartuRawDataset(LidarDataset):
@@ -57,7 +70,46 @@ class TartuRawDataset(LidarDataset):
         dataset_root = Path(cfg.data.paths.tartu.local)
 
         dataset_root = dataset_root.joinpath("tartu_raw")
-        sample_files = sorted(glob(str(Path(dataset_root).joinpath("*.npy"))))
+        use_sharded_archive = self.cfg.data.setdefault(
+            "use_sharded_archives", False
+        ) and (get_archive_dir(dataset_root).exists())
+        if use_sharded_archive:
+            self.sharded_dataset_dirs.append(dataset_root)
+        self.max_sequence_len = 500
+        downsample_dataset_keep_ratio = self.cfg.data.setdefault(
+            "downsample_dataset_keep_ratio", 1.0
+        )
+        # the sequence index is only saved for the complete sample list
+        uses_all_samples = (
+            (pure_inference_mode or size is None)
+            and not get_only_these_specific_samples
+            and not (self.mode == "train" and downsample_dataset_keep_ratio != 1.0)
+        )
+        sequence_index_file = dataset_root.joinpath(SEQUENCE_INDEX_NAME)
+        self.sequence_index = None
+        manifest_hash = None
+        # written by create_tartu.py, lists fully processed dates only
+        dataset_index_file = dataset_root.joinpath("index.json")
+        if uses_all_samples and dataset_index_file.exists():
+            # sample paths follow from the index and the dataset root, no need
+            # to read, let alone regroup them
+            index_checksum = file_sha256_hexdigest(dataset_index_file)
+            manifest_hash = sha256_hexdigest(
+                f"{dataset_root.as_posix()}:{index_checksum}".encode("utf-8")
+            )
+            self.sequence_index = SequenceIndex.load(
+                sequence_index_file, manifest_hash, self.max_sequence_len
+            )
+        if self.sequence_index is not None:
+            # already encoded like self.sample_files at the end of __init__
+            sample_files = self.sequence_index.sample_paths
+        else:
+            sample_files = self.list_sample_files(dataset_root, use_sharded_archive)
+            if uses_all_samples and manifest_hash is None:
+                manifest_hash = get_manifest_hash(sample_files)
+                self.sequence_index = SequenceIndex.load(
+                    sequence_index_file, manifest_hash, self.max_sequence_len
+                )
         if pure_inference_mode:
             assert not use_geom_augmentation
             self.sample_files = sample_files
@@ -88,9 +140,6 @@ class TartuRawDataset(LidarDataset):
                 ), "either stop requesting specific samples or request size=None"
             print(f"Warning: Only requested {len(self.sample_files)}")
 
-        downsample_dataset_keep_ratio = self.cfg.data.setdefault(
-            "downsample_dataset_keep_ratio", 1.0
-        )
         if self.mode == "train" and self.cfg.data.downsample_dataset_keep_ratio != 1.0:
             self.dataset_sequence_is_messed_up = True
             print(
@@ -102,51 +151,60 @@ class TartuRawDataset(LidarDataset):
                 replace=False,
             ).tolist()
             print(f"... {len(sample_files)} samples.")
-        seq_samples = [  # sample_name: 2011_09_26_0001_0000000000.npy
-            ("_".join(Path(el).stem.split("_")[0:4]), Path(el))
-            for el in self.sample_files
-        ]
         # everything must be numpy arrays:
         # https://github.com/pytorch/pytorch/issues/13246#issuecomment-715050814
-
-        sequences_with_sample_names = defaultdict(list)
-        self.max_sequence_len = 500
-        for seq_name, sample_name in seq_samples:
-            if len(sequences_with_sample_names[seq_name]) < self.max_sequence_len:
-                sequences_with_sample_names[seq_name].append(sample_name)
-            else:
-                subsection_idx = 0
-                while (
-                    len(sequences_with_sample_names[seq_name + f"chop{subsection_idx}"])
-                    >= self.max_sequence_len
-                ):
-                    subsection_idx += 1
-                sequences_with_sample_names[seq_name + f"chop{subsection_idx}"].append(
-                    sample_name
-                )
-        for seq_name in sequences_with_sample_names:
-            sequences_with_sample_names[seq_name] = sorted(
-                sequences_with_sample_names[seq_name]
+        if self.sequence_index is None:
+            self.sequence_index = SequenceIndex.from_sample_paths(
+                self.sample_files, get_sequence_name, self.max_sequence_len
             )
-        self.per_seq_sample_paths = []
-        for seq_name in sequences_with_sample_names:
-            self.per_seq_sample_paths.append(sequences_with_sample_names[seq_name])
-
-        self.sequence_lens = np.array([len(el) for el in self.per_seq_sample_paths])
+            if uses_all_samples:
+                self.save_sequence_index(sequence_index_file, manifest_hash)
+        self.sequence_lens = self.sequence_index.sequence_lens
 
         print("sequence lengths: ", self.sequence_lens)
 
-        assert self.data_use_skip_frames in ("only", "both", "never")
+        assert self.data_use_skip_frames in ("only", "both", "never", "multi_pair")
 
         if self.mode == "train" and self.cfg.data.flow_source != "gt":
             pred_flow_path = Path(
                 self.cfg.data.paths.tartu.slim_flow[self.cfg.data.flow_source]["local"]
             )
             self.pred_flow_path = pred_flow_path
+            if self.cfg.data.use_sharded_archives and (
+                get_archive_dir(pred_flow_path).exists()
+            ):
+                self.sharded_dataset_dirs.append(pred_flow_path)
             print(f"Loading flow seperately from source {pred_flow_path}")
 
         self.sample_files = np.array(self.sample_files).astype(np.string_)
 
+    @staticmethod
+    def list_sample_files(dataset_root: Path, use_sharded_archive: bool) -> List[str]:
+        # written by create_tartu.py, lists fully processed dates only
+        dataset_index = load_json(dataset_root.joinpath("index.json"))
+        if dataset_index is not None:
+            return [
+                str(dataset_root.joinpath(f"{sample_name}.npy"))
+                for sample_name in dataset_index["samples"]
+            ]
+        if use_sharded_archive:
+            # one index read per shard writer instead of a glob over all samples
+            return [
+                str(dataset_root.joinpath(member_name))
+                for member_name in ShardedArchiveReader(
+                    get_archive_dir(dataset_root)
+                ).get_member_names()
+                if "/" not in member_name and member_name.endswith(".npy")
+            ]
+        return sorted(glob(str(Path(dataset_root).joinpath("*.npy"))))
+
+    def save_sequence_index(self, sequence_index_file: Path, manifest_hash: str):
+        try:
+            self.sequence_index.save(sequence_index_file, manifest_hash)
+        except OSError as e:
+            # e.g. read only dataset dirs, the index is rebuilt on every start
+            print(f"Warning: could not save sequence index: {e}")
+
     def get_samples_for_sequence(
         self,
         sequence_idx: int,
@@ -154,30 +212,38 @@ class TartuRawDataset(LidarDataset):
         sequence_length: int,
     ) -> List[LidarSample]:
         assert not self.dataset_sequence_is_messed_up
-        global_start_idx_of_sequence = int(np.sum(self.sequence_lens[:sequence_idx]))
-        global_start_idx = global_start_idx_of_sequence + start_idx_in_sequence
-        # global_end_idx = global_start_idx + sequence_length
-        chosen_samples = [
-            LidarSample(
-                idx=global_start_idx + idx,
-                sample_name=str(
-                    self.per_seq_sample_paths[sequence_idx][
-                        start_idx_in_sequence + idx
-                    ].stem
-                ),
-                timestamp=0,
-                full_path=str(
-                    self.per_seq_sample_paths[sequence_idx][start_idx_in_sequence + idx]
-                ),
-            )
-            for idx in range(sequence_length)
+        global_start_idx = self.sequence_index.get_global_sample_idx(
+            sequence_idx, start_idx_in_sequence
+        )
+        sample_paths = self.sequence_index.get_sample_paths(sequence_idx)[
+            start_idx_in_sequence : start_idx_in_sequence + sequence_length
         ]
-
+        assert len(sample_paths) == sequence_length, (
+            sequence_idx,
+            start_idx_in_sequence,
+            sequence_length,
+        )
+        chosen_samples = []
+        for idx, sample_path in enumerate(sample_paths):
+            sample_path = str(sample_path, encoding="utf-8")
+            chosen_samples.append(
+                LidarSample(
+                    idx=global_start_idx + idx,
+                    sample_name=Path(sample_path).stem,
+                    timestamp=0,
+                    full_path=sample_path,
+                )
+            )
         return chosen_samples
 
     def get_scene_index_for_scene_name(self, seq_name: str) -> int:
-        for idx in range(len(self.per_seq_sample_paths)):
-            if seq_name in self.per_seq_sample_paths[idx][0].as_posix():
+        sequence_idx = self.sequence_index.get_sequence_idx(seq_name)
+        if sequence_idx is not None:
+            return sequence_idx
+        # not a sequence name, but maybe part of the path of a first sample
+        for idx in range(len(self.sequence_index)):
+            first_sample_path = self.sequence_index.get_sample_paths(idx)[0]
+            if seq_name in str(first_sample_path, encoding="utf-8"):
                 return idx
 
     def get_consecutive_sample_idxs_for_sequence(
@@ -195,35 +261,20 @@ class TartuRawDataset(LidarDataset):
         )
         return samples_in_sequence
 
-    def __getitem__(self, index):
-        self.initialize_loader_saver_if_necessary()
-        self.initialize_dbs_if_necessary()
-        fname = str(self.sample_files[index], encoding="utf-8")
-        sample_content = self.loader_saver_helper.load_sample(
-            fname, np.load, allow_pickle=True
-        ).item()
+    def prepare_sample_content(self, fname, target_keys_per_frame, drop_time_keys):
+        sample_content = load_tartu_sample(
+            fname,
+            self.loader_saver_helper,
+            keep_key=self.get_sample_key_filter(*drop_time_keys),
+        )
         if not self.cfg.data.use_lidar_intensity:
             self.drop_intensities_from_pcls_in_sample(sample_content)
-
-        if self.for_tracking:
-            src_key = "t0"
-            target_key = "t1"
-            src_trgt_time_delta_s = 0.1
-            self.drop_unused_timed_keys_from_sample(sample_content, "foo", "bar", "baz")
-        else:
-            (
-                src_key,
-                target_key,
-                delete_target_key,
-                src_trgt_time_delta_s,
-            ) = self.select_time_keys()
-
-            self.drop_unused_timed_keys_from_sample(
-                sample_content, src_key, target_key, delete_target_key
-            )
+        self.drop_unused_timed_keys_from_sample(sample_content, *drop_time_keys)
 
         # KITTI (RAW) SPECIFIC: only needed to create tracking DB (raydrop augmentation)
-        add_lidar_rows_to_kitti_sample(sample_content, time_keys=(src_key, target_key))
+        add_lidar_rows_to_kitti_sample(
+            sample_content, time_keys=tuple(target_keys_per_frame)
+        )
 
         # restructure_sample
         sample_content = self.move_keys_to_subdict(
@@ -234,6 +285,14 @@ class TartuRawDataset(LidarDataset):
         )
         sample_content = self.move_keys_to_subdict(sample_content)
         self.add_reverse_odometry_to_sample(sample_content)
+        return sample_content
+
+    def assemble_sample_datas(
+        self, fname, src_key, target_key, src_trgt_time_delta_s, drop_time_keys
+    ):
+        sample_content = self.prepare_sample_content(
+            fname, {src_key: (target_key,), target_key: (src_key,)}, drop_time_keys
+        )
 
         if self.need_flow and self.training_target == "object":
             assert (
@@ -273,11 +332,11 @@ class TartuRawDataset(LidarDataset):
         del sample_content["name"]
         if self.for_tracking:
             sample_data_ta = self.assemble_sample_data(
-                deepcopy(sample_content), "t0", "t1", src_trgt_time_delta_s
+                read_only_view(sample_content), "t0", "t1", src_trgt_time_delta_s
             )
             if self.need_reverse_time_sample_data:
                 sample_data_tb = self.assemble_sample_data(
-                    sample_content, "t1", "t2", src_trgt_time_delta_s
+                    read_only_view(sample_content), "t1", "t2", src_trgt_time_delta_s
                 )
             else:
                 sample_data_tb = {"gt": {}}
@@ -295,23 +354,65 @@ class TartuRawDataset(LidarDataset):
                     "tb",
                     "t0",  # stuff will have been remapped
                 )
-            return (
-                recursive_npy_dict_to_torch(sample_data_ta),
-                recursive_npy_dict_to_torch(sample_data_tb),
-                {},
-                meta,
-            )
-
         else:
             sample_data_ta = self.assemble_sample_data(
-                deepcopy(sample_content), src_key, target_key, src_trgt_time_delta_s
+                read_only_view(sample_content),
+                src_key,
+                target_key,
+                src_trgt_time_delta_s,
             )
             if self.need_reverse_time_sample_data:
                 sample_data_tb = self.assemble_sample_data(
-                    sample_content, target_key, src_key, src_trgt_time_delta_s
+                    read_only_view(sample_content),
+                    target_key,
+                    src_key,
+                    src_trgt_time_delta_s,
                 )
             else:
                 sample_data_tb = {"gt": {}}
+        return sample_data_ta, sample_data_tb, meta
+
+    def get_sample_sequence_names(self) -> List[str]:
+        return [
+            get_sequence_name(str(sample_file, encoding="utf-8"))
+            for sample_file in self.sample_files
+        ]
+
+    def get_sample_ids(self) -> List[str]:
+        return [
+            Path(str(sample_file, encoding="utf-8")).stem
+            for sample_file in self.sample_files
+        ]
+
+    def __getitem__(self, index):
+        self.initialize_loader_saver_if_necessary()
+        self.initialize_dbs_if_necessary()
+        fname = str(self.sample_files[index], encoding="utf-8")
+        if self.data_use_skip_frames == "multi_pair":
+            return self.get_multi_pair_item(fname)
+        if self.for_tracking:
+            src_key = "t0"
+            target_key = "t1"
+            src_trgt_time_delta_s = 0.1
+            drop_time_keys = ("foo", "bar", "baz")
+        else:
+            (
+                src_key,
+                target_key,
+                delete_target_key,
+                src_trgt_time_delta_s,
+            ) = self.select_time_keys()
+            drop_time_keys = (src_key, target_key, delete_target_key)
+        sample_data_ta, sample_data_tb, meta = self.load_or_assemble_sample_datas(
+            fname, src_key, target_key, src_trgt_time_delta_s, drop_time_keys
+        )
+        if self.for_tracking:
+            return (
+                recursive_npy_dict_to_torch(sample_data_ta),
+                recursive_npy_dict_to_torch(sample_data_tb),
+                {},
+                meta,
+            )
 
         if self.verbose:
             print("Loaded sample: {0}".format(Path(fname).stem))
@@ -423,16 +524,15 @@ class TartuTrackingDataset(LidarDataset):
         self.initialize_loader_saver_if_necessary()
 
         fname = self.sample_files[index]
-        sample_content = self.loader_saver_helper.load_sample(
-            fname, np.load, allow_pickle=True
-        ).item()
-
         src_key, target_key, delete_target_key, src_trgt_time_delta_s = (
             "t0",
             "t1",
             "t2",
             0.1,
         )
+        sample_content = self.load_sample_content(
+            fname, src_key, target_key, delete_target_key
+        )
         if not self.cfg.data.use_lidar_intensity:
             self.drop_intensities_from_pcls_in_sample(sample_content)
 
@@ -473,11 +573,14 @@ class TartuTrackingDataset(LidarDataset):
         meta = {"sample_id": sample_content["name"]}
         del sample_content["name"]
         sample_data_ta = self.assemble_sample_data(
-            deepcopy(sample_content), src_key, target_key, src_trgt_time_delta_s
+            read_only_view(sample_content), src_key, target_key, src_trgt_time_delta_s
         )
         if self.need_reverse_time_sample_data:
             sample_data_tb = self.assemble_sample_data(
-                sample_content, target_key, src_key, src_trgt_time_delta_s
+                read_only_view(sample_content),
+                target_key,
+                src_key,
+                src_trgt_time_delta_s,
             )
         else:
             sample_data_tb = {"gt": {}}
@@ -553,16 +656,15 @@ class TartuObjectDataset(LidarDataset):
         self.initialize_loader_saver_if_necessary()
         self.initialize_dbs_if_necessary()
         fname = self.sample_files[index]
-        sample_content = self.loader_saver_helper.load_sample(
-            fname, np.load, allow_pickle=True
-        ).item()
-
         src_key, target_key, delete_target_key, src_trgt_time_delta_s = (
             "t0",
             "t1",
             "t2",
             0.1,
         )
+        sample_content = self.load_sample_content(
+            fname, src_key, target_key, delete_target_key
+        )
 
         add_lidar_rows_to_kitti_sample(sample_content, time_keys=(src_key, target_key))
 
@@ -758,12 +860,11 @@ def get_tartu_train_dataset(
         )
 
         extra_loader_kwargs["sampler"] = weighted_random_sampler
-    train_loader = torch.utils.data.DataLoader(
+    train_loader = get_lidar_data_loader(
+        cfg,
         train_dataset,
-        pin_memory=True,
         batch_size=cfg.data.batch_size,
         num_workers=cfg.data.num_workers,
-        collate_fn=lidar_dataset_collate_fn,
         worker_init_fn=lambda id: np.random.seed(id + cfg.data.num_workers),
         **extra_loader_kwargs,
     )
@@ -1,25 +1,52 @@
 from collections import abc, defaultdict
 from copy import deepcopy
-from functools import lru_cache
+from functools import lru_cache, partial
 from pathlib import Path
-from typing import Dict, List, Tuple, Union
+from typing import Callable, Dict, List, Tuple, Union
 
 import numpy as np
 import torch
+from liso.datasets.assembled_sample_cache import (
+    AssembledSampleCache,
+    AssembledSampleDatas,
+    get_assembled_sample_key,
+    get_package_source_hash,
+)
+from liso.datasets.columnar_samples import COLUMNAR_KEY_SEPARATOR, load_sample_content
+from liso.datasets.flow_store import (
+    EXPANDED_FLOW_KEY_PREFIX,
+    FLOW_STORE_INDEX_NAME,
+    FlowStore,
+    describe_conversion_error,
+    expand_valid_bev_flow_to_zero_flow_neighbor_pillars,
+    get_flow_store_dir,
+)
+from liso.datasets.free_space_sampler import FreeSpaceSampler
 from liso.datasets.kitti.kitti_range_image_projection_helper import (
     kitti_pcl_projection_get_rows_cols,
 )
 from liso.datasets.nuscenes.analyse_boxes import voxelize_pcl
+from liso.datasets.ragged_points import (
+    RAGGED_POINT_PADDING_VALUES,
+    PinnedRingLoader,
+    pack_ragged_points,
+    pack_ragged_values,
+)
 from liso.kabsch.kabsch_mask import (
-    batched_render_gaussian_kabsch_mask,
-    render_hard_kabsch_mask,
+    render_gaussian_kabsch_mask_windows,
+    render_hard_kabsch_masks_batched,
+)
+from liso.kabsch.points_in_boxes import (
+    count_points_in_boxes,
+    get_points_in_boxes_sparse,
+    sparse_points_in_boxes_to_mask,
 )
 from liso.kabsch.shape_utils import Shape
 from liso.tracker.augm_box_db_utils import load_sanitize_box_augmentation_database
 from liso.tracker.mined_box_db_utils import load_mined_boxes_db
 from liso.transformations.transformations import compose_matrix, decompose_matrix
 from liso.utils.bev_utils import get_bev_setup_params
-from liso.utils.cloud_utils import CloudLoaderSaver
+from liso.utils.cloud_utils import CloudLoaderSaver, ShardedCloudLoaderSaver
 from liso.utils.numpy_scatter import scatter_mean_nd_numpy
 from liso.utils.torch_transformation import (
     homogenize_flow,
@@ -28,7 +55,7 @@ from liso.utils.torch_transformation import (
     torch_decompose_matrix,
 )
 from liso.visu.pcl_image import create_occupancy_pcl_image
-from skimage.morphology import binary_dilation, disk
+from omegaconf import OmegaConf
 
 
 # LidarSample = namedtuple("Sample", ("idx", "sample_name", "timestamp", "full_path"))
@@ -70,6 +97,11 @@ KITTI_IGNORE_NON_MOVABLE_CLASSMAPPING = {
     "LargeVehicle": "movable",
 }
 
+# use_skip_frames="multi_pair" (SLIM inference): every item holds the
+# t0->t1 and the t0->t2 sample datas of a sample, assembled from one load
+MULTI_PAIR_TARGET_KEYS = ("t1", "t2")
+TIME_DELTA_FROM_T0_S = {"t1": 0.1, "t2": 0.2}
+
 
 def worker_init_fn(worker_id):
     np.random.seed(4 + worker_id)
@@ -150,14 +182,62 @@ def recursive_npy_dict_to_torch(sample):
     elif isinstance(sample, dict):
         return {k: recursive_npy_dict_to_torch(v) for k, v in sample.items()}
     elif isinstance(sample, np.ndarray):
-        return torch.from_numpy(sample)
+        return torch.from_numpy(materialize_writable(sample))
     elif isinstance(sample, Shape):
         # shape_dict = {k: torch.from_numpy(v) for k, v in sample.__dict__.items()}
-        return sample.to_tensor()
+        return materialize_writable(sample).to_tensor()
     else:
         raise ValueError("unknown type of sample", type(sample))
 
 
+def read_only_view(sample):
+    """Copy the dict structure of sample, sharing its arrays as read only views.
+
+    Replaces deepcopy when several sample datas are assembled from the same
+    sample content: assembling only replaces dict entries, so nothing is
+    copied up front and an in place write into a shared array raises instead
+    of leaking into the other sample data.
+    """
+    if isinstance(sample, dict):
+        return {k: read_only_view(v) for k, v in sample.items()}
+    elif isinstance(sample, np.ndarray):
+        view = sample.view()
+        view.flags.writeable = False
+        return view
+    elif isinstance(sample, Shape):
+        return Shape(**{k: read_only_view(v) for k, v in sample.__dict__.items()})
+    else:
+        return sample
+
+
+def drop_time_key_from_sample(sample, time_key: str):
+    """Copy the dict structure of sample without the keys of time_key.
+
+    E.g. "pcl_t2" or "odom_t0_t2" for time_key t2, arrays are shared.
+    """
+    if isinstance(sample, dict):
+        return {
+            k: drop_time_key_from_sample(v, time_key)
+            for k, v in sample.items()
+            if time_key not in k.split("_")
+        }
+    return sample
+
+
+def materialize_writable(value):
+    """Return value if it may be written to, otherwise a private copy of it.
+
+    Read only arrays are views shared between sample datas (see read_only_view)
+    or memory mapped sample files, the copy is made only where needed.
+    """
+    if isinstance(value, np.ndarray):
+        return value if value.flags.writeable else np.array(value)
+    elif isinstance(value, Shape):
+        return Shape(**{k: materialize_writable(v) for k, v in value.__dict__.items()})
+    else:
+        return value
+
+
 def downsample_dict(data_dict, keep_mask, downsample_keys):
     for k, v in data_dict.items():
         if isinstance(v, abc.Mapping):
@@ -169,16 +249,16 @@ def downsample_dict(data_dict, keep_mask, downsample_keys):
     return data_dict
 
 
-def lidar_dataset_collate_fn(data_list):
+def lidar_dataset_collate_fn(data_list, ragged_points=False):
     sample_datas_t0, sample_datas_t1, augm_sample_datas_t0, meta_datas = list(
         zip(*data_list)
     )
 
     # train_datas = {k: [dic[k] for dic in train_datas] for k in train_datas[0]}
     # train_data = {k: torch.stack(v, dim=0) for k, v in train_datas.items()}
-    sample_data_t0 = collate_list_data(sample_datas_t0)
-    sample_data_t1 = collate_list_data(sample_datas_t1)
-    augm_sample_data_t0 = collate_list_data(augm_sample_datas_t0)
+    sample_data_t0 = collate_list_data(sample_datas_t0, ragged_points)
+    sample_data_t1 = collate_list_data(sample_datas_t1, ragged_points)
+    augm_sample_data_t0 = collate_list_data(augm_sample_datas_t0, ragged_points)
     meta_data = defaultdict(list)
     for md in meta_datas:
         for key, val in md.items():
@@ -187,6 +267,47 @@ def lidar_dataset_collate_fn(data_list):
     return sample_data_t0, sample_data_t1, augm_sample_data_t0, meta_data
 
 
+def multi_pair_collate_fn(data_list, ragged_points=False):
+    # one lidar_dataset_collate_fn batch per pair of MULTI_PAIR_TARGET_KEYS
+    return tuple(
+        lidar_dataset_collate_fn(list(pair_data_list), ragged_points)
+        for pair_data_list in zip(*data_list)
+    )
+
+
+def get_lidar_data_loader(
+    cfg, dataset, **loader_kwargs
+) -> Union[torch.utils.data.DataLoader, PinnedRingLoader]:
+    """DataLoader over a LidarDataset, collating with lidar_dataset_collate_fn.
+
+    By default point clouds are padded and every batch gets pinned. With
+    data.ragged_point_collate, they are packed instead (see
+    liso.datasets.ragged_points, RecursiveDeviceMover pads them on the
+    device) and batches are pinned into a ring of data.pinned_ring_size
+    reused buffers. Multi pair datasets are collated per pair.
+    """
+    if getattr(dataset, "data_use_skip_frames", None) == "multi_pair":
+        collate_fn = multi_pair_collate_fn
+    else:
+        collate_fn = lidar_dataset_collate_fn
+    if not cfg.data.setdefault("ragged_point_collate", False):
+        return torch.utils.data.DataLoader(
+            dataset,
+            pin_memory=True,
+            collate_fn=collate_fn,
+            **loader_kwargs,
+        )
+    loader = torch.utils.data.DataLoader(
+        dataset,
+        pin_memory=False,
+        collate_fn=partial(collate_fn, ragged_points=True),
+        **loader_kwargs,
+    )
+    if not torch.cuda.is_available():
+        return loader
+    return PinnedRingLoader(loader, cfg.data.setdefault("pinned_ring_size", 4))
+
+
 def draw_heat_regression_maps(
     boxes: Shape,  # numpy!
     grid_size: np.ndarray,
@@ -197,22 +318,6 @@ def draw_heat_regression_maps(
 ):
     assert bev_range_m.shape == (2,), bev_range_m.shape
     if np.count_nonzero(boxes.valid) > 0:
-        per_slot_prob_heatmap = batched_render_gaussian_kabsch_mask(
-            box_x=boxes.pos[None, :, 0],
-            box_y=boxes.pos[None, :, 1],
-            box_len=boxes.dims[None, :, 0],
-            box_w=boxes.dims[None, :, 1],
-            box_theta=boxes.rot[None, :, 0],
-            bev_range_x=bev_range_m[0],
-            bev_range_y=bev_range_m[1],
-            img_shape=grid_size,
-            normalize_gaussian=normalize_gaussian,
-        )
-        per_slot_prob_heatmap = np.squeeze(per_slot_prob_heatmap, axis=0)
-        occupancy_thresh = 0.01
-        occupancy_mask_f32 = (per_slot_prob_heatmap > occupancy_thresh).astype(
-            np.float32
-        )[..., None]
         # START SECTION DIMS
         if box_pred_cfg.dimensions_representation.method == "predict_abs_size":
             box_dims = boxes.dims
@@ -221,16 +326,14 @@ def draw_heat_regression_maps(
             box_dims = np.log(boxes.dims)
         else:
             raise NotImplementedError(box_pred_cfg.dimensions_representation.method)
-        dims_map = occupancy_mask_f32 * box_dims[:, None, None, :]
         # END DIMS
 
         # START SECTION ROT
         if box_pred_cfg.rotation_representation.method == "vector":
             sin_yaw, cos_yaw = np.sin(boxes.rot), np.cos(boxes.rot)
-            sincos_yaw = np.concatenate([sin_yaw, cos_yaw], axis=-1)
-            rot_map = occupancy_mask_f32 * sincos_yaw[:, None, None, :]
+            box_rot = np.concatenate([sin_yaw, cos_yaw], axis=-1)
         elif box_pred_cfg.rotation_representation.method in ("direct", "class_bins"):
-            rot_map = occupancy_mask_f32 * boxes.rot[:, None, None, :]
+            box_rot = boxes.rot
         else:
             raise NotImplementedError(box_pred_cfg.rotation_representation.method)
         # END ROT
@@ -240,7 +343,7 @@ def draw_heat_regression_maps(
             "global_absolute",
             "local_relative_offset",
         ):
-            pos_map = occupancy_mask_f32 * boxes.pos[:, None, None, :]
+            box_pos = boxes.pos
         elif box_pred_cfg.position_representation.method == "local_relative_offset":
             raise AssertionError("this did not work so well, dropped it")
             # # assert box_pred_cfg.activations.pos in ("None","none",None), box_pred_cfg.activations.pos
@@ -293,25 +396,47 @@ def draw_heat_regression_maps(
         # END POS
 
         assert boxes.velo.shape[-1] == 1, boxes.velo.shape
-        velo_map = occupancy_mask_f32 * boxes.velo[:, None, None, :]
         if per_obj_prob_scale is not None:
             assert not normalize_gaussian
             assert per_obj_prob_scale.shape[-1] == 1, per_obj_prob_scale.shape
-            per_slot_prob_heatmap = (
-                per_obj_prob_scale[:, :, None] * per_slot_prob_heatmap
-            )
-        prob_heatmap = np.max(per_slot_prob_heatmap, axis=0)[..., None]
-
-        hottest_object_mask = (
-            per_slot_prob_heatmap.max(axis=0, keepdims=1) == per_slot_prob_heatmap
-        )
+        box_attrs = {
+            "dims": box_dims,
+            "pos": box_pos,
+            "rot": box_rot,
+            "velo": boxes.velo,
+        }
+        prob_heatmap = np.zeros(tuple(grid_size))
         maps = {
-            "probs": prob_heatmap,
-            "dims": (hottest_object_mask[..., None] * dims_map).sum(axis=0),
-            "pos": (hottest_object_mask[..., None] * pos_map).sum(axis=0),
-            "rot": (hottest_object_mask[..., None] * rot_map).sum(axis=0),
-            "velo": (hottest_object_mask[..., None] * velo_map).sum(axis=0),
+            k: np.zeros(tuple(grid_size) + v.shape[-1:]) for k, v in box_attrs.items()
         }
+        occupancy_thresh = 0.01
+        # each pixel takes the attributes of its hottest box, summed over ties
+        for box_idx, (rows, cols, weight) in enumerate(
+            render_gaussian_kabsch_mask_windows(
+                box_x=boxes.pos[:, 0],
+                box_y=boxes.pos[:, 1],
+                box_len=boxes.dims[:, 0],
+                box_w=boxes.dims[:, 1],
+                box_theta=boxes.rot[:, 0],
+                bev_range_x=bev_range_m[0],
+                bev_range_y=bev_range_m[1],
+                img_shape=grid_size,
+                normalize_gaussian=normalize_gaussian,
+            )
+        ):
+            occupancy_mask_f32 = (weight > occupancy_thresh).astype(np.float32)
+            if per_obj_prob_scale is not None:
+                weight = per_obj_prob_scale[box_idx, 0] * weight
+            hottest_so_far = prob_heatmap[rows, cols]
+            is_hotter = weight > hottest_so_far
+            is_as_hot = weight == hottest_so_far
+            for k, attr_map in maps.items():
+                box_attr_map = occupancy_mask_f32[..., None] * box_attrs[k][box_idx]
+                window = attr_map[rows, cols]
+                window[is_hotter] = box_attr_map[is_hotter]
+                window[is_as_hot] += box_attr_map[is_as_hot]
+            prob_heatmap[rows, cols] = np.maximum(hottest_so_far, weight)
+        maps["probs"] = prob_heatmap[..., None]
         gt_center_mask = np.squeeze(
             create_occupancy_pcl_image(boxes.pos[boxes.valid], bev_range_m, grid_size)
             > 0.5,
@@ -368,16 +493,29 @@ def list_of_dicts_of_dicts_to_dict_of_dicts_of_lists(in_data):
         return out_dict
 
 
-def collate_list_data(sample_datas_t0):
+def collate_list_data(sample_datas_t0, ragged_points=False):
+    """Collate sample datas, point clouds are padded or with ragged_points packed."""
     nested_dict_of_lists = list_of_dicts_of_dicts_to_dict_of_dicts_of_lists(
         sample_datas_t0
     )
     for k, v in nested_dict_of_lists.items():
-        change_k_v(k, nested_dict_of_lists, v)
+        change_k_v(k, nested_dict_of_lists, v, ragged_points)
     return nested_dict_of_lists
 
 
-def change_k_v(key, parent_dict, value):
+def change_k_v(key, parent_dict, value, ragged_points=False):
+    if (
+        ragged_points
+        and key in ("pcl_ta", "pcl_tb", "pcl_tx")
+        and isinstance(value, abc.Mapping)
+    ):
+        parent_dict[key] = pack_ragged_points(value["pcl"], value["pillar_coors"])
+        return
+    if ragged_points and (
+        key in RAGGED_POINT_PADDING_VALUES or "track_ids_mask" in key
+    ):
+        parent_dict[key] = pack_ragged_values(value)
+        return
     if key in ("pcl_ta", "pcl_tb", "pcl_tx") and isinstance(
         value, abc.Mapping
     ):  # , "pillar_coors", "point_flow", "moving_mask"):
@@ -401,7 +539,7 @@ def change_k_v(key, parent_dict, value):
         assert torch.all(padding_mask == pillar_coords_padding_mask)
     if isinstance(value, abc.Mapping):
         for sub_key, sub_value in value.items():
-            change_k_v(sub_key, value, sub_value)
+            change_k_v(sub_key, value, sub_value, ragged_points)
     else:
         if key in ("pillar_coors", "pcl"):
             # these can only be processed jointly as dict
@@ -454,8 +592,11 @@ class LidarDataset(torch.utils.data.Dataset):
         self.path_to_mined_boxes_db = path_to_mined_boxes_db
         self.box_augm_db = None
         self.mined_boxes_db = None
+        self.pred_flow_store = None
         self.dataset_sequence_is_messed_up = False
         self.loader_saver_helper = None  # need a seperate connection here
+        # dirs packed with liso.utils.shard_archive, served from their shards
+        self.sharded_dataset_dirs = []
 
         assert self.mode in ("train", "val", "test"), self.mode
         if shuffle:
@@ -475,7 +616,12 @@ class LidarDataset(torch.utils.data.Dataset):
                 "gt",
             ), self.cfg.data.odom_source
 
-        assert use_skip_frames in ("only", "never", "both"), use_skip_frames
+        assert use_skip_frames in (
+            "only",
+            "never",
+            "both",
+            "multi_pair",
+        ), use_skip_frames
         if for_tracking:
             assert (
                 use_skip_frames == "never"
@@ -510,9 +656,20 @@ class LidarDataset(torch.utils.data.Dataset):
 
         self.need_reverse_time_sample_data = self.cfg.network.name == "slim"
 
+        # opt-in, e.g. for tracking rounds that iterate the same samples repeatedly
+        self.assembled_sample_cache = AssembledSampleCache(
+            self.cfg.data.setdefault("assembled_sample_cache_dir", None)
+        )
+        self.assembled_sample_cache_config = None
+
     def initialize_loader_saver_if_necessary(self):
         if self.loader_saver_helper is None:
-            self.loader_saver_helper = CloudLoaderSaver()
+            if len(self.sharded_dataset_dirs) > 0:
+                self.loader_saver_helper = ShardedCloudLoaderSaver(
+                    self.sharded_dataset_dirs
+                )
+            else:
+                self.loader_saver_helper = CloudLoaderSaver()
 
     def initialize_dbs_if_necessary(self):
         # not to be called during __init__, but during first loading of data
@@ -556,6 +713,14 @@ class LidarDataset(torch.utils.data.Dataset):
     def __len__(self) -> int:
         return len(self.sample_files)
 
+    def get_sample_sequence_names(self) -> Union[List[str], None]:
+        """Sequence name of each sample, None if not known before loading."""
+        return None
+
+    def get_sample_ids(self) -> Union[List[str], None]:
+        """meta["sample_id"] of each sample, None if not known before loading."""
+        return None
+
     def load_add_mined_boxes_to_sample_content(
         self,
         db_key: str,
@@ -587,6 +752,38 @@ class LidarDataset(torch.utils.data.Dataset):
             extra_boxes = Shape.createEmpty()
         sample_content["mined"] = {"objects_t0": extra_boxes}
 
+    def get_pred_flow_store(self) -> Union[FlowStore, None]:
+        # data.flow_store: "npz" reads the SLIM exports, "mmap" the flow store
+        # built from them by liso.datasets.flow_store
+        flow_store_kind = self.cfg.data.setdefault("flow_store", "npz")
+        assert flow_store_kind in ("npz", "mmap"), flow_store_kind
+        if flow_store_kind == "npz":
+            return None
+        if self.pred_flow_store is None:
+            self.pred_flow_store = FlowStore(
+                self.pred_flow_path, self.loader_saver_helper
+            )
+            print(describe_conversion_error(self.pred_flow_store.index))
+        return self.pred_flow_store
+
+    def load_pred_flow_content(self, pred_flow_file: Path):
+        flow_store = self.get_pred_flow_store()
+        if flow_store is not None and pred_flow_file.is_relative_to(
+            self.pred_flow_path
+        ):
+            pred_content = flow_store.load_sample(
+                pred_flow_file.relative_to(self.pred_flow_path)
+                .with_suffix("")
+                .as_posix()
+            )
+            if pred_content is not None:
+                return pred_content
+        if not self.loader_saver_helper.sample_exists(pred_flow_file):
+            return None
+        return self.loader_saver_helper.load_sample(
+            pred_flow_file, np.load, allow_pickle=True
+        )
+
     def load_add_flow_to_sample_content(
         self,
         fname,
@@ -606,14 +803,12 @@ class LidarDataset(torch.utils.data.Dataset):
                     Path(fname).with_suffix(".npz")
                 )
 
-        if not specific_pred_flow_path.exists():
+        pred_content = self.load_pred_flow_content(specific_pred_flow_path)
+        if pred_content is None:
             print(
                 f"Warning - file {specific_pred_flow_path} for flow source {self.cfg.data.flow_source} was not found!"
             )
             return
-        pred_content = self.loader_saver_helper.load_sample(
-            specific_pred_flow_path, np.load, allow_pickle=True
-        )
         flow_source_grid_range_m_np = np.append(
             pred_content["bev_range_m"], np.array(1000.0)
         )
@@ -627,7 +822,25 @@ class LidarDataset(torch.utils.data.Dataset):
             0.5 * np.max(self.bev_range_m_np) <= max_allowed_radius
         ), "cannot gather flow predictions outside of bev range - load predictiosn with larger bev or reduce cfg.data.bev_range_m"
 
-        grid_size = np.append(pred_content["bev_raw_flow_t0_t1"].shape[:2], np.array(1))
+        bev_flows = {}
+        for source_time_key, target_time_key in (
+            (src_key, target_key),
+            (target_key, src_key),
+        ):
+            time_keys = f"{source_time_key}_{target_time_key}"
+            expanded_flow_key = EXPANDED_FLOW_KEY_PREFIX + time_keys
+            if expanded_flow_key in pred_content:
+                # precomputed by the flow store
+                bev_flows[time_keys] = pred_content[expanded_flow_key]
+            else:
+                bev_flows[
+                    time_keys
+                ] = expand_valid_bev_flow_to_zero_flow_neighbor_pillars(
+                    pred_content[f"bev_raw_flow_{time_keys}"]
+                )
+        grid_size = np.append(
+            bev_flows[f"{src_key}_{target_key}"].shape[:2], np.array(1)
+        )
 
         sample_content[self.cfg.data.flow_source] = {}
         for source_time_key, target_time_key in (
@@ -641,16 +854,7 @@ class LidarDataset(torch.utils.data.Dataset):
             )
             pillar_coors = voxel_coors[:, :2]
             flow2d = np.nan * np.ones(pillar_coors.shape, dtype=np.float32)
-            bev_flow = pred_content[f"bev_raw_flow_{source_time_key}_{target_time_key}"]
-
-            # bev_flow_new = self.fill_in_flow_from_valid_pillar_neighbors(bev_flow)
-            # bev_flow_new = self.fill_in_flow_from_valid_pillar_neighbors_array_style(
-            #     bev_flow
-            # )
-
-            bev_flow = self.expand_valid_bev_flow_to_zero_flow_neighbor_pillars(
-                bev_flow
-            )
+            bev_flow = bev_flows[f"{source_time_key}_{target_time_key}"]
 
             in_range_pillar_coors = pillar_coors[in_range]
             flow2d[in_range] = bev_flow[
@@ -674,25 +878,6 @@ class LidarDataset(torch.utils.data.Dataset):
                 f"flow_{source_time_key}_{target_time_key}"
             ] = flow3d
 
-    def expand_valid_bev_flow_to_zero_flow_neighbor_pillars(self, bev_flow: np.ndarray):
-        # this should fix any small numerical imprecisions during pillarization
-        # but not change flow of occupied cells
-
-        pillar_has_zero_flow = (bev_flow == 0.0).all(axis=-1)
-        bev_flow = np.ma.masked_array(
-            bev_flow,
-            # true indicates invalid data
-            mask=np.stack([pillar_has_zero_flow, pillar_has_zero_flow], axis=-1),
-        )
-        for shift in (-1, 1):
-            for axis in (0, 1):
-                bev_flow_shifted = np.roll(bev_flow, shift=shift, axis=axis)
-                idx = ~bev_flow_shifted.mask * bev_flow.mask
-                bev_flow[idx] = bev_flow_shifted[idx]
-        bev_flow = bev_flow.filled(fill_value=0.0)
-        # pillar_has_zero_flow = (bev_flow == 0.0).all(axis=-1)
-        return bev_flow
-
     def kitti_extract_boxes_for_timestamp(self, sample_content, src_key):
         box_key = f"objects_{src_key}"
         if (
@@ -921,24 +1106,16 @@ class LidarDataset(torch.utils.data.Dataset):
             ignore_boxes_np = ignore_boxes.clone().detach().cpu().numpy()
         else:
             ignore_boxes_np = ignore_boxes
-        ignore_region_is_true_mask = np.zeros(
-            self.centermaps_output_grid_size, dtype=bool
+        return render_hard_kabsch_masks_batched(
+            box_x=ignore_boxes_np.pos[:, 0],
+            box_y=ignore_boxes_np.pos[:, 1],
+            box_len=ignore_boxes_np.dims[:, 0],
+            box_w=ignore_boxes_np.dims[:, 1],
+            box_theta=ignore_boxes_np.rot[:, 0],
+            bev_range_x=self.bev_range_m_np[0],
+            bev_range_y=self.bev_range_m_np[1],
+            img_shape=self.centermaps_output_grid_size,
         )
-        for ignore_box in ignore_boxes_np:
-            this_box_mask_float, _ = render_hard_kabsch_mask(
-                box_x=ignore_box.pos[0],
-                box_y=ignore_box.pos[1],
-                box_len=ignore_box.dims[0],
-                box_w=ignore_box.dims[1],
-                box_theta=ignore_box.rot[0],
-                bev_range_x=self.bev_range_m_np[0],
-                bev_range_y=self.bev_range_m_np[1],
-                img_shape=self.centermaps_output_grid_size,
-            )
-            ignore_region_is_true_mask = ignore_region_is_true_mask | (
-                this_box_mask_float > 0.5
-            )
-        return ignore_region_is_true_mask
 
     def move_keys_to_subdict(
         self,
@@ -996,9 +1173,16 @@ class LidarDataset(torch.utils.data.Dataset):
                 sample_content[pcl_time_key] = sample_content[pcl_time_key][:, :3]
 
     def drop_points_on_kitti_vehicle(self, sample_content, src_key, target_key):
+        return self.drop_frame_points_on_kitti_vehicle(
+            sample_content, {src_key: (target_key,), target_key: (src_key,)}
+        )
+
+    def drop_frame_points_on_kitti_vehicle(
+        self, sample_content, target_keys_per_frame: Dict[str, Tuple[str, ...]]
+    ):
         half_vehicle_size = 0.5 * np.array([5.0, 2.5, 3.0])
-        for sk, tk in ((src_key, target_key), (target_key, src_key)):
-            downsample_keys = self.get_sample_data_downsample_keys(sk, tk)
+        for sk, tks in target_keys_per_frame.items():
+            downsample_keys = self.get_frame_downsample_keys(sk, tks)
             if f"pcl_{sk}" in sample_content:
                 is_vehicle_point = (
                     np.abs(sample_content[f"pcl_{sk}"][:, :3])
@@ -1020,10 +1204,12 @@ class LidarDataset(torch.utils.data.Dataset):
     ):
         if np.count_nonzero(objects.valid) > 0:
             if box_has_points_inside is None:
-                point_is_in_box = get_points_in_boxes_mask(
+                _, box_idxs = get_points_in_boxes_sparse(
                     objects, pcl_homog, use_double_precision=False
                 )
-                box_has_points_inside = point_is_in_box.sum(axis=0) > 0
+                box_has_points_inside = (
+                    count_points_in_boxes(box_idxs, objects.shape[0]) > 0
+                )
             else:
                 # use precomputed box_has_points_inside
                 assert box_has_points_inside.shape == objects.shape, (
@@ -1061,37 +1247,54 @@ class LidarDataset(torch.utils.data.Dataset):
     def pillarize_points_remove_ground_add_bev_ghm_occupancy(
         self, sample_content, src_key, target_key
     ):
-        for sk, tk in ((src_key, target_key), (target_key, src_key)):
-            if f"pcl_{sk}" in sample_content:
-                sample_content[f"pcl_full_w_ground_{sk}"] = np.copy(
-                    sample_content[f"pcl_{sk}"]
-                )
+        return self.pillarize_frames_remove_ground_add_bev_ghm_occupancy(
+            sample_content, {src_key: (target_key,), target_key: (src_key,)}
+        )
+
+    def pillarize_frames_remove_ground_add_bev_ghm_occupancy(
+        self, sample_content, target_keys_per_frame: Dict[str, Tuple[str, ...]]
+    ):
+        # target_keys_per_frame: the frames paired with each frame, their
+        # flows are downsampled together with the frame's points
+        for sk, tks in target_keys_per_frame.items():
+            # frames that are already pillarized are shared between pairs
+            # (see assemble_multi_pair_sample_datas)
+            if f"pcl_{sk}" in sample_content and not isinstance(
+                sample_content[f"pcl_{sk}"], dict
+            ):
+                downsample_keys = self.get_frame_downsample_keys(sk, tks)
+                # downsampling below replaces pcl_{sk} instead of writing into it
+                sample_content[f"pcl_full_w_ground_{sk}"] = sample_content[f"pcl_{sk}"]
                 no_ground_pcl_sample = self.remove_ground_points_from_sample(
                     {
-                        f"pcl_{sk}": np.copy(sample_content[f"pcl_{sk}"]),
+                        f"pcl_{sk}": sample_content[f"pcl_{sk}"],
                         "gt": {
                             f"is_ground_{sk}": sample_content["gt"][f"is_ground_{sk}"]
                         },
                     },
                     sk,
-                    tk,
+                    tks[0],
                     downsample_keys=(f"pcl_{sk}",),
                 )
                 sample_content[f"pcl_full_no_ground_{sk}"] = no_ground_pcl_sample[
                     f"pcl_{sk}"
                 ]
-                sample_content = self.pillarize_bev(sample_content, sk, tk)
+                sample_content = self.pillarize_bev(
+                    sample_content, sk, tks[0], downsample_keys=downsample_keys
+                )
                 sample_content = self.remove_ground_points_from_sample(
                     sample_content,
                     sk,
-                    tk,
+                    tks[0],
+                    downsample_keys=downsample_keys,
                 )
-                flow_key = f"flow_{sk}_{tk}"
-                if flow_key in sample_content["gt"]:
-                    assert (
-                        sample_content[f"pcl_{sk}"].shape[0]
-                        == sample_content["gt"][f"flow_{sk}_{tk}"].shape[0]
-                    )
+                for tk in tks:
+                    flow_key = f"flow_{sk}_{tk}"
+                    if flow_key in sample_content["gt"]:
+                        assert (
+                            sample_content[f"pcl_{sk}"].shape[0]
+                            == sample_content["gt"][f"flow_{sk}_{tk}"].shape[0]
+                        )
 
                 # we now have 3 types on the point cloud
                 # pcl_ta:                   does NOT have ground, is limited to BEV
@@ -1149,8 +1352,14 @@ class LidarDataset(torch.utils.data.Dataset):
         sample_content,
         src_key,
         target_key,
+        downsample_keys=None,
     ):
-        downsample_keys_t0 = self.get_sample_data_downsample_keys(src_key, target_key)
+        if downsample_keys is None:
+            downsample_keys_t0 = self.get_sample_data_downsample_keys(
+                src_key, target_key
+            )
+        else:
+            downsample_keys_t0 = downsample_keys
         pcl_t0 = sample_content[f"pcl_{src_key}"]
 
         pillar_coors_t0, point_is_in_range_t0 = self.voxelize_sample(pcl_t0)
@@ -1197,6 +1406,18 @@ class LidarDataset(torch.utils.data.Dataset):
             f"track_ids_mask_{src_key}",
         )
 
+    @classmethod
+    def get_frame_downsample_keys(
+        cls, src_key: str, target_keys: Tuple[str, ...]
+    ) -> Tuple[str, ...]:
+        return tuple(
+            dict.fromkeys(
+                key
+                for target_key in target_keys
+                for key in cls.get_sample_data_downsample_keys(src_key, target_key)
+            )
+        )
+
     def add_bev_flow(
         self, sample_content, point_flow_src_key, time_src_key, time_target_key
     ):
@@ -1235,17 +1456,14 @@ class LidarDataset(torch.utils.data.Dataset):
         y_in_range = 0.5 * self.bev_range_m_np[1] >= np.abs(obj.pos[:, 1])
         return x_in_range & y_in_range
 
-    def drop_unused_timed_keys_from_sample(
-        self, sample_content, src_key, target_key, delete_target_key
-    ):
-        delete_no_matter_what = [
+    def get_unused_timed_keys(
+        self, src_key, target_key, delete_target_key
+    ) -> Tuple[Tuple[str, ...], Tuple[str, ...]]:
+        delete_no_matter_what = (
             "lidar_intensities",
             "track_ids_mask",
             "semantics",
-        ]
-        for key in list(sample_content.keys()):
-            if any([el in key for el in delete_no_matter_what]):
-                sample_content.pop(key, None)
+        )
 
         drop_these_keys = [
             "meta_data_t0",
@@ -1273,9 +1491,237 @@ class LidarDataset(torch.utils.data.Dataset):
                 f"odom_{target_key}_{src_key}",
             ]
             drop_these_keys += drop_these_additional_keys
+        return delete_no_matter_what, tuple(drop_these_keys)
+
+    def drop_unused_timed_keys_from_sample(
+        self, sample_content, src_key, target_key, delete_target_key
+    ):
+        delete_no_matter_what, drop_these_keys = self.get_unused_timed_keys(
+            src_key, target_key, delete_target_key
+        )
+        for key in list(sample_content.keys()):
+            if any([el in key for el in delete_no_matter_what]):
+                sample_content.pop(key, None)
+
         for delete_key in drop_these_keys:
             sample_content.pop(delete_key, None)
 
+    def get_sample_key_filter(
+        self, src_key, target_key, delete_target_key
+    ) -> Callable[[str], bool]:
+        # columnar samples: keys that drop_unused_timed_keys_from_sample would
+        # drop are not even read from disk
+        delete_no_matter_what, drop_these_keys = self.get_unused_timed_keys(
+            src_key, target_key, delete_target_key
+        )
+
+        def keep_key(flat_key: str) -> bool:
+            key = flat_key.split(COLUMNAR_KEY_SEPARATOR)[0]
+            if any(el in key for el in delete_no_matter_what):
+                return False
+            return key not in drop_these_keys
+
+        return keep_key
+
+    def load_sample_content(self, fname, src_key, target_key, delete_target_key):
+        # memory mapped like the tartu frames, pages of dropped points are never read
+        return load_sample_content(
+            fname,
+            self.loader_saver_helper,
+            keep_key=self.get_sample_key_filter(src_key, target_key, delete_target_key),
+            mmap_mode="r",
+        )
+
+    def sample_assembly_is_deterministic(self) -> bool:
+        # same condition under which __getitem__ skips augment_sample_content
+        return (
+            self.for_tracking
+            or self.pure_inference_mode
+            or not (self.use_geom_augmentation and self.cfg.data.augmentation.active)
+        )
+
+    def get_assembled_sample_input_files(self, fname: str) -> List[str]:
+        input_files = [fname]
+        if self.need_flow and getattr(self, "pred_flow_path", None) is not None:
+            input_files.append(self.pred_flow_path.joinpath(Path(fname).stem + ".npz"))
+            if self.cfg.data.setdefault("flow_store", "npz") == "mmap":
+                input_files.append(
+                    get_flow_store_dir(self.pred_flow_path).joinpath(
+                        FLOW_STORE_INDEX_NAME
+                    )
+                )
+        if self.path_to_mined_boxes_db is not None:
+            input_files.append(self.path_to_mined_boxes_db)
+        return input_files
+
+    def get_assembled_sample_cache_config(self) -> Dict:
+        data_cfg = OmegaConf.to_container(self.cfg.data, resolve=True)
+        # do not change how a single sample is assembled
+        for key in (
+            "tracking_cfg",
+            "num_workers",
+            "batch_size",
+            "assembled_sample_cache_dir",
+        ):
+            data_cfg.pop(key, None)
+        return {
+            "data": data_cfg,
+            "network": self.cfg.network.name,
+            "box_prediction": OmegaConf.to_container(
+                self.cfg.box_prediction, resolve=True
+            ),
+            "centermaps": OmegaConf.to_container(
+                self.cfg.loss.supervised.centermaps, resolve=True
+            ),
+            "confidence_threshold_mined_boxes": OmegaConf.select(
+                self.cfg, "optimization.rounds.confidence_threshold_mined_boxes"
+            ),
+            "dataset": type(self).__name__,
+            "mode": self.mode,
+            "for_tracking": self.for_tracking,
+            "pure_inference_mode": self.pure_inference_mode,
+            "need_flow": self.need_flow,
+            "training_target": getattr(self, "training_target", None),
+        }
+
+    def get_assembled_sample_cache_key(
+        self, fname: str, time_keys: Tuple[str, ...]
+    ) -> str:
+        if self.assembled_sample_cache_config is None:
+            config = self.get_assembled_sample_cache_config()
+            self.assembled_sample_cache_config = config
+        get_fingerprint = self.loader_saver_helper.get_sample_fingerprint
+        return get_assembled_sample_key(
+            input_fingerprints=[
+                f"{input_file}@{get_fingerprint(input_file)}"
+                for input_file in self.get_assembled_sample_input_files(fname)
+            ],
+            time_keys=time_keys,
+            config=self.assembled_sample_cache_config,
+            code_hash=get_package_source_hash(),
+        )
+
+    def assemble_sample_datas(
+        self,
+        fname: str,
+        src_key: str,
+        target_key: str,
+        src_trgt_time_delta_s: float,
+        drop_time_keys: Tuple[str, str, str],
+    ) -> AssembledSampleDatas:
+        raise NotImplementedError("subclass needs to implement this!")
+
+    def load_or_assemble_sample_datas(
+        self,
+        fname: str,
+        src_key: str,
+        target_key: str,
+        src_trgt_time_delta_s: float,
+        drop_time_keys: Tuple[str, str, str],
+    ) -> AssembledSampleDatas:
+        if (
+            self.assembled_sample_cache.cache_dir is None
+            or not self.sample_assembly_is_deterministic()
+        ):
+            return self.assemble_sample_datas(
+                fname, src_key, target_key, src_trgt_time_delta_s, drop_time_keys
+            )
+        key = self.get_assembled_sample_cache_key(
+            fname, (src_key, target_key) + tuple(drop_time_keys)
+        )
+        sample_datas = self.assembled_sample_cache.load(key)
+        if sample_datas is None:
+            sample_datas = self.assemble_sample_datas(
+                fname, src_key, target_key, src_trgt_time_delta_s, drop_time_keys
+            )
+            self.assembled_sample_cache.save(key, sample_datas)
+        return sample_datas
+
+    def prepare_sample_content(
+        self,
+        fname: str,
+        target_keys_per_frame: Dict[str, Tuple[str, ...]],
+        drop_time_keys: Tuple[str, str, str],
+    ) -> Dict:
+        """Load a sample, restructured into subdicts and with reverse odometry."""
+        raise NotImplementedError("subclass needs to implement this!")
+
+    def assemble_multi_pair_sample_datas(self, fname: str):
+        """Sample datas of the pairs t0->t1 and t0->t2, one load of the sample.
+
+        Same sample datas as assemble_sample_datas with use_skip_frames
+        "never" and "only", but the sample is loaded only once and each of the
+        frames t0, t1, t2 is ground filtered and pillarized only once.
+        """
+        assert self.sample_assembly_is_deterministic() and not self.for_tracking
+        assert not self.pure_inference_mode, "pure inference only has t0->t1"
+        assert (
+            not self.need_flow or getattr(self, "training_target", None) != "object"
+        ), "multi pair samples come without predicted flow"
+        target_keys_per_frame = {"t0": MULTI_PAIR_TARGET_KEYS}
+        for target_key in MULTI_PAIR_TARGET_KEYS:
+            target_keys_per_frame[target_key] = ("t0",)
+        # nothing but the keys dropped for any pair
+        sample_content = self.prepare_sample_content(
+            fname, target_keys_per_frame, ("foo", "bar", "baz")
+        )
+        meta = {"sample_id": sample_content.pop("name")}
+        sample_content = self.pillarize_frames_remove_ground_add_bev_ghm_occupancy(
+            sample_content, target_keys_per_frame
+        )
+        pair_sample_datas = []
+        for target_key in MULTI_PAIR_TARGET_KEYS:
+            pair_content = sample_content
+            for other_target_key in MULTI_PAIR_TARGET_KEYS:
+                if other_target_key != target_key:
+                    pair_content = drop_time_key_from_sample(
+                        pair_content, other_target_key
+                    )
+            src_trgt_time_delta_s = TIME_DELTA_FROM_T0_S[target_key]
+            sample_data_ta = self.assemble_sample_data(
+                read_only_view(pair_content), "t0", target_key, src_trgt_time_delta_s
+            )
+            if self.need_reverse_time_sample_data:
+                sample_data_tb = self.assemble_sample_data(
+                    read_only_view(pair_content),
+                    target_key,
+                    "t0",
+                    src_trgt_time_delta_s,
+                )
+            else:
+                sample_data_tb = {"gt": {}}
+            pair_sample_datas.append((sample_data_ta, sample_data_tb))
+        return pair_sample_datas, meta
+
+    def get_multi_pair_item(self, fname: str):
+        """One (sample_data_ta, sample_data_tb, augm_sample_ta, meta) per pair."""
+        pair_sample_datas, meta = self.assemble_multi_pair_sample_datas(fname)
+        items = []
+        for target_key, (sample_data_ta, sample_data_tb) in zip(
+            MULTI_PAIR_TARGET_KEYS, pair_sample_datas
+        ):
+            sample_data_ta = recursive_npy_dict_to_torch(sample_data_ta)
+            if self.cfg.loss.supervised.centermaps.active:
+                sample_data_ta["gt"].update(
+                    self.get_motion_based_centermaps(sample_data_ta)
+                )
+            sample_data_tb = recursive_npy_dict_to_torch(sample_data_tb)
+            if (
+                self.need_reverse_time_sample_data
+                and self.cfg.loss.supervised.centermaps.active
+            ):
+                sample_data_tb["gt"].update(
+                    self.get_motion_based_centermaps(sample_data_tb)
+                )
+            if self.mode == "train":
+                augm_sample_ta = self.create_augmented_sample_from_flow_cluster_detector_and_box_snippet_db(
+                    TIME_DELTA_FROM_T0_S[target_key], sample_data_ta
+                )
+            else:
+                augm_sample_ta = {}
+            items.append((sample_data_ta, sample_data_tb, augm_sample_ta, meta))
+        return tuple(items)
+
     def add_reverse_odometry_to_sample(self, sample_content):
         # add all missing reverse odometries:
         odom_sources = {"gt", self.cfg.data.odom_source}
@@ -1511,7 +1957,7 @@ class LidarDataset(torch.utils.data.Dataset):
         if self.pure_inference_mode:
             target_key = "t1"
 
-        time_delta_between_frames_sec = {"t1": 0.1, "t2": 0.2}[target_key]
+        time_delta_between_frames_sec = TIME_DELTA_FROM_T0_S[target_key]
 
         delete_target_key = delete_map[target_key]
         return src_key, target_key, delete_target_key, time_delta_between_frames_sec
@@ -1540,8 +1986,8 @@ class LidarDataset(torch.utils.data.Dataset):
             low=1, high=self.box_augm_cfg.max_num_objs + 1
         )
 
-        bev_occupancy_bool_map = torch.zeros(tuple(self.img_grid_size_np), dtype=bool)
-        pillar_coors = sample_data_ta["pcl_ta"]["pillar_coors"].long()
+        bev_occupancy_bool_map = np.zeros(tuple(self.img_grid_size_np), dtype=bool)
+        pillar_coors = sample_data_ta["pcl_ta"]["pillar_coors"].long().numpy()
         bev_occupancy_bool_map[
             pillar_coors[:, 0],
             pillar_coors[:, 1],
@@ -1556,26 +2002,52 @@ class LidarDataset(torch.utils.data.Dataset):
         pixel_dilation_radius = int(
             min_obj_center_dist_from_occupied_pillars_m / size_single_pillar_m.mean()
         )
-        footprint = disk(radius=max(3, pixel_dilation_radius))
-        valid_augm_box_loc_mask = ~binary_dilation(
-            bev_occupancy_bool_map.numpy(), footprint=footprint
-        )
-        allowed_box_locs = self.pcl_bev_center_coords_homog_np[valid_augm_box_loc_mask]
-        augm_loc_idxs = np.random.choice(
-            np.arange(allowed_box_locs.shape[0]),
-            size=num_augm_objs,
-            replace=False,
-        )
-        augm_box_locations_xy = torch.from_numpy(allowed_box_locs[augm_loc_idxs][:, :2])
-        augm_box_locations_xy += (
-            0.5 - torch.rand_like(augm_box_locations_xy)
-        ) * size_single_pillar_m
+        min_clearance_any_box_px = max(3, pixel_dilation_radius)
         obj_idxs = np.random.choice(
             np.arange(len(self.box_augm_db["pcl_in_box_cosy"])),
             size=num_augm_objs,
             replace=True,
         )
         box_dims = self.box_augm_db["boxes"][obj_idxs].dims
+        min_clearance_px = np.full(
+            num_augm_objs, min_clearance_any_box_px, dtype=np.float64
+        )
+        if self.box_augm_cfg.setdefault("clearance_from_box_size", True):
+            # the (scaled, rotated) box footprint stays inside the circle of
+            # its half diagonal around the center
+            half_diagonal_m = (
+                0.5
+                * (1.0 + self.box_augm_cfg.max_scale_delta)
+                * np.linalg.norm(box_dims[:, :2].numpy(), axis=-1)
+            )
+            min_clearance_px = np.maximum(
+                min_clearance_px, half_diagonal_m / size_single_pillar_m.mean()
+            )
+        free_space_sampler = FreeSpaceSampler(
+            bev_occupancy_bool_map,
+            np.random.default_rng(np.random.randint(np.iinfo(np.int32).max)),
+            max_clearance_px=min_clearance_px.max(),
+        )
+        augm_loc_pixels = free_space_sampler.sample_placements(min_clearance_px)
+        box_did_not_fit = augm_loc_pixels[:, 0] < 0
+        if box_did_not_fit.any():
+            # place them with the minimum clearance instead
+            augm_loc_pixels[box_did_not_fit] = free_space_sampler.sample_placements(
+                np.full(np.count_nonzero(box_did_not_fit), min_clearance_any_box_px)
+            )
+            box_fits = augm_loc_pixels[:, 0] >= 0
+            assert box_fits.any(), "no free space for augmentation boxes"
+            augm_loc_pixels = augm_loc_pixels[box_fits]
+            obj_idxs = obj_idxs[box_fits]
+            box_dims = self.box_augm_db["boxes"][obj_idxs].dims
+            num_augm_objs = obj_idxs.shape[0]
+        allowed_box_locs = self.pcl_bev_center_coords_homog_np[
+            augm_loc_pixels[:, 0], augm_loc_pixels[:, 1]
+        ]
+        augm_box_locations_xy = torch.from_numpy(allowed_box_locs[:, :2])
+        augm_box_locations_xy += (
+            0.5 - torch.rand_like(augm_box_locations_xy)
+        ) * size_single_pillar_m
         box_z_pos_old = self.box_augm_db["boxes"][obj_idxs].pos[..., [2]]
         box_z_pos_new = 0.5 * (torch.rand((num_augm_objs, 1)) - 0.5) + box_z_pos_old
 
@@ -1912,6 +2384,14 @@ def get_points_in_boxes_mask(
 ) -> Union[np.ndarray, torch.BoolTensor]:
     assert pcl_homog.shape[-1] == 4, pcl_homog.shape
     assert len(pcl_homog.shape) == 2, pcl_homog.shape
+    if not return_pcl_in_box_cosy:
+        # only points near a box are transformed into its frame
+        point_idxs, box_idxs = get_points_in_boxes_sparse(
+            objects, pcl_homog, use_double_precision=use_double_precision
+        )
+        return sparse_points_in_boxes_to_mask(
+            point_idxs, box_idxs, pcl_homog.shape[0], objects.shape[0]
+        )
     sensor_T_box = objects.get_poses()
     if torch.is_tensor(pcl_homog):
         assert use_double_precision, "not implemented for torch"
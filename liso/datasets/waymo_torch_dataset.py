@@ -16,7 +16,7 @@ from liso.datasets.torch_dataset_commons import (
     recursive_npy_dict_to_torch,
     worker_init_fn,
 )
-from liso.jcp.jcp import JPCGroundRemove
+from liso.jcp.ground_label_cache import GroundLabelCache
 from liso.kabsch.shape_utils import Shape
 from liso.utils.torch_transformation import homogenize_pcl
 from tqdm import tqdm
@@ -104,6 +104,9 @@ class WaymoDataset(LidarDataset):
             cfg.data.paths.waymo.ground_segmentation.local
         )
         self.flow_gt_root = Path(cfg.data.paths.waymo.flow_gt.local)
+        self.ground_label_cache = GroundLabelCache(
+            cfg.data.paths.ground_label_cache.local
+        )
         kiss_icp_root = Path(cfg.data.paths.waymo.poses_kiss_icp_kitti_lidar.local)
         self.kiss_icp_poses_path_wo_ext = kiss_icp_root.joinpath(self.mode)
         if self.cfg.data.odom_source == "kiss_icp":
@@ -795,7 +798,7 @@ class WaymoDataset(LidarDataset):
         except (FileNotFoundError, ValueError) as e:
             if isinstance(e, ValueError):
                 print(e)
-            is_ground = JPCGroundRemove(
+            is_ground = self.ground_label_cache.get_is_ground(
                 pcl=pcl[:, :3],
                 range_img_width=2000,
                 range_img_height=60,
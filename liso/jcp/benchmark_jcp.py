@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+import time
+from argparse import ArgumentParser
+from pathlib import Path
+
+import numpy as np
+from liso.jcp import fast_jcp, jcp
+
+
+def create_synthetic_scan(
+    rng: np.random.Generator,
+    num_beams=64,
+    num_azimuths=2083,
+    sensor_height=1.73,
+) -> np.ndarray:
+    # rays hitting a slightly tilted ground plane and a few box shaped obstacles
+    elevation = np.deg2rad(np.linspace(-24.8, 2.0, num_beams))[:, None]
+    azimuth = np.linspace(-np.pi, np.pi, num_azimuths, endpoint=False)[None, :]
+    dirs = np.stack(
+        np.broadcast_arrays(
+            np.cos(elevation) * np.cos(azimuth),
+            np.cos(elevation) * np.sin(azimuth),
+            np.sin(elevation),
+        ),
+        axis=-1,
+    ).reshape(-1, 3)
+    tilt = rng.normal(scale=0.01, size=2)
+    ground_z = -sensor_height
+    denom = dirs[:, 2] - tilt[0] * dirs[:, 0] - tilt[1] * dirs[:, 1]
+    with np.errstate(divide="ignore"):
+        dist = np.where(denom < -1e-3, ground_z / denom, np.inf)
+    for _ in range(rng.integers(10, 30)):
+        center = rng.uniform(-40, 40, size=2)
+        half_size = rng.uniform(0.5, 3.0, size=2)
+        height = rng.uniform(0.5, 4.0)
+        # slab intersection with an axis aligned box standing on the ground
+        box_min = np.array([*(center - half_size), ground_z])
+        box_max = np.array([*(center + half_size), ground_z + height])
+        with np.errstate(divide="ignore", invalid="ignore"):
+            t0 = box_min[None] / dirs
+            t1 = box_max[None] / dirs
+        t_near = np.nanmax(np.minimum(t0, t1), axis=-1)
+        t_far = np.nanmin(np.maximum(t0, t1), axis=-1)
+        hits = (t_near <= t_far) & (t_near > 0)
+        dist = np.where(hits, np.minimum(dist, t_near), dist)
+    valid = np.isfinite(dist) & (dist < 80.0)
+    pcl = dirs[valid] * dist[valid, None]
+    pcl += rng.normal(scale=0.02, size=pcl.shape)
+    return pcl.astype(np.float32)
+
+
+def load_recorded_frames(pcd_dir: Path, num_frames: int):
+    from pypcd4 import PointCloud
+
+    pcd_files = sorted(pcd_dir.glob("*.pcd"))[:num_frames]
+    assert len(pcd_files) > 0, f"no pcd files found in {pcd_dir}"
+    return [PointCloud.from_path(f).numpy()[:, :3] for f in pcd_files]
+
+
+def main():
+    argparser = ArgumentParser(
+        description="Benchmark the JCP ground segmentation engines and check label parity."
+    )
+    argparser.add_argument(
+        "--pcd_dir",
+        type=Path,
+        default=None,
+        help="recorded frames, synthetic scans are used if not given",
+    )
+    argparser.add_argument("--num_frames", type=int, default=32)
+    argparser.add_argument("--batch_size", type=int, default=8)
+    argparser.add_argument("--range_img_width", type=int, default=2083)
+    argparser.add_argument("--range_img_height", type=int, default=64)
+    argparser.add_argument("--sensor_height", type=float, default=1.73)
+    argparser.add_argument("--delta_R", type=float, default=1.0)
+    argparser.add_argument("--seed", type=int, default=0)
+    args = argparser.parse_args()
+
+    if args.pcd_dir is not None:
+        pcls = load_recorded_frames(args.pcd_dir, args.num_frames)
+    else:
+        rng = np.random.default_rng(args.seed)
+        pcls = [
+            create_synthetic_scan(
+                rng,
+                num_beams=args.range_img_height,
+                num_azimuths=args.range_img_width,
+                sensor_height=args.sensor_height,
+            )
+            for _ in range(args.num_frames)
+        ]
+    jcp_kwargs = {
+        "range_img_width": args.range_img_width,
+        "range_img_height": args.range_img_height,
+        "sensor_height": args.sensor_height,
+        "delta_R": args.delta_R,
+    }
+
+    # compile outside of the timed region
+    jcp.JPCGroundRemove(pcl=pcls[0], **jcp_kwargs)
+    fast_jcp.JPCGroundRemove(pcl=pcls[0], **jcp_kwargs)
+    fast_jcp.JPCGroundRemoveBatch(pcls=pcls[:1], **jcp_kwargs)
+
+    start = time.perf_counter()
+    reference_labels = [jcp.JPCGroundRemove(pcl=pcl, **jcp_kwargs) for pcl in pcls]
+    reference_s = time.perf_counter() - start
+
+    start = time.perf_counter()
+    single_labels = [fast_jcp.JPCGroundRemove(pcl=pcl, **jcp_kwargs) for pcl in pcls]
+    single_s = time.perf_counter() - start
+
+    start = time.perf_counter()
+    batch_labels = []
+    for batch_start in range(0, len(pcls), args.batch_size):
+        batch_labels.extend(
+            fast_jcp.JPCGroundRemoveBatch(
+                pcls=pcls[batch_start : batch_start + args.batch_size], **jcp_kwargs
+            )
+        )
+    batch_s = time.perf_counter() - start
+
+    num_points = sum(pcl.shape[0] for pcl in pcls)
+    num_mismatches = 0
+    for reference, single, batch in zip(reference_labels, single_labels, batch_labels):
+        num_mismatches += int(np.count_nonzero(reference != single))
+        num_mismatches += int(np.count_nonzero(reference != batch))
+    print(
+        f"{len(pcls)} frames, {num_points} points, "
+        f"{np.mean(np.concatenate(reference_labels)):.3f} ground fraction"
+    )
+    for name, duration_s in (
+        ("reference", reference_s),
+        ("fast single", single_s),
+        (f"fast batch {args.batch_size}", batch_s),
+    ):
+        print(
+            f"{name:>16}: {1_000 * duration_s / len(pcls):8.2f} ms/frame "
+            f"({reference_s / duration_s:5.1f}x)"
+        )
+    print(f"label mismatches: {num_mismatches}")
+    assert num_mismatches == 0, "fast JCP labels differ from the reference"
+
+
+if __name__ == "__main__":
+    main()
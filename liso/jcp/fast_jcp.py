@@ -0,0 +1,433 @@
+import math
+from typing import List, Sequence, Tuple
+
+import numpy as np
+from numba import njit, prange
+
+# Label image replacing the BGR colour image of liso.jcp.jcp:
+#   black (0, 0, 0) -> LABEL_EMPTY, red (0, 0, 255) -> LABEL_OBSTACLE,
+#   green (0, 255, 0) -> LABEL_GROUND, blue (255, 0, 0) -> LABEL_PENDING.
+# The values of obstacle, ground and pending equal the neighbour mask codes
+# of the JCP voting step, so the label can be used as mask directly.
+LABEL_EMPTY = -1
+LABEL_OBSTACLE = 0
+LABEL_GROUND = 1
+LABEL_PENDING = 2
+# pixel close to an obstacle, turned into LABEL_OBSTACLE after dilation
+_LABEL_OBSTACLE_AFTER_DILATION = 3
+
+MIN_RANGE = 3.0
+MAX_RANGE = 70.0
+TH_G = 0.3
+SIGMA = 7.0
+
+_NEIGHBOR_COL_OFFSETS = np.array(
+    [-2, -1, 0, 1, 2, -2, -1, 0, 1, 2, -2, -1, 1, 2, -2, -1, 0, 1, 2, -2, -1, 0, 1, 2],
+    dtype=np.int64,
+)
+_NEIGHBOR_ROW_OFFSETS = np.array(
+    [-2, -2, -2, -2, -2, -1, -1, -1, -1, -1, 0, 0, 0, 0, 1, 1, 1, 1, 1, 2, 2, 2, 2, 2],
+    dtype=np.int64,
+)
+# 5x5 cv2.MORPH_CROSS without its center
+_DILATION_ROW_OFFSETS = np.array([-2, -1, 1, 2, 0, 0, 0, 0], dtype=np.int64)
+_DILATION_COL_OFFSETS = np.array([0, 0, 0, 0, -2, -1, 1, 2], dtype=np.int64)
+
+
+def get_num_regions(delta_R: float) -> int:
+    return int((MAX_RANGE - MIN_RANGE) / delta_R)
+
+
+def get_range_image_coordinates(
+    pcl: np.ndarray, range_img_width: int, range_img_height: int
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    per_point_col_angle_rad = np.arctan2(pcl[:, 1], pcl[:, 0])
+    per_point_col_angle_rad = np.where(
+        pcl[:, 1] < 0, per_point_col_angle_rad + 2 * np.pi, per_point_col_angle_rad
+    )
+    per_point_range_xy_m = np.linalg.norm(pcl[:, :2], axis=-1)
+
+    arcsin_input = pcl[:, 2] / np.maximum(per_point_range_xy_m, 1e-6)
+    if (np.abs(arcsin_input) > 1.0).any():
+        has_bad_arcsin_input = np.abs(arcsin_input) > 1.0
+        arcsin_input[has_bad_arcsin_input] = np.clip(
+            arcsin_input[has_bad_arcsin_input],
+            a_min=-1.0,
+            a_max=1.0,
+        )
+        if has_bad_arcsin_input.sum() > 0.01 * pcl.shape[0]:
+            print(
+                f"bad arsin input found for more than 0.1 % of points: {has_bad_arcsin_input.sum()} points"
+            )
+
+    elevation_rad = np.arcsin(arcsin_input)
+    valid_eles = np.isfinite(elevation_rad)
+    max_ele = np.max(elevation_rad[valid_eles])
+    min_ele = np.min(elevation_rad[valid_eles])
+    per_point_row_idx = np.clip(
+        (range_img_height * (elevation_rad - min_ele) / (max_ele - min_ele)).astype(
+            np.int32
+        ),
+        a_min=0,
+        a_max=range_img_height - 1,
+    )
+    per_point_col_idx = (
+        (range_img_width - 1) * (per_point_col_angle_rad * 180.0 / np.pi) / 360.0
+    ).astype(np.int32)
+    return per_point_row_idx, per_point_col_idx, per_point_range_xy_m
+
+
+@njit
+def _range_projection(
+    pcl,
+    per_point_row_idx,
+    per_point_col_idx,
+    per_point_range_xy_m,
+    label_img,
+    region_,
+    region_minz_,
+    cloud_index_,
+    delta_R,
+    length_,
+):
+    range_img_height, range_img_width = label_img.shape
+    for i in range(pcl.shape[0]):
+        col = per_point_col_idx[i]
+        range_m = per_point_range_xy_m[i]
+        ind = per_point_row_idx[i]
+        if (
+            (range_m < MIN_RANGE)
+            or (range_m > MAX_RANGE)
+            or (col < 0)
+            or (col > range_img_width)
+            or (ind < 0)
+            or (ind > range_img_height)
+            or (
+                (pcl[i, 0] < 3 and pcl[i, 0] > -2)
+                and (pcl[i, 1] < 1.5 and pcl[i, 1] > -1.5)
+            )
+        ):
+            continue
+
+        region = int((range_m - MIN_RANGE) / delta_R)
+        region_index = col * length_ + region
+        label_img[ind, col] = LABEL_GROUND
+        region_minz_[region_index] = min(region_minz_[region_index], pcl[i, 2])
+        region_[ind, col] = region
+        cloud_index_[col * range_img_height + ind] = i
+
+
+@njit
+def _recm(
+    pcl,
+    label_img,
+    region_,
+    region_minz_,
+    cloud_index_,
+    delta_R,
+    length_,
+    sensor_height,
+):
+    range_img_height, range_img_width = label_img.shape
+    num_regions = range_img_width * length_
+    flag = False
+    for i in range(num_regions):
+        if i % length_ == 0:
+            flag = False
+            region_minz_[i] = min(region_minz_[i], sensor_height + TH_G)
+            continue
+        else:
+            if (i + 1) % length_ == 0:
+                continue
+            if region_minz_[i] == 100 and not flag:
+                region_minz_[i] = sensor_height + TH_G
+                continue
+            if region_minz_[i] == 100 and flag:
+                region_minz_[i] = region_minz_[i - 1]
+            flag = True
+            if (
+                abs(region_minz_[i] - region_minz_[i - 1]) > 0.5
+                and abs(region_minz_[i] - region_minz_[i + 1]) > 0.5
+            ):
+                region_minz_[i] = (region_minz_[i - 1] + region_minz_[i + 1]) / 2
+
+    pre_th = 0.0
+    for i in range(num_regions):
+        if i % length_ == 0:
+            pre_th = min(region_minz_[i], float(sensor_height))
+        else:
+            region_minz_[i] = min(
+                region_minz_[i], pre_th + delta_R * math.tan(SIGMA * np.pi / 180)
+            )
+            pre_th = region_minz_[i]
+
+    for i in range(range_img_width):
+        for j in range(range_img_height):
+            pt_idx = cloud_index_[i * range_img_height + j]
+            if pt_idx == -1:
+                continue
+            th_height = region_minz_[i * length_ + region_[j, i]]
+            if pcl[pt_idx, 2] >= (th_height + TH_G):
+                label_img[j, i] = LABEL_OBSTACLE
+
+
+@njit
+def _mark_pending(label_img, cloud_index_):
+    # equivalent of dilating the obstacle channel with a 5x5 cross and
+    # selecting ground pixels that now overlap the dilated obstacles
+    range_img_height, range_img_width = label_img.shape
+    for row in range(range_img_height):
+        for col in range(range_img_width):
+            if label_img[row, col] != LABEL_GROUND:
+                continue
+            for k in range(_DILATION_ROW_OFFSETS.shape[0]):
+                nrow = row + _DILATION_ROW_OFFSETS[k]
+                ncol = col + _DILATION_COL_OFFSETS[k]
+                if (
+                    nrow < 0
+                    or nrow >= range_img_height
+                    or ncol < 0
+                    or ncol >= range_img_width
+                ):
+                    continue
+                if label_img[nrow, ncol] == LABEL_OBSTACLE:
+                    # row * height + col mirrors the (row major) lookup
+                    # of the reference implementation, keep for label parity
+                    if cloud_index_[row * range_img_height + col] != -1:
+                        label_img[row, col] = LABEL_PENDING
+                    else:
+                        label_img[row, col] = _LABEL_OBSTACLE_AFTER_DILATION
+                    break
+    for row in range(range_img_height):
+        for col in range(range_img_width):
+            if label_img[row, col] == _LABEL_OBSTACLE_AFTER_DILATION:
+                label_img[row, col] = LABEL_OBSTACLE
+
+
+@njit
+def _jcp_vote(pcl, label_img, cloud_index_, diff_, weights_, mask_):
+    # Pending pixels are decided in row major order and every vote sees the
+    # labels of the pixels decided before it, so this pass stays sequential.
+    range_img_height, range_img_width = label_img.shape
+    num_neighbors = _NEIGHBOR_ROW_OFFSETS.shape[0]
+    for row in range(range_img_height):
+        for col in range(range_img_width):
+            if label_img[row, col] != LABEL_PENDING:
+                continue
+            pt_idx = cloud_index_[col * range_img_height + row]
+            sum_weights = 0.0
+            for i in range(num_neighbors):
+                nx = _NEIGHBOR_COL_OFFSETS[i] + col
+                ny = _NEIGHBOR_ROW_OFFSETS[i] + row
+                weights_[i] = 0.0
+                mask_[i] = -1
+                if nx < 0 or nx >= range_img_width or ny < 0 or ny >= range_img_height:
+                    continue
+                npt_idx = cloud_index_[nx * range_img_height + ny]
+                if npt_idx == -1:
+                    continue
+                for k in range(3):
+                    diff_[k] = pcl[pt_idx, k] - pcl[npt_idx, k]
+                range_diff = np.linalg.norm(diff_)
+                if range_diff <= 3:
+                    weights_[i] = math.exp(-5 * range_diff)
+                    sum_weights += weights_[i]
+                mask_[i] = label_img[ny, nx]
+
+            normalizer = max(sum_weights, 1e-6)
+            score_r = 0.0
+            score_g = 0.0
+            for i in range(num_neighbors):
+                if mask_[i] == LABEL_OBSTACLE:
+                    score_r += weights_[i] / normalizer
+                elif mask_[i] == LABEL_GROUND:
+                    score_g += weights_[i] / normalizer
+
+            if score_r > score_g:
+                label_img[row, col] = LABEL_OBSTACLE
+            else:
+                label_img[row, col] = LABEL_GROUND
+
+
+@njit
+def _jcp_frame(
+    pcl,
+    per_point_row_idx,
+    per_point_col_idx,
+    per_point_range_xy_m,
+    label_img,
+    region_,
+    region_minz_,
+    cloud_index_,
+    diff_,
+    weights_,
+    mask_,
+    is_ground,
+    delta_R,
+    length_,
+    sensor_height,
+):
+    label_img[:] = LABEL_EMPTY
+    region_[:] = 0
+    region_minz_[:] = 100.0
+    cloud_index_[:] = -1
+
+    _range_projection(
+        pcl,
+        per_point_row_idx,
+        per_point_col_idx,
+        per_point_range_xy_m,
+        label_img,
+        region_,
+        region_minz_,
+        cloud_index_,
+        delta_R,
+        length_,
+    )
+    _recm(
+        pcl,
+        label_img,
+        region_,
+        region_minz_,
+        cloud_index_,
+        delta_R,
+        length_,
+        sensor_height,
+    )
+    _mark_pending(label_img, cloud_index_)
+    _jcp_vote(pcl, label_img, cloud_index_, diff_, weights_, mask_)
+
+    for i in range(pcl.shape[0]):
+        is_ground[i] = (
+            label_img[per_point_row_idx[i], per_point_col_idx[i]] == LABEL_GROUND
+        )
+
+
+@njit(parallel=True)
+def _jcp_batch(
+    pcl,
+    point_offsets,
+    per_point_row_idx,
+    per_point_col_idx,
+    per_point_range_xy_m,
+    label_imgs,
+    regions,
+    region_minzs,
+    cloud_indices,
+    diffs,
+    weights,
+    masks,
+    is_ground,
+    delta_R,
+    length_,
+    sensor_height,
+):
+    for b in prange(point_offsets.shape[0] - 1):
+        start = point_offsets[b]
+        stop = point_offsets[b + 1]
+        _jcp_frame(
+            pcl[start:stop],
+            per_point_row_idx[start:stop],
+            per_point_col_idx[start:stop],
+            per_point_range_xy_m[start:stop],
+            label_imgs[b],
+            regions[b],
+            region_minzs[b],
+            cloud_indices[b],
+            diffs[b],
+            weights[b],
+            masks[b],
+            is_ground[start:stop],
+            delta_R,
+            length_,
+            sensor_height,
+        )
+
+
+def JPCGroundRemoveBatch(
+    *,
+    pcls: Sequence[np.ndarray],
+    range_img_width: int,
+    range_img_height: int,
+    sensor_height: float,
+    delta_R: float,
+) -> List[np.ndarray]:
+    """Label-identical to liso.jcp.jcp.JPCGroundRemove, for several point clouds.
+
+    Frames are segmented in parallel (numba prange), each with its own
+    preallocated label image and scratch buffers. Processes that fork workers
+    after a call should use the workqueue or omp threading layer of numba
+    (NUMBA_THREADING_LAYER), with tbb they may hang at exit.
+    """
+    assert len(pcls) > 0
+    for pcl in pcls:
+        assert pcl.shape[-1] == 3, pcl.shape
+    length_ = get_num_regions(delta_R)
+    batch_size = len(pcls)
+    point_offsets = np.cumsum([0] + [pcl.shape[0] for pcl in pcls]).astype(np.int64)
+
+    row_idxs, col_idxs, ranges_xy = zip(
+        *(
+            get_range_image_coordinates(pcl, range_img_width, range_img_height)
+            for pcl in pcls
+        )
+    )
+    pcl = np.concatenate(pcls, axis=0)
+    is_ground = np.zeros(pcl.shape[0], dtype=bool)
+    _jcp_batch(
+        pcl,
+        point_offsets,
+        np.concatenate(row_idxs),
+        np.concatenate(col_idxs),
+        np.concatenate(ranges_xy),
+        np.empty((batch_size, range_img_height, range_img_width), dtype=np.int8),
+        np.empty((batch_size, range_img_height, range_img_width), dtype=np.uint8),
+        # one spare region: points at exactly max range index one past a column
+        np.empty((batch_size, range_img_width * length_ + 1), dtype=np.float64),
+        np.empty((batch_size, range_img_width * range_img_height), dtype=np.int64),
+        np.empty((batch_size, 3), dtype=pcl.dtype),
+        np.empty((batch_size, _NEIGHBOR_ROW_OFFSETS.shape[0]), dtype=np.float64),
+        np.empty((batch_size, _NEIGHBOR_ROW_OFFSETS.shape[0]), dtype=np.int8),
+        is_ground,
+        delta_R,
+        length_,
+        sensor_height,
+    )
+    return np.split(is_ground, point_offsets[1:-1])
+
+
+def JPCGroundRemove(
+    *,
+    pcl: np.ndarray,
+    range_img_width: int,
+    range_img_height: int,
+    sensor_height: float,
+    delta_R: float,
+) -> np.ndarray:
+    assert pcl.shape[-1] == 3, pcl.shape
+    length_ = get_num_regions(delta_R)
+    (
+        per_point_row_idx,
+        per_point_col_idx,
+        per_point_range_xy_m,
+    ) = get_range_image_coordinates(pcl, range_img_width, range_img_height)
+    is_ground = np.zeros(pcl.shape[0], dtype=bool)
+    # single frame: serial kernel, callers already parallelize across processes
+    _jcp_frame(
+        pcl,
+        per_point_row_idx,
+        per_point_col_idx,
+        per_point_range_xy_m,
+        np.empty((range_img_height, range_img_width), dtype=np.int8),
+        np.empty((range_img_height, range_img_width), dtype=np.uint8),
+        np.empty(range_img_width * length_ + 1, dtype=np.float64),
+        np.empty(range_img_width * range_img_height, dtype=np.int64),
+        np.empty(3, dtype=pcl.dtype),
+        np.empty(_NEIGHBOR_ROW_OFFSETS.shape[0], dtype=np.float64),
+        np.empty(_NEIGHBOR_ROW_OFFSETS.shape[0], dtype=np.int8),
+        is_ground,
+        delta_R,
+        length_,
+        sensor_height,
+    )
+    return is_ground
@@ -0,0 +1,87 @@
+import hashlib
+import json
+from pathlib import Path
+from typing import Optional, Union
+
+import numpy as np
+from liso.jcp.fast_jcp import JPCGroundRemove
+from liso.utils.file_utils import atomic_save_npy
+
+
+def get_ground_label_key(
+    pcl: np.ndarray,
+    *,
+    range_img_width: int,
+    range_img_height: int,
+    sensor_height: float,
+    delta_R: float,
+) -> str:
+    jcp_params = {
+        "range_img_width": int(range_img_width),
+        "range_img_height": int(range_img_height),
+        "sensor_height": float(sensor_height),
+        "delta_R": float(delta_R),
+    }
+    pcl = np.ascontiguousarray(pcl)
+    key = hashlib.sha256()
+    key.update(json.dumps(jcp_params, sort_keys=True).encode("utf-8"))
+    key.update(f"{pcl.dtype.str}{pcl.shape}".encode("utf-8"))
+    key.update(pcl.data)
+    return key.hexdigest()
+
+
+class GroundLabelCache:
+    """Persistent JCP ground labels, addressed by point buffer and JCP parameters.
+
+    Labels are stored as packed bits in <cache_dir>/<key[:2]>/<key>.npy.
+    Files are written atomically, so any number of preprocessing or
+    dataloader processes may share one cache directory. Racing writers
+    store identical labels, the last rename wins.
+    Without a cache_dir, labels are computed on every call.
+    """
+
+    def __init__(self, cache_dir: Optional[Union[Path, str]] = None):
+        self.cache_dir = None if cache_dir is None else Path(cache_dir)
+
+    def get_cache_file(self, key: str) -> Path:
+        return self.cache_dir / key[:2] / f"{key}.npy"
+
+    def load(self, key: str, num_points: int) -> Optional[np.ndarray]:
+        try:
+            packed_is_ground = np.load(self.get_cache_file(key), allow_pickle=False)
+        except (FileNotFoundError, ValueError):
+            return None
+        if packed_is_ground.shape != ((num_points + 7) // 8,):
+            return None
+        return np.unpackbits(packed_is_ground, count=num_points).astype(bool)
+
+    def save(self, key: str, is_ground: np.ndarray) -> None:
+        cache_file = self.get_cache_file(key)
+        cache_file.parent.mkdir(parents=True, exist_ok=True)
+        atomic_save_npy(cache_file, np.packbits(is_ground), allow_pickle=False)
+
+    def get_is_ground(
+        self,
+        *,
+        pcl: np.ndarray,
+        range_img_width: int,
+        range_img_height: int,
+        sensor_height: float,
+        delta_R: float,
+    ) -> np.ndarray:
+        """Drop-in replacement for JPCGroundRemove."""
+        jcp_params = {
+            "range_img_width": range_img_width,
+            "range_img_height": range_img_height,
+            "sensor_height": sensor_height,
+            "delta_R": delta_R,
+        }
+        if self.cache_dir is None:
+            return JPCGroundRemove(pcl=pcl, **jcp_params)
+
+        key = get_ground_label_key(pcl, **jcp_params)
+        is_ground = self.load(key, pcl.shape[0])
+        if is_ground is None:
+            is_ground = JPCGroundRemove(pcl=pcl, **jcp_params)
+            self.save(key, is_ground)
+        return is_ground
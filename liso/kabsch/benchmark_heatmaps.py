@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+import time
+from argparse import ArgumentParser
+
+import numpy as np
+from liso.kabsch.kabsch_mask import (
+    batched_render_gaussian_kabsch_mask,
+    render_gaussian_kabsch_mask_windows,
+)
+
+
+def main():
+    argparser = ArgumentParser(
+        description="Benchmark windowed against full grid Gaussian box heatmaps."
+    )
+    argparser.add_argument("--num_samples", type=int, default=8)
+    argparser.add_argument("--num_boxes", type=int, default=40)
+    argparser.add_argument("--img_size", type=int, default=512)
+    argparser.add_argument("--bev_range_m", type=float, default=100.0)
+    argparser.add_argument("--seed", type=int, default=0)
+    args = argparser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    img_shape = np.array([args.img_size, args.img_size])
+    full_s = 0.0
+    windowed_s = 0.0
+    max_abs_diff = 0.0
+    num_window_pixels = 0
+    for _ in range(args.num_samples):
+        # boxes are allowed to stick out of the BEV range
+        box_kwargs = {
+            "box_x": rng.uniform(-0.6, 0.6, args.num_boxes) * args.bev_range_m,
+            "box_y": rng.uniform(-0.6, 0.6, args.num_boxes) * args.bev_range_m,
+            "box_len": rng.uniform(0.5, 12.0, args.num_boxes),
+            "box_w": rng.uniform(0.5, 3.0, args.num_boxes),
+            "box_theta": rng.uniform(-np.pi, np.pi, args.num_boxes),
+            "bev_range_x": args.bev_range_m,
+            "bev_range_y": args.bev_range_m,
+            "img_shape": img_shape,
+        }
+        # the full grid renderer takes boxes of shape [batch, num_boxes]
+        batched_box_kwargs = {
+            k: v[None] if k.startswith("box_") else v for k, v in box_kwargs.items()
+        }
+        for normalize_gaussian in (False, True):
+            start = time.perf_counter()
+            full = batched_render_gaussian_kabsch_mask(
+                **batched_box_kwargs, normalize_gaussian=normalize_gaussian
+            )[0]
+            full_s += time.perf_counter() - start
+
+            start = time.perf_counter()
+            windows = list(
+                render_gaussian_kabsch_mask_windows(
+                    **box_kwargs, normalize_gaussian=normalize_gaussian
+                )
+            )
+            windowed_s += time.perf_counter() - start
+
+            for box_idx, (rows, cols, weight) in enumerate(windows):
+                num_window_pixels += weight.size
+                box_heatmap = np.zeros(tuple(img_shape))
+                box_heatmap[rows, cols] = weight
+                max_abs_diff = max(
+                    max_abs_diff, np.abs(box_heatmap - full[box_idx]).max()
+                )
+
+    num_renders = 2 * args.num_samples
+    print(
+        f"{args.num_boxes} boxes on {args.img_size}x{args.img_size}: "
+        f"{num_window_pixels / (num_renders * args.num_boxes):.0f} pixels per window"
+    )
+    for name, duration_s in (("full grid", full_s), ("windowed", windowed_s)):
+        print(
+            f"{name:>10}: {1_000 * duration_s / num_renders:8.2f} ms/sample "
+            f"({full_s / duration_s:5.1f}x)"
+        )
+    print(f"max abs weight difference: {max_abs_diff:.2e}")
+    assert max_abs_diff <= 1e-6, "windowed heatmaps differ from the full grid"
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+import time
+from argparse import ArgumentParser
+
+import numpy as np
+import torch
+from liso.kabsch.kabsch_mask import (
+    render_hard_kabsch_mask,
+    render_hard_kabsch_masks_batched,
+    render_hard_kabsch_masks_batched_torch,
+)
+
+
+def main():
+    argparser = ArgumentParser(
+        description="Benchmark batched against per box hard ignore region masks."
+    )
+    argparser.add_argument("--num_samples", type=int, default=8)
+    argparser.add_argument("--num_boxes", type=int, default=30)
+    argparser.add_argument("--img_size", type=int, default=640)
+    argparser.add_argument("--bev_range_m", type=float, default=100.0)
+    argparser.add_argument("--device", default="cpu")
+    argparser.add_argument("--seed", type=int, default=0)
+    args = argparser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    img_shape = np.array([args.img_size, args.img_size])
+    durations_s = {"per box": 0.0, "batched": 0.0, "batched torch": 0.0}
+    num_torch_mismatches = 0
+    for _ in range(args.num_samples):
+        # boxes are allowed to stick out of the BEV range
+        box_kwargs = {
+            "box_x": rng.uniform(-0.6, 0.6, args.num_boxes) * args.bev_range_m,
+            "box_y": rng.uniform(-0.6, 0.6, args.num_boxes) * args.bev_range_m,
+            "box_len": rng.uniform(0.5, 20.0, args.num_boxes),
+            "box_w": rng.uniform(0.5, 8.0, args.num_boxes),
+            "box_theta": rng.uniform(-np.pi, np.pi, args.num_boxes),
+        }
+        box_kwargs = {k: v.astype(np.float32) for k, v in box_kwargs.items()}
+        grid_kwargs = {
+            "bev_range_x": args.bev_range_m,
+            "bev_range_y": args.bev_range_m,
+            "img_shape": img_shape,
+        }
+
+        start = time.perf_counter()
+        per_box = np.zeros(tuple(img_shape), dtype=bool)
+        for box_idx in range(args.num_boxes):
+            box_mask, _ = render_hard_kabsch_mask(
+                **{k: v[box_idx] for k, v in box_kwargs.items()}, **grid_kwargs
+            )
+            per_box = per_box | (box_mask > 0.5)
+        durations_s["per box"] += time.perf_counter() - start
+
+        start = time.perf_counter()
+        batched = render_hard_kabsch_masks_batched(**box_kwargs, **grid_kwargs)
+        durations_s["batched"] += time.perf_counter() - start
+        assert np.array_equal(per_box, batched), "batched mask differs"
+
+        torch_box_kwargs = {
+            k: torch.from_numpy(v).to(args.device) for k, v in box_kwargs.items()
+        }
+        start = time.perf_counter()
+        batched_torch = render_hard_kabsch_masks_batched_torch(
+            **torch_box_kwargs, **grid_kwargs
+        )
+        if args.device != "cpu":
+            torch.cuda.synchronize()
+        durations_s["batched torch"] += time.perf_counter() - start
+        # sin/cos may differ in the last bit between numpy and torch
+        num_torch_mismatches += np.count_nonzero(batched_torch.cpu().numpy() != per_box)
+
+    print(f"{args.num_boxes} boxes on {args.img_size}x{args.img_size}:")
+    for name, duration_s in durations_s.items():
+        print(
+            f"{name:>13}: {1_000 * duration_s / args.num_samples:8.2f} ms/sample "
+            f"({durations_s['per box'] / duration_s:5.1f}x)"
+        )
+    print(f"pixels differing in torch: {num_torch_mismatches}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+import time
+from argparse import ArgumentParser
+
+import numpy as np
+import torch
+from liso.kabsch.points_in_boxes import (
+    get_points_in_boxes_sparse,
+    sparse_points_in_boxes_to_mask,
+)
+from liso.kabsch.shape_utils import Shape
+
+
+def get_random_boxes_and_points(rng, num_boxes, num_points, range_m):
+    boxes = Shape(
+        pos=np.concatenate(
+            [
+                rng.uniform(-range_m, range_m, (num_boxes, 2)),
+                rng.uniform(-1.0, 1.0, (num_boxes, 1)),
+            ],
+            axis=-1,
+        ).astype(np.float32),
+        dims=np.stack(
+            [
+                rng.uniform(0.5, 12.0, num_boxes),
+                rng.uniform(0.5, 3.0, num_boxes),
+                rng.uniform(1.0, 4.0, num_boxes),
+            ],
+            axis=-1,
+        ).astype(np.float32),
+        rot=rng.uniform(-np.pi, np.pi, (num_boxes, 1)).astype(np.float32),
+        probs=np.ones((num_boxes, 1), dtype=np.float32),
+    )
+    # lidar like density: dense close to the sensor, plus a share inside boxes
+    dist_m = range_m * rng.uniform(0.0, 1.0, num_points) ** 2
+    angle = rng.uniform(-np.pi, np.pi, num_points)
+    pcl = np.stack(
+        [
+            dist_m * np.cos(angle),
+            dist_m * np.sin(angle),
+            rng.uniform(-2.0, 2.0, num_points),
+        ],
+        axis=-1,
+    ).astype(np.float32)
+    point_is_near_box = rng.uniform(0.0, 1.0, num_points) < 0.2
+    near_box_idxs = rng.integers(0, num_boxes, np.count_nonzero(point_is_near_box))
+    pcl[point_is_near_box] = boxes.pos[near_box_idxs] + rng.uniform(
+        -0.5, 0.5, (near_box_idxs.shape[0], 3)
+    ).astype(np.float32) * np.array([12.0, 3.0, 4.0], dtype=np.float32)
+    return boxes, pcl
+
+
+def main():
+    argparser = ArgumentParser(
+        description="Benchmark grid indexed sparse against dense points-in-boxes."
+    )
+    argparser.add_argument("--num_samples", type=int, default=5)
+    argparser.add_argument("--num_points", type=int, default=150_000)
+    argparser.add_argument("--num_boxes", type=int, default=200)
+    argparser.add_argument("--range_m", type=float, default=60.0)
+    argparser.add_argument("--device", default="cpu")
+    argparser.add_argument("--seed", type=int, default=0)
+    args = argparser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    durations_s = {}
+    num_pairs = 0
+    for _ in range(args.num_samples):
+        boxes, pcl = get_random_boxes_and_points(
+            rng, args.num_boxes, args.num_points, args.range_m
+        )
+        torch_boxes = boxes.to_tensor().to(torch.device(args.device))
+        torch_pcl = torch.from_numpy(pcl).to(args.device)
+        for name, use_torch in (("numpy", False), ("torch", True)):
+            sample_boxes, sample_pcl = (
+                (torch_boxes, torch_pcl) if use_torch else (boxes, pcl)
+            )
+            start = time.perf_counter()
+            dense = sample_boxes.get_points_in_box_bool_mask(sample_pcl)
+            if use_torch and args.device != "cpu":
+                torch.cuda.synchronize()
+            durations_s[f"{name} dense"] = durations_s.get(f"{name} dense", 0.0) + (
+                time.perf_counter() - start
+            )
+
+            start = time.perf_counter()
+            # the dense torch reference transforms in single precision
+            point_idxs, box_idxs = get_points_in_boxes_sparse(
+                sample_boxes, sample_pcl, use_double_precision=not use_torch
+            )
+            if use_torch and args.device != "cpu":
+                torch.cuda.synchronize()
+            durations_s[f"{name} sparse"] = durations_s.get(f"{name} sparse", 0.0) + (
+                time.perf_counter() - start
+            )
+
+            sparse = sparse_points_in_boxes_to_mask(
+                point_idxs, box_idxs, args.num_points, args.num_boxes
+            )
+            if use_torch:
+                dense, sparse = dense.cpu().numpy(), sparse.cpu().numpy()
+            assert np.array_equal(dense, sparse), f"{name}: sparse differs from dense"
+            num_pairs += point_idxs.shape[0]
+
+    print(
+        f"{args.num_points} points x {args.num_boxes} boxes: "
+        f"{num_pairs / (2 * args.num_samples):.0f} points in boxes per sample"
+    )
+    for name in ("numpy", "torch"):
+        dense_s = durations_s[f"{name} dense"]
+        for variant in ("dense", "sparse"):
+            duration_s = durations_s[f"{name} {variant}"]
+            print(
+                f"{name + ' ' + variant:>13}: "
+                f"{1_000 * duration_s / args.num_samples:8.2f} ms/sample "
+                f"({dense_s / duration_s:5.1f}x)"
+            )
+
+
+if __name__ == "__main__":
+    main()
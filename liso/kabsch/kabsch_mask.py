@@ -1,4 +1,4 @@
-from typing import Tuple
+from typing import Iterator, Tuple
 
 import numpy as np
 import torch
@@ -6,13 +6,20 @@ from liso.kabsch.mask_fusing import fuse_masks_screen
 from liso.kabsch.shape_utils import Shape
 from liso.torch_symm_ortho import symmetric_orthogonalization
 from liso.transformations.transformations import compose_matrix
-from liso.utils.bev_utils import get_bev_setup_params, get_metric_voxel_center_coords
+from liso.utils.bev_utils import (
+    get_bev_setup_params,
+    get_metric_voxel_center_axes,
+    get_metric_voxel_center_coords,
+)
 from liso.utils.torch_transformation import (
     homogenize_pcl,
     numpy_compose_matrix,
     torch_compose_matrix,
 )
 
+# covers rounding of the box footprint when windowing hard box masks
+WINDOW_MARGIN_M = 1e-3
+
 
 def map_nan_padding_to_zeros(batched_points, valid_mask):
     batched_points[~valid_mask] = 0.0
@@ -91,6 +98,21 @@ def batched_render_gaussian_kabsch_mask(
     pos = get_metric_voxel_center_coords(
         bev_range_x=bev_range_x, bev_range_y=bev_range_y, dataset_img_shape=img_shape
     )[..., 0:2]
+    mu, cov = get_gaussian_kabsch_mask_params(
+        box_x=box_x, box_y=box_y, box_len=box_len, box_w=box_w, box_theta=box_theta
+    )
+
+    weight = batched_multivariate_gaussian(
+        pos[None, None, ...], mu, cov, normalize=normalize_gaussian
+    )
+    if not normalize_gaussian:
+        # TODO: this seems like a bug: we normalize if normalize_gaussian == False
+        weight_max = weight.max(axis=(-1, -2), keepdims=True)
+        weight = weight / np.maximum(weight_max, 1e-5)
+    return weight
+
+
+def get_gaussian_kabsch_mask_params(*, box_x, box_y, box_len, box_w, box_theta):
     mu = np.stack([box_x, box_y], axis=-1)
     # 95% of points should lie in mask
     cov_top_row = np.stack([box_len, np.zeros_like(box_len)], axis=-1)
@@ -105,15 +127,68 @@ def batched_render_gaussian_kabsch_mask(
         "...ij, ...jk", np.einsum("...ij, ...jk", rot_mat, cov), np.linalg.inv(rot_mat)
     )
     # cov = cov @ rot_mat.T
+    return mu, cov
 
-    weight = batched_multivariate_gaussian(
-        pos[None, None, ...], mu, cov, normalize=normalize_gaussian
+
+def render_gaussian_kabsch_mask_windows(
+    *,
+    box_x,
+    box_y,
+    box_len,
+    box_w,
+    box_theta,
+    bev_range_x,
+    bev_range_y,
+    img_shape,
+    normalize_gaussian=True,
+    max_dropped_weight=1e-6,
+) -> Iterator[Tuple[slice, slice, np.ndarray]]:
+    """Sparse batched_render_gaussian_kabsch_mask for boxes of shape [num_boxes].
+
+    Yields rows, cols, weight per box: its weights on the grid window
+    img[rows, cols] around the box, outside of which all weights are below
+    max_dropped_weight. Instead of num_boxes x H x W, only the windows are
+    evaluated, which are a few meters wide.
+    """
+    row_coords, col_coords = get_metric_voxel_center_axes(
+        bev_range_x=bev_range_x, bev_range_y=bev_range_y, dataset_img_shape=img_shape
     )
-    if not normalize_gaussian:
-        # TODO: this seems like a bug: we normalize if normalize_gaussian == False
-        weight_max = weight.max(axis=(-1, -2), keepdims=True)
-        weight = weight / np.maximum(weight_max, 1e-5)
-    return weight
+    mu, cov = get_gaussian_kabsch_mask_params(
+        box_x=box_x[None],
+        box_y=box_y[None],
+        box_len=box_len[None],
+        box_w=box_w[None],
+        box_theta=box_theta[None],
+    )
+    mu, cov = mu[0], cov[0]
+    sigma_inv = np.linalg.inv(cov)
+    if normalize_gaussian:
+        norm = np.sqrt((2 * np.pi) ** 2 * np.linalg.det(cov))
+        # outside of the window: exp(-fac / 2) / norm < max_dropped_weight
+        max_fac = 2.0 * np.log(1.0 / np.maximum(max_dropped_weight * norm, 1e-300))
+    else:
+        norm = np.ones(len(mu))
+        # weights are divided by at most 1e-5 below
+        max_fac = np.full(len(mu), 2.0 * np.log(1.0 / (1e-5 * max_dropped_weight)))
+    # axis aligned bounding box of the ellipse fac <= max_fac
+    half_extent = np.sqrt(np.maximum(max_fac, 0.0)[:, None] * cov[:, [0, 1], [0, 1]])
+    rows_lo = np.searchsorted(row_coords, mu[:, 0] - half_extent[:, 0])
+    rows_hi = np.searchsorted(row_coords, mu[:, 0] + half_extent[:, 0], side="right")
+    cols_lo = np.searchsorted(col_coords, mu[:, 1] - half_extent[:, 1])
+    cols_hi = np.searchsorted(col_coords, mu[:, 1] + half_extent[:, 1], side="right")
+    for box_idx in range(len(mu)):
+        rows = slice(rows_lo[box_idx], max(rows_lo[box_idx], rows_hi[box_idx]))
+        cols = slice(cols_lo[box_idx], max(cols_lo[box_idx], cols_hi[box_idx]))
+        pos = np.stack(
+            np.meshgrid(row_coords[rows], col_coords[cols], indexing="ij"), axis=-1
+        )
+        delta = pos - mu[box_idx]
+        fac = np.einsum("...k,kl,...l->...", delta, sigma_inv[box_idx], delta)
+        weight = np.exp(-fac / 2) / norm[box_idx]
+        if not normalize_gaussian and weight.size > 0:
+            # the grid maximum lies inside the window unless it is negligible
+            weight = weight / np.maximum(weight.max(), 1e-5)
+        yield rows, cols, weight
 
 
 def render_hard_kabsch_mask(
@@ -146,6 +221,159 @@ def render_hard_kabsch_mask(
     return weight, pcl_s[..., 0:2]
 
 
+def render_hard_kabsch_masks_batched(
+    *,
+    box_x,
+    box_y,
+    box_len,
+    box_w,
+    box_theta,
+    bev_range_x,
+    bev_range_y,
+    img_shape,
+):
+    """Union of the render_hard_kabsch_mask of all boxes of shape [..., num_boxes].
+
+    Returns a bool mask of shape [..., H, W]. Every box is only tested on the
+    pixels of the axis aligned window around its footprint, the windows of all
+    boxes are tested at once. Non finite boxes are skipped.
+    """
+    batch_shape = box_x.shape[:-1]
+    img_shape = (int(img_shape[0]), int(img_shape[1]))
+    box_params = np.stack([box_x, box_y, box_len, box_w, box_theta], axis=-1)
+    box_params = box_params.reshape(-1, 5).astype(np.float64)
+    box_batch_idx = np.arange(box_params.shape[0]) // max(box_x.shape[-1], 1)
+    box_is_finite = np.isfinite(box_params).all(axis=-1)
+    box_params, box_batch_idx = box_params[box_is_finite], box_batch_idx[box_is_finite]
+    mask = np.zeros((int(np.prod(batch_shape)),) + img_shape, dtype=bool)
+    if box_params.shape[0] == 0:
+        return mask.reshape(batch_shape + img_shape)
+    box_x, box_y, box_len, box_w, box_theta = box_params.T
+
+    row_coords, col_coords = get_metric_voxel_center_axes(
+        bev_range_x=bev_range_x, bev_range_y=bev_range_y, dataset_img_shape=img_shape
+    )
+    abs_cos, abs_sin = np.abs(np.cos(box_theta)), np.abs(np.sin(box_theta))
+    half_extent_x = 0.5 * (abs_cos * box_len + abs_sin * box_w) + WINDOW_MARGIN_M
+    half_extent_y = 0.5 * (abs_sin * box_len + abs_cos * box_w) + WINDOW_MARGIN_M
+    rows_lo = np.searchsorted(row_coords, box_x - half_extent_x)
+    rows_hi = np.searchsorted(row_coords, box_x + half_extent_x, side="right")
+    cols_lo = np.searchsorted(col_coords, box_y - half_extent_y)
+    cols_hi = np.searchsorted(col_coords, box_y + half_extent_y, side="right")
+    num_rows, num_cols = rows_hi - rows_lo, cols_hi - cols_lo
+    num_pixels = num_rows * num_cols
+
+    # flat list of (box, pixel) candidates over all windows
+    pix_box = np.repeat(np.arange(box_x.shape[0]), num_pixels)
+    pix_in_window = np.arange(pix_box.shape[0]) - np.repeat(
+        np.cumsum(num_pixels) - num_pixels, num_pixels
+    )
+    rows = rows_lo[pix_box] + pix_in_window // num_cols[pix_box]
+    cols = cols_lo[pix_box] + pix_in_window % num_cols[pix_box]
+
+    # same transform and inside test as render_hard_kabsch_mask
+    s_T_box = numpy_compose_matrix(
+        t_x=box_x[None], t_y=box_y[None], theta_z=box_theta[None]
+    )[0]
+    box_T_s = np.linalg.inv(s_T_box)[pix_box]
+    pix_x, pix_y = row_coords[rows], col_coords[cols]
+    pix_in_box_x, pix_in_box_y = (
+        box_T_s[:, i, 0] * pix_x + box_T_s[:, i, 1] * pix_y + box_T_s[:, i, 3]
+        for i in (0, 1)
+    )
+    half_len, half_w = box_len[pix_box] / 2.0, box_w[pix_box] / 2.0
+    is_in = (
+        (-half_len < pix_in_box_x)
+        & (pix_in_box_x < half_len)
+        & (-half_w < pix_in_box_y)
+        & (pix_in_box_y < half_w)
+    )
+    mask[box_batch_idx[pix_box[is_in]], rows[is_in], cols[is_in]] = True
+    return mask.reshape(batch_shape + img_shape)
+
+
+def render_hard_kabsch_masks_batched_torch(
+    *,
+    box_x,
+    box_y,
+    box_len,
+    box_w,
+    box_theta,
+    bev_range_x,
+    bev_range_y,
+    img_shape,
+):
+    """Torch version of render_hard_kabsch_masks_batched, on the device of box_x."""
+    device = box_x.device
+    batch_shape = tuple(box_x.shape[:-1])
+    img_shape = (int(img_shape[0]), int(img_shape[1]))
+    box_params = torch.stack([box_x, box_y, box_len, box_w, box_theta], dim=-1)
+    box_params = box_params.reshape(-1, 5).to(torch.double)
+    box_batch_idx = torch.div(
+        torch.arange(box_params.shape[0], device=device),
+        max(box_x.shape[-1], 1),
+        rounding_mode="floor",
+    )
+    box_is_finite = torch.isfinite(box_params).all(dim=-1)
+    box_params, box_batch_idx = box_params[box_is_finite], box_batch_idx[box_is_finite]
+    mask = torch.zeros(
+        (int(np.prod(batch_shape)),) + img_shape, dtype=torch.bool, device=device
+    )
+    if box_params.shape[0] == 0:
+        return mask.reshape(batch_shape + img_shape)
+    box_x, box_y, box_len, box_w, box_theta = box_params.T
+
+    row_coords, col_coords = (
+        torch.from_numpy(coords).to(device)
+        for coords in get_metric_voxel_center_axes(
+            bev_range_x=float(bev_range_x),
+            bev_range_y=float(bev_range_y),
+            dataset_img_shape=img_shape,
+        )
+    )
+    abs_cos, abs_sin = torch.abs(torch.cos(box_theta)), torch.abs(torch.sin(box_theta))
+    half_extent_x = 0.5 * (abs_cos * box_len + abs_sin * box_w) + WINDOW_MARGIN_M
+    half_extent_y = 0.5 * (abs_sin * box_len + abs_cos * box_w) + WINDOW_MARGIN_M
+    rows_lo = torch.searchsorted(row_coords, box_x - half_extent_x)
+    rows_hi = torch.searchsorted(row_coords, box_x + half_extent_x, right=True)
+    cols_lo = torch.searchsorted(col_coords, box_y - half_extent_y)
+    cols_hi = torch.searchsorted(col_coords, box_y + half_extent_y, right=True)
+    num_rows, num_cols = rows_hi - rows_lo, cols_hi - cols_lo
+    num_pixels = num_rows * num_cols
+
+    # flat list of (box, pixel) candidates over all windows
+    pix_box = torch.repeat_interleave(
+        torch.arange(box_x.shape[0], device=device), num_pixels
+    )
+    window_start = torch.cumsum(num_pixels, dim=0) - num_pixels
+    pix_in_window = torch.arange(
+        pix_box.shape[0], device=device
+    ) - torch.repeat_interleave(window_start, num_pixels)
+    rows = rows_lo[pix_box] + torch.div(
+        pix_in_window, num_cols[pix_box], rounding_mode="floor"
+    )
+    cols = cols_lo[pix_box] + pix_in_window % num_cols[pix_box]
+
+    s_T_box = torch_compose_matrix(
+        t_x=box_x[None], t_y=box_y[None], theta_z=box_theta[None]
+    )[0]
+    box_T_s = torch.linalg.inv(s_T_box)[pix_box]
+    pix_x, pix_y = row_coords[rows], col_coords[cols]
+    pix_in_box_x, pix_in_box_y = (
+        box_T_s[:, i, 0] * pix_x + box_T_s[:, i, 1] * pix_y + box_T_s[:, i, 3]
+        for i in (0, 1)
+    )
+    half_len, half_w = box_len[pix_box] / 2.0, box_w[pix_box] / 2.0
+    is_in = (
+        (-half_len < pix_in_box_x)
+        & (pix_in_box_x < half_len)
+        & (-half_w < pix_in_box_y)
+        & (pix_in_box_y < half_w)
+    )
+    mask[box_batch_idx[pix_box[is_in]], rows[is_in], cols[is_in]] = True
+    return mask.reshape(batch_shape + img_shape)
+
+
 def render_soft_kabsch_mask_torch(
     *,
     box_x,
@@ -1,6 +1,7 @@
 from typing import Tuple
 
 import torch
+from liso.datasets.ragged_points import pad_ragged_sample_data
 from liso.kabsch.shape_utils import Shape
 
 
@@ -85,6 +86,18 @@ class RecursiveDeviceMover(torch.nn.Module):
             augmented_dataset_element_t0,
             meta_data,
         ) = data_input
+        # ragged point clouds are only transferred packed, padded on the device
+        device = self.dummy_device_indicator_param.device
+        dataset_element_t0 = pad_ragged_sample_data(
+            dataset_element_t0, device if need_sample_data_t0 else None
+        )
+        dataset_element_t1 = pad_ragged_sample_data(
+            dataset_element_t1, device if need_sample_data_t1 else None
+        )
+        augmented_dataset_element_t0 = pad_ragged_sample_data(
+            augmented_dataset_element_t0,
+            device if need_augm_sample_data_t0 else None,
+        )
         if need_sample_data_t0:
             dataset_element_t0 = recursive_device_mover_for_specific_keys(
                 dataset_element_t0,
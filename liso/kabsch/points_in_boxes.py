@@ -0,0 +1,267 @@
+from typing import Tuple, Union
+
+import numpy as np
+import torch
+from liso.kabsch.shape_utils import Shape
+from liso.utils.torch_transformation import homogenize_pcl
+
+# Points-in-boxes without the dense [num_points, num_boxes, 4] transform:
+# points are sorted by their cell in a BEV grid, every box only transforms the
+# points of the cells overlapped by its axis aligned footprint. The result is
+# a sparse list of (point_idx, box_idx) pairs, sorted by box, then by point.
+DEFAULT_CELL_SIZE_M = 1.0
+# covers rounding when comparing in the box frame against the footprint
+FOOTPRINT_MARGIN_M = 1e-3
+
+
+def _get_box_footprints(objects: Shape):
+    # axis aligned bounding rectangle of the rotated box in the xy plane
+    if torch.is_tensor(objects.pos):
+        pos_xy = objects.pos[:, :2].to(torch.double)
+        dims_xy = objects.dims[:, :2].to(torch.double)
+        if objects.rot is None or objects.rot.shape[-1] == 0:
+            rot = torch.zeros_like(pos_xy[:, 0])
+        else:
+            rot = objects.rot[:, 0].to(torch.double)
+        abs_cos, abs_sin = torch.abs(torch.cos(rot)), torch.abs(torch.sin(rot))
+        half_extent_xy = 0.5 * torch.stack(
+            [
+                abs_cos * dims_xy[:, 0] + abs_sin * dims_xy[:, 1],
+                abs_sin * dims_xy[:, 0] + abs_cos * dims_xy[:, 1],
+            ],
+            dim=-1,
+        )
+    else:
+        pos_xy = objects.pos[:, :2].astype(np.float64)
+        dims_xy = objects.dims[:, :2].astype(np.float64)
+        if objects.rot is None or objects.rot.shape[-1] == 0:
+            rot = np.zeros_like(pos_xy[:, 0])
+        else:
+            rot = objects.rot[:, 0].astype(np.float64)
+        abs_cos, abs_sin = np.abs(np.cos(rot)), np.abs(np.sin(rot))
+        half_extent_xy = 0.5 * np.stack(
+            [
+                abs_cos * dims_xy[:, 0] + abs_sin * dims_xy[:, 1],
+                abs_sin * dims_xy[:, 0] + abs_cos * dims_xy[:, 1],
+            ],
+            axis=-1,
+        )
+    half_extent_xy = half_extent_xy + FOOTPRINT_MARGIN_M
+    return pos_xy - half_extent_xy, pos_xy + half_extent_xy
+
+
+def _get_candidate_pairs_numpy(
+    points_xy: np.ndarray,
+    box_xy_min: np.ndarray,
+    box_xy_max: np.ndarray,
+    cell_size_m: float,
+) -> Tuple[np.ndarray, np.ndarray]:
+    empty = np.zeros(0, dtype=np.int64)
+    finite_point_idxs = np.nonzero(np.isfinite(points_xy).all(axis=-1))[0]
+    if finite_point_idxs.size == 0 or box_xy_min.shape[0] == 0:
+        return empty, empty
+    points_xy = points_xy[finite_point_idxs].astype(np.float64)
+    grid_origin = points_xy.min(axis=0)
+    point_cells = np.floor((points_xy - grid_origin) / cell_size_m).astype(np.int64)
+    grid_shape = point_cells.max(axis=0) + 1
+    cell_ids = point_cells[:, 0] * grid_shape[1] + point_cells[:, 1]
+    sort_order = np.argsort(cell_ids, kind="stable")
+    sorted_cell_ids = cell_ids[sort_order]
+
+    box_is_finite = np.isfinite(box_xy_min).all(axis=-1) & np.isfinite(box_xy_max).all(
+        axis=-1
+    )
+    box_idxs = np.nonzero(box_is_finite)[0]
+    box_cell_min = np.floor((box_xy_min[box_idxs] - grid_origin) / cell_size_m)
+    box_cell_max = np.floor((box_xy_max[box_idxs] - grid_origin) / cell_size_m)
+    box_overlaps_grid = np.all(
+        (box_cell_max >= 0) & (box_cell_min < grid_shape), axis=-1
+    )
+    box_idxs = box_idxs[box_overlaps_grid]
+    box_cell_min = np.maximum(box_cell_min[box_overlaps_grid], 0).astype(np.int64)
+    box_cell_max = np.minimum(box_cell_max[box_overlaps_grid], grid_shape - 1).astype(
+        np.int64
+    )
+
+    # one contiguous range of sorted points per box and grid row
+    num_rows = box_cell_max[:, 0] - box_cell_min[:, 0] + 1
+    row_owner = np.repeat(np.arange(box_idxs.shape[0]), num_rows)
+    row_x = (
+        box_cell_min[row_owner, 0]
+        + np.arange(row_owner.shape[0])
+        - np.repeat(np.cumsum(num_rows) - num_rows, num_rows)
+    )
+    row_start = np.searchsorted(
+        sorted_cell_ids,
+        row_x * grid_shape[1] + box_cell_min[row_owner, 1],
+        side="left",
+    )
+    row_end = np.searchsorted(
+        sorted_cell_ids,
+        row_x * grid_shape[1] + box_cell_max[row_owner, 1],
+        side="right",
+    )
+    num_pairs = row_end - row_start
+    pair_sorted_pos = (
+        np.repeat(row_start, num_pairs)
+        + np.arange(num_pairs.sum())
+        - np.repeat(np.cumsum(num_pairs) - num_pairs, num_pairs)
+    )
+    pair_point_idxs = finite_point_idxs[sort_order[pair_sorted_pos]]
+    pair_box_idxs = box_idxs[np.repeat(row_owner, num_pairs)]
+    return pair_point_idxs, pair_box_idxs
+
+
+def _get_candidate_pairs_torch(
+    points_xy: torch.FloatTensor,
+    box_xy_min: torch.DoubleTensor,
+    box_xy_max: torch.DoubleTensor,
+    cell_size_m: float,
+) -> Tuple[torch.LongTensor, torch.LongTensor]:
+    device = points_xy.device
+    empty = torch.zeros(0, dtype=torch.long, device=device)
+    finite_point_idxs = torch.nonzero(torch.isfinite(points_xy).all(dim=-1))[:, 0]
+    if finite_point_idxs.numel() == 0 or box_xy_min.shape[0] == 0:
+        return empty, empty
+    points_xy = points_xy[finite_point_idxs].to(torch.double)
+    grid_origin = points_xy.min(dim=0).values
+    point_cells = torch.floor((points_xy - grid_origin) / cell_size_m).to(torch.long)
+    grid_shape = point_cells.max(dim=0).values + 1
+    sorted_cell_ids, sort_order = torch.sort(
+        point_cells[:, 0] * grid_shape[1] + point_cells[:, 1], stable=True
+    )
+
+    box_is_finite = torch.isfinite(box_xy_min).all(dim=-1) & torch.isfinite(
+        box_xy_max
+    ).all(dim=-1)
+    box_idxs = torch.nonzero(box_is_finite)[:, 0]
+    box_cell_min = torch.floor((box_xy_min[box_idxs] - grid_origin) / cell_size_m)
+    box_cell_max = torch.floor((box_xy_max[box_idxs] - grid_origin) / cell_size_m)
+    box_overlaps_grid = torch.all(
+        (box_cell_max >= 0) & (box_cell_min < grid_shape), dim=-1
+    )
+    box_idxs = box_idxs[box_overlaps_grid]
+    box_cell_min = torch.clamp(box_cell_min[box_overlaps_grid], min=0).to(torch.long)
+    box_cell_max = torch.minimum(
+        box_cell_max[box_overlaps_grid], (grid_shape - 1).to(torch.double)
+    ).to(torch.long)
+
+    # one contiguous range of sorted points per box and grid row
+    num_rows = box_cell_max[:, 0] - box_cell_min[:, 0] + 1
+    row_owner = torch.repeat_interleave(
+        torch.arange(box_idxs.shape[0], device=device), num_rows
+    )
+    row_x = (
+        box_cell_min[row_owner, 0]
+        + torch.arange(row_owner.shape[0], device=device)
+        - torch.repeat_interleave(torch.cumsum(num_rows, dim=0) - num_rows, num_rows)
+    )
+    row_start = torch.searchsorted(
+        sorted_cell_ids, row_x * grid_shape[1] + box_cell_min[row_owner, 1]
+    )
+    row_end = torch.searchsorted(
+        sorted_cell_ids,
+        row_x * grid_shape[1] + box_cell_max[row_owner, 1],
+        right=True,
+    )
+    num_pairs = row_end - row_start
+    pair_sorted_pos = (
+        torch.repeat_interleave(row_start, num_pairs)
+        + torch.arange(int(num_pairs.sum()), device=device)
+        - torch.repeat_interleave(torch.cumsum(num_pairs, dim=0) - num_pairs, num_pairs)
+    )
+    pair_point_idxs = finite_point_idxs[sort_order[pair_sorted_pos]]
+    pair_box_idxs = box_idxs[torch.repeat_interleave(row_owner, num_pairs)]
+    return pair_point_idxs, pair_box_idxs
+
+
+def get_points_in_boxes_sparse(
+    objects: Shape,
+    pcl: Union[np.ndarray, torch.FloatTensor],
+    cell_size_m: float = DEFAULT_CELL_SIZE_M,
+    use_double_precision: bool = True,
+    return_points_in_box_coords: bool = False,
+):
+    """Find all (point_idx, box_idx) pairs with the point inside the box.
+
+    objects are unbatched boxes [num_boxes], pcl is [num_points, 3 or 4]
+    (xyz or homogeneous), both numpy or both torch. Pairs are sorted by box
+    and then by point. The inside test is the one of get_points_in_boxes_mask,
+    with return_points_in_box_coords the homogeneous point coordinates in the
+    frame of their box [num_pairs, 4] are returned as well.
+    """
+    assert len(objects.shape) == 1, objects.shape
+    assert len(pcl.shape) == 2 and pcl.shape[-1] in (3, 4), pcl.shape
+    assert torch.is_tensor(objects.pos) == torch.is_tensor(
+        pcl
+    ), "need either both np arrays or tensors!"
+    num_points = pcl.shape[0]
+    box_xy_min, box_xy_max = _get_box_footprints(objects)
+    if torch.is_tensor(pcl):
+        point_idxs, box_idxs = _get_candidate_pairs_torch(
+            pcl[:, :2],
+            box_xy_min.to(pcl.device),
+            box_xy_max.to(pcl.device),
+            cell_size_m,
+        )
+        box_T_sensor = torch.linalg.inv(objects.get_poses())
+        points_homog = homogenize_pcl(pcl[point_idxs, :3])
+        if use_double_precision:
+            pts_in_box_homog = torch.einsum(
+                "pij,pj->pi",
+                box_T_sensor[box_idxs],
+                points_homog.to(box_T_sensor.dtype),
+            ).to(pcl.dtype)
+        else:
+            pts_in_box_homog = torch.einsum(
+                "pij,pj->pi", box_T_sensor[box_idxs].to(pcl.dtype), points_homog
+            )
+        is_inside = torch.all(
+            torch.abs(pts_in_box_homog[:, 0:3]) < 0.5 * objects.dims[box_idxs], dim=-1
+        )
+        point_idxs, box_idxs = point_idxs[is_inside], box_idxs[is_inside]
+        order = torch.argsort(box_idxs * num_points + point_idxs)
+    else:
+        point_idxs, box_idxs = _get_candidate_pairs_numpy(
+            pcl[:, :2], box_xy_min, box_xy_max, cell_size_m
+        )
+        box_T_sensor = np.linalg.inv(objects.get_poses())
+        if not use_double_precision:
+            box_T_sensor = box_T_sensor.astype(np.float32)
+        pts_in_box_homog = np.einsum(
+            "pij,pj->pi", box_T_sensor[box_idxs], homogenize_pcl(pcl[point_idxs, :3])
+        )
+        is_inside = np.all(
+            np.abs(pts_in_box_homog[:, 0:3]) < 0.5 * objects.dims[box_idxs], axis=-1
+        )
+        point_idxs, box_idxs = point_idxs[is_inside], box_idxs[is_inside]
+        order = np.argsort(box_idxs * num_points + point_idxs)
+    point_idxs, box_idxs = point_idxs[order], box_idxs[order]
+    if return_points_in_box_coords:
+        return point_idxs, box_idxs, pts_in_box_homog[is_inside][order]
+    return point_idxs, box_idxs
+
+
+def sparse_points_in_boxes_to_mask(
+    point_idxs: Union[np.ndarray, torch.LongTensor],
+    box_idxs: Union[np.ndarray, torch.LongTensor],
+    num_points: int,
+    num_boxes: int,
+) -> Union[np.ndarray, torch.BoolTensor]:
+    """Dense [num_points, num_boxes] mask of get_points_in_boxes_sparse pairs."""
+    if torch.is_tensor(point_idxs):
+        point_is_in_box = torch.zeros(
+            (num_points, num_boxes), dtype=torch.bool, device=point_idxs.device
+        )
+    else:
+        point_is_in_box = np.zeros((num_points, num_boxes), dtype=bool)
+    point_is_in_box[point_idxs, box_idxs] = True
+    return point_is_in_box
+
+
+def count_points_in_boxes(
+    box_idxs: Union[np.ndarray, torch.LongTensor], num_boxes: int
+) -> Union[np.ndarray, torch.LongTensor]:
+    if torch.is_tensor(box_idxs):
+        return torch.bincount(box_idxs, minlength=num_boxes)
+    return np.bincount(box_idxs, minlength=num_boxes)
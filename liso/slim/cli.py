@@ -34,6 +34,11 @@ def main():
 
         checkpoint_cfg = dumb_load_yaml_to_omegaconf(cfg_path_chkpt)
         checkpoint_cfg.data.paths = cfg.data.paths  # data paths may have changed
+        # export setting of this run, not of the training run
+        checkpoint_cfg.SLIM.inference_batch_size = cfg.SLIM.setdefault(
+            "inference_batch_size", 1
+        )
+        checkpoint_cfg.SLIM.export_writer = cfg.SLIM.setdefault("export_writer", {})
         save_config(checkpoint_cfg, log_dir.joinpath("config.yml"))
         del cfg
         exp = Experiment(
@@ -20,6 +20,11 @@ from liso.datasets.nuscenes_torch_dataset import (
     get_nuscenes_train_dataset,
     get_nuscenes_val_dataset,
 )
+from liso.datasets.rank_shards import (
+    check_outputs_complete,
+    get_loader_sample_ids,
+    get_rank_shard_loader,
+)
 from liso.datasets.torch_dataset_commons import LidarDataset
 from liso.datasets.waymo_torch_dataset import (
     get_waymo_train_dataset,
@@ -42,7 +47,9 @@ from liso.slim.utils.metrics import (
 )
 from liso.slim.utils.pointwise2bev import scatter_pointwise2bev
 from liso.slim.utils.tb_factory import TBFactory
+from liso.utils.async_npz_writer import AsyncNpzWriter
 from liso.utils.config_helper_helper import pretty_json
+from liso.utils.file_utils import atomic_write_bytes, npz_bytes
 from liso.utils.learning_rate import get_polynomial_decay_schedule_with_warmup
 from liso.visu.bbox_image import (
     draw_boxes_on_2d_projection,
@@ -231,6 +238,10 @@ class Experiment:
         with open(target_dir.joinpath("pred_info.yml"), "w") as yaml_file:
             dump(info, yaml_file, default_flow_style=False)
 
+        # the loaders below are batched with data.batch_size, which was set for
+        # training, results are written per sample whatever the batch size
+        self.cfg.data.batch_size = self.slim_cfg.setdefault("inference_batch_size", 1)
+
         ds_args = {
             "use_geom_augmentation": False,
             "shuffle": False,
@@ -253,12 +264,19 @@ class Experiment:
             )
             val_on_train_loader = None
         elif self.cfg.data.source == "kitti":
-            t0_t1_loader, t0_t1_ds = get_kitti_train_dataset(
-                cfg=self.cfg, use_skip_frames="never", **ds_args
-            )
-            t0_t2_loader, _ = get_kitti_train_dataset(
-                cfg=self.cfg, use_skip_frames="only", **ds_args
-            )
+            if self.cfg.data.train_on_box_source == "gt":
+                t0_t1_loader, t0_t1_ds = get_kitti_train_dataset(
+                    cfg=self.cfg, use_skip_frames="never", **ds_args
+                )
+                t0_t2_loader, _ = get_kitti_train_dataset(
+                    cfg=self.cfg, use_skip_frames="only", **ds_args
+                )
+            else:
+                # KittiRawDataset, t0->t1 and t0->t2 from one load
+                t0_t1_loader, t0_t1_ds = get_kitti_train_dataset(
+                    cfg=self.cfg, use_skip_frames="multi_pair", **ds_args
+                )
+                t0_t2_loader = None
             val_loader, _ = get_kitti_val_dataset(
                 self.cfg,
                 size=None,
@@ -312,17 +330,36 @@ class Experiment:
             )
             val_on_train_loader = None
         elif self.cfg.data.source == "tartu":
+            # t0->t1 and t0->t2 from one load
             t0_t1_loader, t0_t1_ds = get_tartu_train_dataset(
-                cfg=self.cfg, use_skip_frames="never", **ds_args
-            )
-            t0_t2_loader, _ = get_tartu_train_dataset(
-                cfg=self.cfg, use_skip_frames="only", **ds_args
+                cfg=self.cfg, use_skip_frames="multi_pair", **ds_args
             )
+            t0_t2_loader = None
             # NOTE: we have no validation data
             val_loader, _ = (None, None)
             val_on_train_loader = None
 
-        assert len(t0_t1_loader) == len(t0_t2_loader), "missed frames"
+        if self.world_size > 1:
+            # every rank only loads the samples of its own shard
+            val_loader, val_on_train_loader, t0_t1_loader = (
+                None
+                if loader is None
+                else get_rank_shard_loader(loader, self.world_size, self.worker_id)
+                for loader in (val_loader, val_on_train_loader, t0_t1_loader)
+            )
+            if isinstance(t0_t2_loader, list):
+                # no t0->t2 export
+                t0_t2_loader = [None] * len(t0_t1_loader)
+            elif t0_t2_loader is not None:
+                t0_t2_loader = get_rank_shard_loader(
+                    t0_t2_loader, self.world_size, self.worker_id
+                )
+        if t0_t2_loader is None:
+            # multi pair batches hold the t0->t1 and the t0->t2 batch
+            t0_t1_t0_t2_loader = t0_t1_loader
+        else:
+            assert len(t0_t1_loader) == len(t0_t2_loader), "missed frames"
+            t0_t1_t0_t2_loader = zip(t0_t1_loader, t0_t2_loader)
 
         no_summaries = {
             "writer": None,
@@ -331,17 +368,20 @@ class Experiment:
             "aggregated_metrics": False,
         }
 
-        with torch.no_grad():
+        # results are compressed and written in the background, leaving the
+        # with block waits for (and verifies) all writes
+        export_writer_cfg = self.slim_cfg.setdefault("export_writer", {})
+        npz_writer = AsyncNpzWriter(
+            num_workers=export_writer_cfg.setdefault("num_workers", 2),
+            max_pending_writes=export_writer_cfg.setdefault("max_pending_writes", 8),
+            codec=export_writer_cfg.setdefault("codec", "deflate"),
+            compresslevel=export_writer_cfg.setdefault("compresslevel", None),
+        )
+        with torch.no_grad(), npz_writer:
             for vl in (val_loader, val_on_train_loader):
                 if vl is None:
                     continue
-                for sample_idx, val_el in tqdm(
-                    enumerate(vl), total=len(vl), disable=False
-                ):
-                    if self.world_size > 1:
-                        if sample_idx % self.world_size != self.worker_id:
-                            continue
-
+                for val_el in tqdm(vl, total=len(vl), disable=False):
                     self.slim_inference_and_save_result(
                         target_dir,
                         t0_t1_ds,
@@ -349,19 +389,17 @@ class Experiment:
                         val_el,
                         t0_t2_el=None,
                         skip_existing=skip_existing,
+                        npz_writer=npz_writer,
                     )
             # print("NOT EXPORTING ON TRAIN AGAIN")
             # print("REMOVE EXIT BELOW TO RUN EXPORT ON TRAIN SET")
             # print("DONE")
             # sys.exit(0)
-            for sample_idx, (t0_t1_el, t0_t2_el) in tqdm(
-                enumerate(zip(t0_t1_loader, t0_t2_loader)),
+            for t0_t1_el, t0_t2_el in tqdm(
+                t0_t1_t0_t2_loader,
                 total=len(t0_t1_loader),
                 disable=False,
             ):
-                if self.world_size > 1:
-                    if sample_idx % self.world_size != self.worker_id:
-                        continue
                 self.slim_inference_and_save_result(
                     target_dir,
                     t0_t1_ds,
@@ -369,7 +407,24 @@ class Experiment:
                     t0_t1_el,
                     t0_t2_el,
                     skip_existing=skip_existing,
+                    npz_writer=npz_writer,
+                )
+
+        expected_sample_ids = []
+        for loader in (val_loader, val_on_train_loader, t0_t1_loader):
+            if loader is None:
+                continue
+            sample_ids = get_loader_sample_ids(loader)
+            if sample_ids is None:
+                print(
+                    "Can't check outputs of "
+                    f"{type(loader.dataset).__name__} for completeness"
                 )
+            else:
+                expected_sample_ids.extend(sample_ids)
+        check_outputs_complete(
+            target_dir, expected_sample_ids, self.world_size, self.worker_id
+        )
 
     @torch.no_grad()
     def slim_inference_and_save_result(
@@ -380,6 +435,7 @@ class Experiment:
         t0_t1_el: Dict[str, torch.FloatTensor],
         t0_t2_el: Dict[str, torch.FloatTensor] = None,
         skip_existing=False,
+        npz_writer: AsyncNpzWriter = None,
     ):
         (
             sample_data_t0,
@@ -388,16 +444,23 @@ class Experiment:
             meta_data_t0_t1,
         ) = self.mask_gt_renderer(t0_t1_el)
 
-        target_file = target_dir.joinpath(meta_data_t0_t1["sample_id"][0]).with_suffix(
-            ".npz"
-        )
-        if skip_existing and target_file.exists():
+        # batches are un-batched into one file per sample
+        target_files = [
+            target_dir.joinpath(sample_id).with_suffix(".npz")
+            for sample_id in meta_data_t0_t1["sample_id"]
+        ]
+        if skip_existing and all(target_file.exists() for target_file in target_files):
             return
 
+        # every frame is encoded once, also if it is part of several pairs
+        encoding_t0 = self.model.encode_frame(sample_data_t0)
+        encoding_t1 = self.model.encode_frame(sample_data_t1)
         preds_fw, preds_bw = self.model(
             sample_data_t0,
             sample_data_t1,
             summaries=no_summaries,
+            encoding_t0=encoding_t0,
+            encoding_t1=encoding_t1,
         )
         preds = {}
         preds["bev_raw_flow_t0_t1"] = preds_fw[-1].modified_network_output.static_flow
@@ -424,16 +487,19 @@ class Experiment:
                 meta_data_t0_t1["sample_id"],
                 meta_data_t0_t2["sample_id"],
             )
-            assert len(meta_data_t0_t1["sample_id"]) == 1, len(
-                meta_data_t0_t1["sample_id"]
-            )
+            pcl_t0 = sample_data_t0["pcl_ta"]["pcl"]
+            pcl_t0_2 = sample_data_t0_2["pcl_ta"]["pcl"]
+            # batches are padded with nan
             assert torch.all(
-                sample_data_t0["pcl_ta"]["pcl"] == sample_data_t0_2["pcl_ta"]["pcl"]
+                (pcl_t0 == pcl_t0_2) | (torch.isnan(pcl_t0) & torch.isnan(pcl_t0_2))
             )
+            encoding_t2 = self.model.encode_frame(sample_data_t2)
             preds_fw, preds_bw = self.model(
                 sample_data_t0_2,
                 sample_data_t2,
                 summaries=no_summaries,
+                encoding_t0=encoding_t0,
+                encoding_t1=encoding_t2,
             )
             preds["bev_raw_flow_t0_t2"] = preds_fw[
                 -1
@@ -452,6 +518,8 @@ class Experiment:
                 sample_data_t1,
                 sample_data_t2,
                 summaries=no_summaries,
+                encoding_t0=encoding_t1,
+                encoding_t1=encoding_t2,
             )
             preds["bev_raw_flow_t1_t2"] = preds_fw[
                 -1
@@ -467,19 +535,26 @@ class Experiment:
             ].modified_network_output.dynamicness
 
         # save:
-        save_stuff = {
-            **save_stuff,
-            **preds,
-        }
         save_stuff_cpu = {
             k: torch.squeeze(v, dim=0).detach().cpu().numpy()
             for k, v in save_stuff.items()
         }
-        save_stuff_cpu["bev_range_m"] = t0_t1_ds.bev_range_m_np
-        target_file.parent.mkdir(
-            exist_ok=True, parents=True
-        )  # for waymo we have subfolders
-        np.savez_compressed(target_file, **save_stuff_cpu)
+        preds_cpu = {k: v.detach().cpu().numpy() for k, v in preds.items()}
+        for sample_idx_in_batch, target_file in enumerate(target_files):
+            if skip_existing and target_file.exists():
+                continue
+            sample_save_stuff_cpu = {
+                **save_stuff_cpu,
+                **{k: v[sample_idx_in_batch] for k, v in preds_cpu.items()},
+            }
+            sample_save_stuff_cpu["bev_range_m"] = t0_t1_ds.bev_range_m_np
+            target_file.parent.mkdir(
+                exist_ok=True, parents=True
+            )  # for waymo we have subfolders
+            if npz_writer is None:
+                atomic_write_bytes(target_file, npz_bytes(sample_save_stuff_cpu))
+            else:
+                npz_writer.submit(target_file, sample_save_stuff_cpu)
 
     def run(self):
         self.model.train()
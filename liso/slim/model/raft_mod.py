@@ -79,55 +79,62 @@ class RAFT(nn.Module):
             filters=hdim,
         )
 
+    def encode_frame(self, pcl):
+        """Everything computed from a single frame, shared by all of its pairs."""
+        img, bev_occupancy_map = self.pp_layer(pcl)  # bev_enc
+        # feature extractor -> (bs, nch, h/8, w/8), nch: 128
+        fmap = self.fnet(img)
+        # context network
+        cnet = self.cnet(img)
+        net, inp = torch.split(cnet, [self.hidden_dim, self.context_dim], dim=1)
+        return {
+            "img": img,
+            "bev_net_input_dbg": bev_occupancy_map,
+            "fmap": fmap,
+            "net": torch.tanh(net),
+            "inp": torch.relu(inp),
+        }
+
     def forward(
         self,
         pcl_t0,
         pcl_t1,
     ):
-        img_t0, bev_occupancy_map_t0 = self.pp_layer(  # bev_enc_0
-            pcl_t0,
-        )
-
-        img_t1, bev_occupancy_map_t1 = self.pp_layer(  # bev_enc_1
-            pcl_t1,
+        return self.predict_from_encodings(
+            self.encode_frame(pcl_t0), self.encode_frame(pcl_t1)
         )
 
+    def predict_from_encodings(self, encoding_t0, encoding_t1):
         aux_outputs = {
-            "t0": {"bev_net_input_dbg": bev_occupancy_map_t0},
-            "t1": {"bev_net_input_dbg": bev_occupancy_map_t1},
+            "t0": {"bev_net_input_dbg": encoding_t0["bev_net_input_dbg"]},
+            "t1": {"bev_net_input_dbg": encoding_t1["bev_net_input_dbg"]},
         }
 
-        # feature extractor -> (bs, nch, h/8, w/8)x2
-        fmap_t0 = self.fnet(img_t0)
-
-        fmap_t1 = self.fnet(img_t1)  # nch: 128
-
         assert self.slim_cfg.model.flow_maps_archi in [
             "single",
             "vanilla",
         ], "David did only check this branch because he thinks others are unused"
 
         retvals_fw = self.predict_single_flow_map_and_classes(
-            img_t0,
-            fmap_t0,
-            fmap_t1,
+            encoding_t0,
+            encoding_t1["fmap"],
             self.head_decoder_fw,  # training
         )
         retvals_bw = self.predict_single_flow_map_and_classes(
-            img_t1,
-            fmap_t1,
-            fmap_t0,
+            encoding_t1,
+            encoding_t0["fmap"],
             self.head_decoder_bw,  # training
         )
         return retvals_fw, retvals_bw, aux_outputs
 
     def predict_single_flow_map_and_classes(
         self,
-        img_t0,
-        fmap_t0,
+        encoding_t0,
         fmap_t1,
         decoder,  # training
     ):
+        img_t0 = encoding_t0["img"]
+        fmap_t0 = encoding_t0["fmap"]
         assert (
             img_t0.shape[1] == self.slim_cfg.model.point_pillars.nbr_point_feats
         ), img_t0.shape
@@ -166,11 +173,8 @@ class RAFT(nn.Module):
         else:
             raise ValueError("Wrong corr module selected")
 
-        # context network
-        cnet = self.cnet(img_t0)
-        net, inp = torch.split(cnet, [self.hidden_dim, self.context_dim], dim=1)
-        net = torch.tanh(net)
-        inp = torch.relu(inp)
+        net = encoding_t0["net"]
+        inp = encoding_t0["inp"]
 
         iters = (
             self.slim_cfg.model.num_iters
@@ -41,26 +41,33 @@ class SLIM(nn.Module):  # type:ignore
             head_decoder_bw=self.head_decoder_bw,
         )
 
+    def encode_frame(self, sample_data):
+        return self.raft_network.encode_frame(
+            get_network_input_pcls(
+                self.cfg,
+                sample_data,
+                "ta",
+                to_device="cuda",
+            )
+        )
+
     def forward(
         self,
         sample_data_t0,
         sample_data_t1,
         summaries,
+        encoding_t0=None,
+        encoding_t1=None,
     ):
+        # encodings of frames that are part of several pairs may be passed in
+        # (see encode_frame), they are computed otherwise
+        if encoding_t0 is None:
+            encoding_t0 = self.encode_frame(sample_data_t0)
+        if encoding_t1 is None:
+            encoding_t1 = self.encode_frame(sample_data_t1)
         # predictions is list across iterations
-        outputs_fw, outputs_bw, aux_outputs = self.raft_network(
-            get_network_input_pcls(
-                self.cfg,
-                sample_data_t0,
-                "ta",
-                to_device="cuda",
-            ),
-            get_network_input_pcls(
-                self.cfg,
-                sample_data_t1,
-                "ta",
-                to_device="cuda",
-            ),
+        outputs_fw, outputs_bw, aux_outputs = self.raft_network.predict_from_encodings(
+            encoding_t0, encoding_t1
         )
         filled_pillar_mask_t0 = torch.squeeze(
             aux_outputs["t0"]["bev_net_input_dbg"] > 0.5, dim=1
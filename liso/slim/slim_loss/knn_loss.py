@@ -66,6 +66,8 @@ def compute_knn_loss_components(
         flows,
         loss_function=NearestPointLoss(bev_extent=bev_extent, **loss_cfg.knn_loss),
         nearest_dist_mode=loss_cfg.knn_dist_measure,
+        knn_backend=loss_cfg.setdefault("knn_backend", "nanoflann"),
+        knn_voxel_size_m=loss_cfg.setdefault("knn_voxel_size_m", 1.0),
     )
 
     knn_results = {}
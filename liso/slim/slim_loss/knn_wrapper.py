@@ -5,6 +5,12 @@ import typing as t
 
 import torch
 from liso.slim.slim_loss.knn_graph import knn_graph
+from liso.slim.slim_loss.torch_knn import (
+    DEFAULT_VOXEL_SIZE_M,
+    KNN_BACKENDS,
+    brute_force_knn_idxs,
+    voxel_hash_nearest_idxs,
+)
 from munch import Munch
 
 
@@ -158,9 +164,12 @@ def compute_flow_loss_a_to_b(
     flow_a_to_b: torch.FloatTensor,
     loss_function,
     nearest_dist_mode: str = "point",
+    knn_backend: str = "nanoflann",
+    knn_voxel_size_m: float = DEFAULT_VOXEL_SIZE_M,
 ):
     # #region check shapes and dtypes
     assert nearest_dist_mode in {"point", "plane"}
+    assert knn_backend in KNN_BACKENDS, knn_backend
     assert cloud_a.ndim == 3
     assert cloud_b.ndim == 3
     assert flow_a_to_b.ndim == 3
@@ -177,13 +186,20 @@ def compute_flow_loss_a_to_b(
 
     cloud_b__a = cloud_a + flow_a_to_b
     bs = cloud_b.size(0)
-    indices_into_b__a = torch.stack(
-        [
-            get_idx_dists_for_knn(cloud_b[b], cloud_b__a[b], num_neighbors=1)
-            for b in range(bs)
-        ],
-        dim=0,
-    )
+    if knn_backend == "nanoflann":
+        indices_into_b__a = torch.stack(
+            [
+                get_idx_dists_for_knn(cloud_b[b], cloud_b__a[b], num_neighbors=1)
+                for b in range(bs)
+            ],
+            dim=0,
+        )
+    elif knn_backend == "torch_brute_force":
+        indices_into_b__a = brute_force_knn_idxs(cloud_b, cloud_b__a, k=1)
+    else:
+        indices_into_b__a = voxel_hash_nearest_idxs(
+            cloud_b, cloud_b__a, voxel_size_m=knn_voxel_size_m
+        )
 
     nearest_cloud_b__a = torch.gather(cloud_b, 1, indices_into_b__a.repeat(1, 1, 3))
 
@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+import torch
+
+# On-device alternatives to the pynanoflann KD-tree of knn_graph for the
+# nearest point loss. Both run batched over all batch elements on the device
+# of the points, without copying the clouds to the host. Points with a
+# non-finite coordinate (padding) are never returned as neighbors, padding
+# queries get index 0.
+#  - torch_brute_force: all query to reference distances, chunked over the
+#    queries to bound memory, fine for moderate point counts.
+#  - torch_voxel_hash: the references are sorted by voxel (hash key of batch
+#    element and voxel coordinates), a query only looks at the references in
+#    the 3x3x3 voxels around its own. A neighbor found there is the true
+#    nearest neighbor if it is at most one voxel size away, the few queries
+#    without such a neighbor fall back to brute force, so results are exact.
+KNN_BACKENDS = ("nanoflann", "torch_brute_force", "torch_voxel_hash")
+# query to reference distances per brute force chunk
+DEFAULT_MAX_NUM_DISTS_PER_CHUNK = 2**25
+# query to reference candidates per voxel hash chunk
+DEFAULT_MAX_NUM_CANDIDATES_PER_CHUNK = 2**24
+DEFAULT_VOXEL_SIZE_M = 1.0
+
+
+@torch.no_grad()
+def brute_force_knn_idxs(
+    ref_pts: torch.FloatTensor,
+    query_pts: torch.FloatTensor,
+    k: int = 1,
+    max_num_dists_per_chunk: int = DEFAULT_MAX_NUM_DISTS_PER_CHUNK,
+) -> torch.LongTensor:
+    """Indices [B, N, k] into ref_pts [B, M, 3] of the k nearest neighbors of
+    query_pts [B, N, 3], nearest first.
+
+    Queries with a non-finite coordinate get index 0, as do the neighbors of a
+    query beyond the number of finite references.
+    """
+    assert ref_pts.ndim == 3 and query_pts.ndim == 3, (ref_pts.shape, query_pts.shape)
+    assert ref_pts.shape[0] == query_pts.shape[0], (ref_pts.shape, query_pts.shape)
+    assert ref_pts.shape[1] >= k, (ref_pts.shape, k)
+    bs, num_refs = ref_pts.shape[:2]
+    num_queries = query_pts.shape[1]
+    ref_is_invalid = ~torch.isfinite(ref_pts).all(dim=-1)
+    chunk_size = max(1, max_num_dists_per_chunk // (bs * num_refs))
+    knn_idxs = [torch.zeros((bs, 0, k), dtype=torch.long, device=query_pts.device)]
+    for chunk_start in range(0, num_queries, chunk_size):
+        dists = torch.cdist(
+            query_pts[:, chunk_start : chunk_start + chunk_size],
+            ref_pts,
+            compute_mode="donot_use_mm_for_euclid_dist",
+        )
+        dists = dists.masked_fill(ref_is_invalid[:, None, :], float("inf"))
+        knn_dists, chunk_knn_idxs = torch.topk(dists, k, dim=-1, largest=False)
+        # nan or inf for padding queries and for padding references
+        knn_idxs.append(chunk_knn_idxs.masked_fill(~torch.isfinite(knn_dists), 0))
+    return torch.cat(knn_idxs, dim=1)
+
+
+def _get_voxel_keys(
+    batch_idxs: torch.LongTensor, voxels: torch.LongTensor, grid_shape: torch.LongTensor
+) -> torch.LongTensor:
+    # voxels [..., 3] relative to the grid, unique per batch element and voxel
+    return (
+        (batch_idxs * grid_shape[0] + voxels[..., 0]) * grid_shape[1] + voxels[..., 1]
+    ) * grid_shape[2] + voxels[..., 2]
+
+
+@torch.no_grad()
+def voxel_hash_nearest_idxs(
+    ref_pts: torch.FloatTensor,
+    query_pts: torch.FloatTensor,
+    voxel_size_m: float = DEFAULT_VOXEL_SIZE_M,
+    max_num_candidates_per_chunk: int = DEFAULT_MAX_NUM_CANDIDATES_PER_CHUNK,
+) -> torch.LongTensor:
+    """Indices [B, N, 1] into ref_pts [B, M, 3] of the nearest neighbors of
+    query_pts [B, N, 3].
+
+    Queries with a non-finite coordinate get index 0.
+    """
+    assert ref_pts.ndim == 3 and query_pts.ndim == 3, (ref_pts.shape, query_pts.shape)
+    assert ref_pts.shape[0] == query_pts.shape[0], (ref_pts.shape, query_pts.shape)
+    assert voxel_size_m > 0.0, voxel_size_m
+    device = query_pts.device
+    nearest_idxs = torch.zeros(query_pts.shape[:2], dtype=torch.long, device=device)
+
+    ref_batch_idxs, ref_idxs = torch.nonzero(
+        torch.isfinite(ref_pts).all(dim=-1), as_tuple=True
+    )
+    query_batch_idxs, query_idxs = torch.nonzero(
+        torch.isfinite(query_pts).all(dim=-1), as_tuple=True
+    )
+    if ref_idxs.shape[0] == 0 or query_idxs.shape[0] == 0:
+        return nearest_idxs[..., None]
+    valid_ref_pts = ref_pts[ref_batch_idxs, ref_idxs]
+    valid_query_pts = query_pts[query_batch_idxs, query_idxs]
+
+    # voxels relative to the bounding box of the references, padded by one
+    # voxel, so that all neighbor voxels holding references are inside
+    ref_voxels = torch.floor(valid_ref_pts / voxel_size_m).long()
+    grid_min = ref_voxels.amin(dim=0) - 1
+    grid_shape = ref_voxels.amax(dim=0) - grid_min + 2
+    sorted_ref_keys, ref_order = torch.sort(
+        _get_voxel_keys(ref_batch_idxs, ref_voxels - grid_min, grid_shape)
+    )
+
+    # far away queries are clamped to the padding, which holds no references
+    query_voxels = torch.minimum(
+        torch.maximum(
+            torch.floor(valid_query_pts / voxel_size_m),
+            (grid_min - 1).to(valid_query_pts.dtype),
+        ),
+        (grid_min + grid_shape).to(valid_query_pts.dtype),
+    ).long()
+    neighbor_offsets = torch.stack(
+        torch.meshgrid(*([torch.arange(-1, 2, device=device)] * 3), indexing="ij"),
+        dim=-1,
+    ).reshape(27, 3)
+    neighbor_voxels = query_voxels[:, None, :] + neighbor_offsets - grid_min
+    neighbor_is_inside = ((neighbor_voxels >= 0) & (neighbor_voxels < grid_shape)).all(
+        dim=-1
+    )
+    neighbor_keys = _get_voxel_keys(
+        query_batch_idxs[:, None], neighbor_voxels, grid_shape
+    )
+    # references of a voxel are sorted_ref_keys[first:last]
+    neighbor_first = torch.searchsorted(sorted_ref_keys, neighbor_keys)
+    neighbor_last = torch.searchsorted(sorted_ref_keys, neighbor_keys, right=True)
+    neighbor_num_refs = (neighbor_last - neighbor_first) * neighbor_is_inside
+
+    # chunks of consecutive queries with a bounded number of candidates
+    num_candidates_cumsum = torch.cumsum(neighbor_num_refs.sum(dim=-1), dim=0)
+    chunk_ends = torch.searchsorted(
+        num_candidates_cumsum,
+        torch.arange(
+            max_num_candidates_per_chunk,
+            int(num_candidates_cumsum[-1]) + max_num_candidates_per_chunk,
+            max_num_candidates_per_chunk,
+            device=device,
+        ),
+        right=True,
+    ).tolist()
+    nearest_dists_sqr = torch.full(
+        valid_query_pts.shape[:1],
+        float("inf"),
+        dtype=valid_query_pts.dtype,
+        device=device,
+    )
+    nearest_valid_ref_idxs = torch.zeros_like(query_idxs)
+    chunk_start = 0
+    for chunk_end in chunk_ends + [query_idxs.shape[0]]:
+        if chunk_end <= chunk_start:
+            # the next query alone exceeds the budget, it gets a chunk of its own
+            continue
+        chunk_num_refs = neighbor_num_refs[chunk_start:chunk_end].flatten()
+        chunk_first = neighbor_first[chunk_start:chunk_end].flatten()
+        candidate_neighbors = torch.repeat_interleave(
+            torch.arange(chunk_num_refs.shape[0], device=device), chunk_num_refs
+        )
+        first_candidate_of_neighbor = (
+            torch.cumsum(chunk_num_refs, dim=0) - chunk_num_refs
+        )
+        candidate_valid_ref_idxs = ref_order[
+            chunk_first[candidate_neighbors]
+            + torch.arange(candidate_neighbors.shape[0], device=device)
+            - first_candidate_of_neighbor[candidate_neighbors]
+        ]
+        candidate_queries = candidate_neighbors // 27
+        candidate_dists_sqr = (
+            (
+                valid_query_pts[chunk_start:chunk_end][candidate_queries]
+                - valid_ref_pts[candidate_valid_ref_idxs]
+            )
+            .square()
+            .sum(dim=-1)
+        )
+        chunk_nearest_dists_sqr = nearest_dists_sqr[
+            chunk_start:chunk_end
+        ].scatter_reduce(0, candidate_queries, candidate_dists_sqr, reduce="amin")
+        candidate_is_nearest = (
+            candidate_dists_sqr == chunk_nearest_dists_sqr[candidate_queries]
+        )
+        nearest_valid_ref_idxs[chunk_start:chunk_end] = torch.zeros_like(
+            chunk_nearest_dists_sqr, dtype=torch.long
+        ).scatter_reduce(
+            0,
+            candidate_queries[candidate_is_nearest],
+            candidate_valid_ref_idxs[candidate_is_nearest],
+            reduce="amax",
+            include_self=False,
+        )
+        nearest_dists_sqr[chunk_start:chunk_end] = chunk_nearest_dists_sqr
+        chunk_start = chunk_end
+    nearest_idxs[query_batch_idxs, query_idxs] = ref_idxs[nearest_valid_ref_idxs]
+
+    # a closer reference than one at more than one voxel size may be outside
+    # of the neighbor voxels
+    needs_fallback = nearest_dists_sqr > voxel_size_m**2
+    if needs_fallback.any():
+        for batch_idx in range(query_pts.shape[0]):
+            fallback_query_idxs = query_idxs[
+                needs_fallback & (query_batch_idxs == batch_idx)
+            ]
+            if fallback_query_idxs.shape[0] == 0:
+                continue
+            nearest_idxs[batch_idx, fallback_query_idxs] = brute_force_knn_idxs(
+                ref_pts[batch_idx : batch_idx + 1],
+                query_pts[batch_idx : batch_idx + 1, fallback_query_idxs],
+            )[0, :, 0]
+    return nearest_idxs[..., None]
@@ -0,0 +1,102 @@
+from pathlib import Path
+from typing import Sequence, Tuple
+
+import numpy as np
+
+# Synthetic scans of a spinning lidar in a small scene: a ground plane and a
+# few axis aligned boxes (cars, walls) around the sensor, ray cast like a
+# 64 beam sensor. Scans of consecutive frames are taken from a sensor moving
+# along x, so that odometry has something to register.
+SCENE_BOXES = (
+    # (min x, min y, min z), (max x, max y, max z) in world coordinates
+    ((6.0, 2.0, -1.73), (10.5, 4.0, -0.2)),
+    ((12.0, -5.0, -1.73), (16.0, -3.0, -0.1)),
+    ((-9.0, -4.0, -1.73), (-5.0, -2.2, -0.3)),
+    ((-30.0, 9.0, -1.73), (40.0, 10.0, 2.0)),
+    ((-30.0, -12.0, -1.73), (40.0, -11.0, 2.0)),
+    ((25.0, -3.0, -1.73), (26.0, 5.0, 1.0)),
+)
+GROUND_Z = -1.73
+
+
+def get_ray_directions(num_beams: int = 64, num_azimuths: int = 512) -> np.ndarray:
+    elevations = np.deg2rad(np.linspace(-24.8, 2.0, num_beams))
+    azimuths = np.linspace(-np.pi, np.pi, num_azimuths, endpoint=False)
+    elevations, azimuths = np.meshgrid(elevations, azimuths, indexing="ij")
+    return np.stack(
+        [
+            np.cos(elevations) * np.cos(azimuths),
+            np.cos(elevations) * np.sin(azimuths),
+            np.sin(elevations),
+        ],
+        axis=-1,
+    ).reshape(-1, 3)
+
+
+def cast_rays(
+    origin: np.ndarray,
+    directions: np.ndarray,
+    boxes: Sequence[Tuple[Sequence[float], Sequence[float]]] = SCENE_BOXES,
+    max_range: float = 80.0,
+) -> np.ndarray:
+    """Distance along each ray to the first hit, inf for rays without hit."""
+    with np.errstate(divide="ignore", invalid="ignore"):
+        ranges = np.where(
+            directions[:, 2] < 0.0, (GROUND_Z - origin[2]) / directions[:, 2], np.inf
+        )
+        for box_min, box_max in boxes:
+            t_lower = (np.asarray(box_min) - origin) / directions
+            t_upper = (np.asarray(box_max) - origin) / directions
+            t_enter = np.nanmax(np.minimum(t_lower, t_upper), axis=-1)
+            t_exit = np.nanmin(np.maximum(t_lower, t_upper), axis=-1)
+            is_hit = (t_enter <= t_exit) & (t_enter > 0.0)
+            ranges = np.where(is_hit, np.minimum(ranges, t_enter), ranges)
+    return np.where(ranges <= max_range, ranges, np.inf)
+
+
+def make_scan(
+    sensor_position: Sequence[float],
+    rng: np.random.Generator,
+    num_beams: int = 64,
+    num_azimuths: int = 512,
+    range_noise_m: float = 0.01,
+) -> np.ndarray:
+    """float32 [N, 4] x, y, z, intensity in the sensor frame."""
+    origin = np.asarray(sensor_position, dtype=np.float64)
+    directions = get_ray_directions(num_beams, num_azimuths)
+    ranges = cast_rays(origin, directions)
+    is_hit = np.isfinite(ranges)
+    ranges = ranges[is_hit] + rng.normal(scale=range_noise_m, size=is_hit.sum())
+    points = directions[is_hit] * ranges[:, None]
+    intensities = rng.uniform(0.0, 1.0, size=(points.shape[0], 1))
+    return np.concatenate([points, intensities], axis=-1).astype(np.float32)
+
+
+def make_sequence(
+    num_frames: int, step_m: float = 0.5, seed: int = 0, **scan_kwargs
+) -> Tuple[np.ndarray, ...]:
+    rng = np.random.default_rng(seed)
+    return tuple(
+        make_scan((frame_idx * step_m, 0.0, 0.0), rng, **scan_kwargs)
+        for frame_idx in range(num_frames)
+    )
+
+
+def write_binary_pcd(pcd_file: Path, pcl: np.ndarray) -> None:
+    """x, y, z, intensity as float32 binary PCD v0.7."""
+    header = (
+        "# .PCD v0.7 - Point Cloud Data file format\n"
+        "VERSION 0.7\n"
+        "FIELDS x y z intensity\n"
+        "SIZE 4 4 4 4\n"
+        "TYPE F F F F\n"
+        "COUNT 1 1 1 1\n"
+        f"WIDTH {pcl.shape[0]}\n"
+        "HEIGHT 1\n"
+        "VIEWPOINT 0 0 0 1 0 0 0\n"
+        f"POINTS {pcl.shape[0]}\n"
+        "DATA binary\n"
+    )
+    with open(pcd_file, "wb") as f:
+        f.write(header.encode("ascii"))
+        f.write(np.ascontiguousarray(pcl, dtype="<f4").tobytes())
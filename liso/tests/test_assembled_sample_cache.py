@@ -0,0 +1,50 @@
+import numpy as np
+from liso.datasets.assembled_sample_cache import (
+    AssembledSampleCache,
+    get_package_source_hash,
+)
+from liso.kabsch.shape_utils import Shape
+
+
+def get_sample_datas():
+    boxes = Shape(
+        pos=np.zeros((2, 3), dtype=np.float32),
+        dims=np.ones((2, 3), dtype=np.float32),
+        rot=np.zeros((2, 1), dtype=np.float32),
+        probs=np.ones((2, 1), dtype=np.float32),
+        valid=np.ones(2, dtype=bool),
+    )
+    sample_data_ta = {"pcl": np.arange(12, dtype=np.float32).reshape(4, 3)}
+    sample_data_tb = {"gt": {"boxes": boxes}, "empty": {}}
+    return sample_data_ta, sample_data_tb, {"sample_id": np.array("00017")}
+
+
+def test_cache_roundtrip(tmp_path):
+    cache = AssembledSampleCache(tmp_path)
+    assert cache.load("ab12") is None
+    cache.save("ab12", get_sample_datas())
+    sample_data_ta, sample_data_tb, meta = cache.load("ab12")
+    np.testing.assert_array_equal(sample_data_ta["pcl"], get_sample_datas()[0]["pcl"])
+    assert isinstance(sample_data_tb["gt"]["boxes"], Shape)
+    assert sample_data_tb["empty"] == {}
+    assert str(meta["sample_id"]) == "00017"
+
+
+def test_uncachable_samples_warn_once(tmp_path, capsys):
+    cache = AssembledSampleCache(tmp_path)
+    sample_datas = ({"names": np.array([None, "car"], dtype=object)}, {}, {})
+    for key in ("ab12", "ab34", "cd56"):
+        cache.save(key, sample_datas)
+        assert cache.load(key) is None
+    assert cache.num_not_cached == 3
+    assert capsys.readouterr().out.count("Warning: not caching") == 1
+
+
+def test_package_source_hash_covers_all_modules(tmp_path):
+    (tmp_path / "datasets").mkdir()
+    module = tmp_path / "datasets" / "loader.py"
+    module.write_text("SCALE = 1.0\n")
+    source_hash = get_package_source_hash(tmp_path)
+    module.write_text("SCALE = 2.0\n")
+    get_package_source_hash.cache_clear()
+    assert get_package_source_hash(tmp_path) != source_hash
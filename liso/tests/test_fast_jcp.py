@@ -0,0 +1,95 @@
+import os
+from pathlib import Path
+
+import numba
+import numpy as np
+import pytest
+from liso.datasets.tartu.pcd_reader import read_pcd_xyzi
+from liso.jcp import fast_jcp, jcp
+from liso.tests.synthetic_lidar import GROUND_Z, make_scan
+
+# fast_jcp must give exactly the labels of the reference implementation in
+# liso.jcp.jcp, for single frames and for batches. Recorded frames are used in
+# addition to the synthetic scans if LISO_TEST_PCD_DIR points to a directory
+# of PCD files. Timing lives in liso/jcp/benchmark_jcp.py.
+JCP_PARAMS = {
+    # TARTU_JCP_PARAMS of create_tartu, also used for KITTI
+    "tartu": {
+        "range_img_width": 2083,
+        "range_img_height": 64,
+        "sensor_height": 1.73,
+        "delta_R": 1,
+    },
+    # ground label cache of the waymo dataset
+    "waymo": {
+        "range_img_width": 2000,
+        "range_img_height": 60,
+        "sensor_height": 1.8,
+        "delta_R": 2,
+    },
+}
+# JPCGroundRemoveBatch starts numba worker threads, with the tbb layer the
+# test process then hangs at exit once another test forks a process pool
+numba.config.THREADING_LAYER = "workqueue"
+NUM_SYNTHETIC_FRAMES = 4
+NUM_RECORDED_FRAMES = 8
+RECORDED_PCD_DIR_ENV_VAR = "LISO_TEST_PCD_DIR"
+
+
+def get_synthetic_scans(jcp_params, seed=0):
+    # sensor at the height of the parameter set above the ground, driving
+    # through the scene, with a beam count that does not match the image
+    rng = np.random.default_rng(seed)
+    sensor_z = jcp_params["sensor_height"] + GROUND_Z
+    return [
+        make_scan(
+            (3.0 * frame_idx, 0.3 * frame_idx, sensor_z),
+            rng,
+            num_beams=jcp_params["range_img_height"] + 8 * frame_idx,
+            num_azimuths=jcp_params["range_img_width"],
+            range_noise_m=0.02,
+        )[:, :3]
+        for frame_idx in range(NUM_SYNTHETIC_FRAMES)
+    ]
+
+
+def get_recorded_scans():
+    pcd_dir = os.environ.get(RECORDED_PCD_DIR_ENV_VAR)
+    if pcd_dir is None:
+        pytest.skip(f"{RECORDED_PCD_DIR_ENV_VAR} not set")
+    pcd_files = sorted(Path(pcd_dir).glob("*.pcd"))[:NUM_RECORDED_FRAMES]
+    assert len(pcd_files) > 0, f"no pcd files found in {pcd_dir}"
+    return [read_pcd_xyzi(str(pcd_file))[:, :3] for pcd_file in pcd_files]
+
+
+def assert_same_labels(pcls, jcp_params):
+    reference_labels = [jcp.JPCGroundRemove(pcl=pcl, **jcp_params) for pcl in pcls]
+    ground_fraction = np.mean(np.concatenate(reference_labels))
+    assert 0.0 < ground_fraction < 1.0, ground_fraction
+    for pcl, reference in zip(pcls, reference_labels):
+        labels = fast_jcp.JPCGroundRemove(pcl=pcl, **jcp_params)
+        assert labels.dtype == bool and labels.shape == reference.shape
+        np.testing.assert_array_equal(labels, reference)
+    batch_labels = fast_jcp.JPCGroundRemoveBatch(pcls=pcls, **jcp_params)
+    assert len(batch_labels) == len(pcls)
+    for labels, reference in zip(batch_labels, reference_labels):
+        np.testing.assert_array_equal(labels, reference)
+
+
+@pytest.mark.parametrize("params_name", sorted(JCP_PARAMS))
+def test_synthetic_scans(params_name):
+    jcp_params = JCP_PARAMS[params_name]
+    assert_same_labels(get_synthetic_scans(jcp_params), jcp_params)
+
+
+@pytest.mark.parametrize("params_name", sorted(JCP_PARAMS))
+def test_synthetic_float64_scans(params_name):
+    pcls = get_synthetic_scans(JCP_PARAMS[params_name], seed=1)
+    assert_same_labels(
+        [pcl.astype(np.float64) for pcl in pcls[:2]], JCP_PARAMS[params_name]
+    )
+
+
+@pytest.mark.parametrize("params_name", sorted(JCP_PARAMS))
+def test_recorded_scans(params_name):
+    assert_same_labels(get_recorded_scans(), JCP_PARAMS[params_name])
@@ -0,0 +1,254 @@
+import os
+from pathlib import Path
+
+import numpy as np
+import pytest
+from liso.datasets.tartu.pcd_reader import (
+    PCD_TYPE_TO_NUMPY,
+    XYZI_FIELDS,
+    read_pcd_records,
+    read_pcd_xyzi,
+    read_pcd_xyzi_batch,
+)
+
+PointCloud = pytest.importorskip("pypcd4").PointCloud
+
+# The mmap reader must decode exactly what pypcd4 decodes. The files are
+# written by hand, so that the layouts pypcd4 cannot write (padding, COUNT > 1)
+# are covered. Recorded scans are checked as well if LISO_TEST_PCD_DIR points to
+# a directory of PCD files. Timing lives in
+# liso/datasets/tartu/benchmark_pcd_reader.py.
+# layout: (field, TYPE, SIZE, COUNT) per field of the point record
+PCD_LAYOUTS = {
+    "xyzi_f4": [
+        ("x", "F", 4, 1),
+        ("y", "F", 4, 1),
+        ("z", "F", 4, 1),
+        ("intensity", "F", 4, 1),
+    ],
+    "ouster": [
+        ("x", "F", 4, 1),
+        ("y", "F", 4, 1),
+        ("z", "F", 4, 1),
+        ("intensity", "F", 4, 1),
+        ("t", "U", 4, 1),
+        ("reflectivity", "U", 2, 1),
+        ("ring", "U", 1, 1),
+        ("ambient", "U", 2, 1),
+        ("range", "U", 4, 1),
+    ],
+    "intensity_first": [
+        ("intensity", "F", 4, 1),
+        ("x", "F", 4, 1),
+        ("y", "F", 4, 1),
+        ("z", "F", 4, 1),
+    ],
+    "xyz_f8_leading_ring": [
+        ("ring", "U", 2, 1),
+        ("x", "F", 8, 1),
+        ("y", "F", 8, 1),
+        ("z", "F", 8, 1),
+        ("intensity", "U", 1, 1),
+    ],
+    "padding": [
+        ("x", "F", 4, 1),
+        ("y", "F", 4, 1),
+        ("z", "F", 4, 1),
+        ("_", "U", 1, 4),
+        ("intensity", "I", 2, 1),
+        ("_", "U", 1, 2),
+    ],
+    "count_above_one": [
+        ("normal", "F", 4, 3),
+        ("x", "F", 4, 1),
+        ("y", "F", 4, 1),
+        ("z", "F", 4, 1),
+        ("intensity", "F", 8, 1),
+        ("histogram", "I", 4, 5),
+    ],
+}
+# layouts with x, y, z, intensity as adjacent float32 values
+FUSED_LAYOUTS = ("xyzi_f4", "ouster")
+NUM_POINTS = 257
+NUM_RECORDED_FILES = 16
+RECORDED_PCD_DIR_ENV_VAR = "LISO_TEST_PCD_DIR"
+
+
+def get_field_dtype(pcd_type, size, count):
+    field_dtype = np.dtype(PCD_TYPE_TO_NUMPY[(pcd_type, size)])
+    return field_dtype if count == 1 else np.dtype((field_dtype, (count,)))
+
+
+def make_points(layout, rng):
+    # packed records, padding fields get unique names
+    record_dtype = np.dtype(
+        [
+            (f"_{i}" if field == "_" else field, get_field_dtype(*field_type))
+            for i, (field, *field_type) in enumerate(layout)
+        ]
+    )
+    points = np.empty(NUM_POINTS, dtype=record_dtype)
+    for name in record_dtype.names:
+        base_dtype = record_dtype[name].base
+        if base_dtype.kind == "f":
+            values = rng.uniform(-80.0, 80.0, points[name].shape)
+        else:
+            values = rng.integers(
+                np.iinfo(base_dtype).min, np.iinfo(base_dtype).max, points[name].shape
+            )
+        points[name] = values.astype(base_dtype)
+    return points
+
+
+def write_pcd(pcd_file, layout, points, data):
+    fields, types, sizes, counts = zip(*layout)
+    header = (
+        "# .PCD v0.7 - Point Cloud Data file format\n"
+        "VERSION 0.7\n"
+        f"FIELDS {' '.join(fields)}\n"
+        f"SIZE {' '.join(map(str, sizes))}\n"
+        f"TYPE {' '.join(types)}\n"
+        f"COUNT {' '.join(map(str, counts))}\n"
+        f"WIDTH {points.shape[0]}\n"
+        "HEIGHT 1\n"
+        "VIEWPOINT 0 0 0 1 0 0 0\n"
+        f"POINTS {points.shape[0]}\n"
+        f"DATA {data}\n"
+    )
+    if data == "binary":
+        body = points.tobytes()
+    else:
+        # enough digits to read back the exact values
+        value_formats = {4: "{:.9g}", 8: "{:.17g}"}
+        lines = []
+        for point in points:
+            values = []
+            for name, (_, pcd_type, size, _) in zip(points.dtype.names, layout):
+                value_format = value_formats[size] if pcd_type == "F" else "{:d}"
+                values.extend(
+                    value_format.format(value)
+                    for value in np.atleast_1d(point[name]).tolist()
+                )
+            lines.append(" ".join(values) + "\n")
+        body = "".join(lines).encode("ascii")
+    pcd_file.write_bytes(header.encode("ascii") + body)
+
+
+@pytest.fixture(params=["binary", "ascii"])
+def data(request):
+    return request.param
+
+
+@pytest.fixture(params=sorted(PCD_LAYOUTS))
+def layout_name(request):
+    return request.param
+
+
+@pytest.fixture
+def pcd_file_and_points(tmp_path, layout_name, data):
+    rng = np.random.default_rng(sorted(PCD_LAYOUTS).index(layout_name))
+    layout = PCD_LAYOUTS[layout_name]
+    points = make_points(layout, rng)
+    pcd_file = tmp_path / f"{layout_name}_{data}.pcd"
+    write_pcd(pcd_file, layout, points, data)
+    return pcd_file, points
+
+
+def test_read_pcd_xyzi_matches_pypcd4(pcd_file_and_points):
+    pcd_file, points = pcd_file_and_points
+    expected = np.stack([points[f].astype(np.float32) for f in XYZI_FIELDS], axis=-1)
+    pypcd4_points = PointCloud.from_path(pcd_file).numpy(XYZI_FIELDS)
+    np.testing.assert_array_equal(pypcd4_points.astype(np.float32), expected)
+
+    decoded = read_pcd_xyzi(str(pcd_file))
+    assert decoded.dtype == np.float32 and decoded.shape == (NUM_POINTS, 4)
+    assert decoded.flags.writeable and decoded.flags.c_contiguous
+    np.testing.assert_array_equal(decoded, expected)
+    for batch_decoded in read_pcd_xyzi_batch([str(pcd_file)] * 2, readahead=1):
+        np.testing.assert_array_equal(batch_decoded, expected)
+
+
+def test_read_pcd_xyzi_view(pcd_file_and_points, layout_name, data):
+    pcd_file, points = pcd_file_and_points
+    if data != "binary" or layout_name not in FUSED_LAYOUTS:
+        with pytest.raises(ValueError, match=str(pcd_file)):
+            read_pcd_xyzi(str(pcd_file), copy=False)
+        return
+    view = read_pcd_xyzi(str(pcd_file), copy=False)
+    assert not view.flags.writeable
+    np.testing.assert_array_equal(
+        view, np.stack([points[f] for f in XYZI_FIELDS], axis=-1)
+    )
+
+
+@pytest.mark.parametrize(
+    "fields", [("x", "y", "z"), ("z", "intensity"), ("intensity", "x", "y", "z")]
+)
+def test_read_pcd_xyzi_selects_fields_by_name(pcd_file_and_points, fields):
+    pcd_file, points = pcd_file_and_points
+    np.testing.assert_array_equal(
+        read_pcd_xyzi(str(pcd_file), fields=fields),
+        np.stack([points[f].astype(np.float32) for f in fields], axis=-1),
+    )
+
+
+def test_read_pcd_records(tmp_path, layout_name):
+    layout = PCD_LAYOUTS[layout_name]
+    points = make_points(layout, np.random.default_rng(0))
+    pcd_file = tmp_path / "points.pcd"
+    write_pcd(pcd_file, layout, points, "binary")
+    records = read_pcd_records(str(pcd_file))
+    assert records.dtype.itemsize == points.dtype.itemsize
+    assert "_" not in records.dtype.names
+    point_names = [name for name in points.dtype.names if not name.startswith("_")]
+    assert list(records.dtype.names) == point_names
+    for name in point_names:
+        np.testing.assert_array_equal(records[name], points[name])
+
+    write_pcd(pcd_file, layout, points, "ascii")
+    with pytest.raises(ValueError, match="cannot memory map DATA ascii"):
+        read_pcd_records(str(pcd_file))
+
+
+def test_binary_compressed_is_delegated_to_pypcd4(tmp_path):
+    from pypcd4 import Encoding
+
+    points = np.random.default_rng(0).uniform(-80, 80, (NUM_POINTS, 4))
+    pcd_file = tmp_path / "compressed.pcd"
+    PointCloud.from_xyzi_points(points.astype(np.float32)).save(
+        pcd_file, encoding=Encoding.BINARY_COMPRESSED
+    )
+    np.testing.assert_array_equal(
+        read_pcd_xyzi(str(pcd_file)), points.astype(np.float32)
+    )
+
+
+@pytest.mark.parametrize(
+    "fields,message",
+    [
+        (XYZI_FIELDS, "no field 'intensity' in PCD fields \\('x', 'y', 'z', '_',"),
+        (("x", "y", "_"), "no field '_'"),
+        (("normal",), "field 'normal' has COUNT 3, not 1"),
+    ],
+)
+def test_read_pcd_xyzi_missing_field(tmp_path, data, fields, message):
+    layout = [("x", "F", 4, 1), ("y", "F", 4, 1), ("z", "F", 4, 1)]
+    layout += [("_", "U", 1, 4), ("normal", "F", 4, 3)]
+    pcd_file = tmp_path / "xyz.pcd"
+    write_pcd(pcd_file, layout, make_points(layout, np.random.default_rng(0)), data)
+    for copy in (True, False):
+        with pytest.raises(ValueError, match=message):
+            read_pcd_xyzi(str(pcd_file), copy=copy, fields=fields)
+
+
+def test_recorded_pcds_match_pypcd4():
+    pcd_dir = os.environ.get(RECORDED_PCD_DIR_ENV_VAR)
+    if pcd_dir is None:
+        pytest.skip(f"{RECORDED_PCD_DIR_ENV_VAR} not set")
+    pcd_files = sorted(Path(pcd_dir).glob("*.pcd"))[:NUM_RECORDED_FILES]
+    assert len(pcd_files) > 0, f"no pcd files found in {pcd_dir}"
+    for pcd_file in pcd_files:
+        np.testing.assert_array_equal(
+            read_pcd_xyzi(str(pcd_file)),
+            PointCloud.from_path(pcd_file).numpy(XYZI_FIELDS).astype(np.float32),
+        )
@@ -0,0 +1,73 @@
+import os
+import sys
+
+import numpy as np
+from liso.utils.file_utils import load_json
+from liso.utils.shard_archive import (
+    ShardedArchiveReader,
+    ShardedArchiveWriter,
+    get_archive_dir,
+    main,
+)
+
+
+def pack(monkeypatch, dataset_dir):
+    monkeypatch.setattr(sys, "argv", ["shard_archive", str(dataset_dir)])
+    main()
+    return ShardedArchiveReader(get_archive_dir(dataset_dir))
+
+
+def load_pack_index_members(dataset_dir):
+    return load_json(get_archive_dir(dataset_dir) / "index-pack.json")["members"]
+
+
+def test_most_recent_writer_wins(tmp_path):
+    # "pack" sorts before "worker-0" but writes last
+    with ShardedArchiveWriter(tmp_path, writer_name="worker-0") as writer:
+        writer.add_bytes("a.npy", b"old")
+        writer.add_bytes("b.npy", b"only")
+    with ShardedArchiveWriter(tmp_path, writer_name="pack") as writer:
+        writer.add_bytes("a.npy", b"new")
+    reader = ShardedArchiveReader(tmp_path)
+    assert reader.read_bytes("a.npy") == b"new"
+    assert reader.read_bytes("b.npy") == b"only"
+
+    with ShardedArchiveWriter(tmp_path, writer_name="worker-0") as writer:
+        writer.add_bytes("a.npy", b"newest")
+    assert ShardedArchiveReader(tmp_path).read_bytes("a.npy") == b"newest"
+
+
+def test_save_and_load_sample(tmp_path):
+    payload = np.arange(12, dtype=np.float32).reshape(3, 4)
+    with ShardedArchiveWriter(tmp_path) as writer:
+        writer.save_sample(np.save, "seq/0.npy", payload)
+    loaded = ShardedArchiveReader(tmp_path).load_sample("seq/0.npy", np.load)
+    assert np.array_equal(loaded, payload)
+
+
+def test_repack_rewritten_files_of_same_size(tmp_path, monkeypatch):
+    dataset_dir = tmp_path / "dataset"
+    dataset_dir.mkdir()
+    for name in ("0.npy", "1.npy", "2.npy"):
+        (dataset_dir / name).write_bytes(b"old-" + name.encode())
+    assert pack(monkeypatch, dataset_dir).read_bytes("0.npy") == b"old-0.npy"
+
+    # fixed size records: rewritten content of the same size
+    (dataset_dir / "0.npy").write_bytes(b"new-0.npy")
+    # same content, new mtime
+    (dataset_dir / "1.npy").write_bytes(b"old-1.npy")
+    for name in ("0.npy", "1.npy"):
+        mtime_ns = (dataset_dir / name).stat().st_mtime_ns + 10**9
+        os.utime(dataset_dir / name, ns=(mtime_ns, mtime_ns))
+    write_times_before = {
+        name: member[3] for name, member in load_pack_index_members(dataset_dir).items()
+    }
+    reader = pack(monkeypatch, dataset_dir)
+    assert reader.read_bytes("0.npy") == b"new-0.npy"
+    assert reader.read_bytes("1.npy") == b"old-1.npy"
+    write_times_after = {
+        name: member[3] for name, member in load_pack_index_members(dataset_dir).items()
+    }
+    assert write_times_after["0.npy"] > write_times_before["0.npy"]
+    assert write_times_after["1.npy"] == write_times_before["1.npy"]
+    assert write_times_after["2.npy"] == write_times_before["2.npy"]
@@ -0,0 +1,271 @@
+import sys
+from pathlib import Path
+from types import ModuleType, SimpleNamespace
+from typing import List
+
+import numpy as np
+import pytest
+from liso.datasets.columnar_samples import load_sample_content, save_columnar_sample
+from liso.datasets.tartu.tartu_frame_store import load_tartu_sample
+from liso.jcp import jcp
+from liso.tests.synthetic_lidar import make_sequence, write_binary_pcd
+from liso.utils.cloud_utils import CloudLoaderSaver
+
+# The creators write every sample once, with the KISS-ICP odometry of a
+# separate streaming pose pass. The flow they replace wrote samples while
+# registering frames and then reloaded and rewrote them to add the
+# kiss_odom_* keys. Each test runs that flow next to the creator:
+#  - tartu: the replaced flow is transcribed from the old create_tartu loop.
+#    Samples are now records referencing stored frames, so the contents
+#    loaded by load_tartu_sample are compared key by key with the old pickled
+#    dicts: same keys in the same order, dtypes, shapes and array bytes.
+#  - kitti: samples are columnar files, compared byte by byte.
+# What is tested is how samples are emitted, not ICP: KISS-ICP is replaced by
+# a deterministic odometry that derives a pose from each registered frame.
+NUM_FRAMES = 6
+
+
+class FrameStatisticsOdometry:
+    def __init__(self, config=None):
+        self.poses = []
+
+    def register_frame(self, frame: np.ndarray, timestamps: np.ndarray):
+        assert timestamps.shape[0] == frame.shape[0], (timestamps.shape, frame.shape)
+        yaw = 0.01 * frame[:, 0].std()
+        pose = np.eye(4)
+        pose[:2, :2] = [[np.cos(yaw), -np.sin(yaw)], [np.sin(yaw), np.cos(yaw)]]
+        pose[:3, 3] = -frame.mean(axis=0)
+        self.poses.append(pose)
+
+
+@pytest.fixture
+def fake_kiss_icp(monkeypatch):
+    kiss_config = SimpleNamespace(
+        mapping=SimpleNamespace(voxel_size=None), data=SimpleNamespace(max_range=100.0)
+    )
+    modules = {
+        "kiss_icp": ModuleType("kiss_icp"),
+        "kiss_icp.config": SimpleNamespace(KISSConfig=lambda: kiss_config),
+        "kiss_icp.kiss_icp": SimpleNamespace(KissICP=FrameStatisticsOdometry),
+        "kiss_icp.datasets": ModuleType("kiss_icp.datasets"),
+        "kiss_icp.datasets.kitti_raw": SimpleNamespace(
+            KITTIRawDataset=SimpleNamespace(
+                get_timestamps=lambda pcl: np.zeros(pcl.shape[0], dtype=np.float32)
+            )
+        ),
+    }
+    for module_name, module in modules.items():
+        monkeypatch.setitem(sys.modules, module_name, module)
+
+
+def get_sample_file_bytes(sample_dir: Path):
+    return {
+        sample_file.name: sample_file.read_bytes()
+        for sample_file in sorted(sample_dir.glob("*.npy"))
+    }
+
+
+def write_legacy_tartu_samples(date: str, pcd_files: List[str], target_dir: Path):
+    # the replaced create_tartu loop: samples are saved while their frames are
+    # registered, then reloaded and saved again with the kiss_odom_* keys
+    from kiss_icp.config import KISSConfig
+    from kiss_icp.kiss_icp import KissICP
+    from pypcd4 import PointCloud
+
+    def load_pcl_get_ground_label(pcd_file):
+        pcl = PointCloud.from_path(pcd_file).numpy()[:, :4]
+        is_ground = jcp.JPCGroundRemove(
+            pcl=pcl[:, :3],
+            range_img_width=2083,
+            range_img_height=64,
+            sensor_height=1.73,
+            delta_R=1,
+        )
+        return pcl, is_ground
+
+    def register_frame(pcl):
+        odometry.register_frame(
+            np.copy(pcl[:, :3].astype(np.float64)),
+            timestamps=np.zeros_like(pcl[:, :3]).astype(np.float64),
+        )
+
+    kiss_config = KISSConfig()
+    kiss_config.mapping.voxel_size = 0.01 * kiss_config.data.max_range
+    odometry = KissICP(config=kiss_config)
+    seq_idxs = list(range(len(pcd_files) - 2))
+    sample_files = []
+    for idx in seq_idxs:
+        pcl_t0, is_ground_t0 = load_pcl_get_ground_label(pcd_files[idx])
+        register_frame(pcl_t0)
+        pcl_t1, is_ground_t1 = load_pcl_get_ground_label(pcd_files[idx + 1])
+        pcl_t2, is_ground_t2 = load_pcl_get_ground_label(pcd_files[idx + 2])
+        sample_name = f"{date}_0_{Path(pcd_files[idx]).stem}"
+        sample_files.append(target_dir / f"{sample_name}.npy")
+        np.save(
+            sample_files[-1],
+            {
+                "pcl_t0": pcl_t0.astype(np.float32),
+                "pcl_t1": pcl_t1.astype(np.float32),
+                "pcl_t2": pcl_t2.astype(np.float32),
+                "is_ground_t0": is_ground_t0,
+                "is_ground_t1": is_ground_t1,
+                "is_ground_t2": is_ground_t2,
+                "name": sample_name,
+            },
+        )
+        if idx == seq_idxs[-1]:
+            register_frame(pcl_t1)
+            register_frame(pcl_t2)
+
+    w_Ts_si = odometry.poses
+    for idx, sample_file in enumerate(sample_files):
+        content = np.load(sample_file, allow_pickle=True).item()
+        odom_t0_t1 = np.linalg.inv(w_Ts_si[idx]) @ w_Ts_si[idx + 1]
+        odom_t0_t2 = np.linalg.inv(w_Ts_si[idx]) @ w_Ts_si[idx + 2]
+        odom_t1_t2 = np.linalg.inv(w_Ts_si[idx + 1]) @ w_Ts_si[idx + 2]
+        content["kiss_odom_t0_t1"] = odom_t0_t1
+        content["kiss_odom_t1_t0"] = np.linalg.inv(odom_t0_t1)
+        content["kiss_odom_t0_t2"] = odom_t0_t2
+        content["kiss_odom_t2_t0"] = np.linalg.inv(odom_t0_t2)
+        content["kiss_odom_t1_t2"] = odom_t1_t2
+        content["kiss_odom_t2_t1"] = np.linalg.inv(odom_t1_t2)
+        np.save(sample_file, content)
+
+
+def assert_same_sample_content(content, reference):
+    assert list(content) == list(reference)
+    for key, reference_value in reference.items():
+        if isinstance(reference_value, str):
+            assert content[key] == reference_value, key
+            continue
+        value = np.asarray(content[key])
+        assert value.dtype == reference_value.dtype, (key, value.dtype)
+        assert value.shape == reference_value.shape, (key, value.shape)
+        assert value.tobytes() == reference_value.tobytes(), key
+
+
+def test_tartu_samples_match_the_replaced_flow(tmp_path, monkeypatch, fake_kiss_icp):
+    from liso.datasets.tartu import create_tartu
+
+    date = "2023_05_17"
+    pcd_dir = tmp_path / "raw" / date / "lidar_center"
+    pcd_dir.mkdir(parents=True)
+    for frame_idx, pcl in enumerate(make_sequence(NUM_FRAMES)):
+        write_binary_pcd(pcd_dir / f"{1684300000 + frame_idx}.100000.pcd", pcl)
+    pcd_files = [str(pcd_file) for pcd_file in sorted(pcd_dir.glob("*.pcd"))]
+    reference_dir = tmp_path / "reference"
+    reference_dir.mkdir()
+    write_legacy_tartu_samples(date, pcd_files, reference_dir)
+    reference = {
+        sample_file.name: np.load(sample_file, allow_pickle=True).item()
+        for sample_file in sorted(reference_dir.glob("*.npy"))
+    }
+    assert len(reference) == NUM_FRAMES - 2
+
+    sample_dir = tmp_path / "out" / "tartu_raw"
+
+    def run_create_tartu():
+        monkeypatch.setattr(
+            sys,
+            "argv",
+            [
+                "create_tartu",
+                "--target_dir",
+                str(tmp_path / "out"),
+                "--tartu_raw_root",
+                str(tmp_path / "raw"),
+                "--num_workers",
+                "1",
+            ],
+        )
+        create_tartu.main()
+        sample_files = sorted(sample_dir.glob("*.npy"))
+        assert [sample_file.name for sample_file in sample_files] == list(reference)
+        for sample_file in sample_files:
+            assert_same_sample_content(
+                load_tartu_sample(sample_file, CloudLoaderSaver()),
+                reference[sample_file.name],
+            )
+
+    run_create_tartu()
+    # resumed run: records are rewritten from the persisted pose table
+    for sample_file in sample_dir.glob("*.npy"):
+        sample_file.unlink()
+    (sample_dir / "dataset_manifest.json").unlink()
+    run_create_tartu()
+
+
+def test_kitti_raw_samples_are_byte_identical(tmp_path, monkeypatch, fake_kiss_icp):
+    pytest.importorskip("pykitti")
+    from kiss_icp.config import KISSConfig
+    from kiss_icp.datasets.kitti_raw import KITTIRawDataset
+    from kiss_icp.kiss_icp import KissICP
+    from liso.datasets.kitti import create_kitti_raw
+
+    # deskewing of the scan is part of the replaced odometry
+    monkeypatch.setattr(create_kitti_raw, "correct_kitti_scan", lambda frame: frame)
+
+    date, drive_str = "2011_09_26", "0001"
+    velo_dir = tmp_path / "velodyne_points"
+    velo_dir.mkdir()
+    for frame_idx, pcl in enumerate(make_sequence(NUM_FRAMES)):
+        pcl.astype(np.float32).tofile(velo_dir / f"{frame_idx:010d}.bin")
+    velo_files = [str(velo_file) for velo_file in sorted(velo_dir.glob("*.bin"))]
+    rng = np.random.default_rng(0)
+    w_Ts_imu = np.tile(np.eye(4), (NUM_FRAMES, 1, 1))
+    w_Ts_imu[:, :3, 3] = rng.normal(size=(NUM_FRAMES, 3))
+    kitti = SimpleNamespace(
+        velo_files=velo_files,
+        oxts=[SimpleNamespace(T_w_imu=w_T_imu) for w_T_imu in w_Ts_imu],
+        calib=SimpleNamespace(T_velo_imu=np.eye(4)),
+    )
+    seq_idxs = list(range(NUM_FRAMES - 2))
+
+    # previous flow: save samples while registering, reload, add the
+    # odometry, save again
+    reference_dir = tmp_path / "reference"
+    reference_dir.mkdir()
+    kiss_config = KISSConfig()
+    kiss_config.mapping.voxel_size = 0.01 * kiss_config.data.max_range
+    odometry = KissICP(config=kiss_config)
+
+    def register_frame(velo_file):
+        kitti_pcl = np.fromfile(velo_file, dtype=np.float32).reshape(-1, 4)
+        odometry.register_frame(
+            create_kitti_raw.correct_kitti_scan(
+                np.copy(kitti_pcl[:, :3]).astype(np.float64)
+            ),
+            timestamps=KITTIRawDataset.get_timestamps(kitti_pcl).astype(np.float64),
+        )
+
+    placeholder_poses = np.tile(np.eye(4), (NUM_FRAMES, 1, 1))
+    for idx in seq_idxs:
+        register_frame(velo_files[idx])
+        sample_name, data_dict = create_kitti_raw.create_kitti_raw_sample(
+            kitti, date, drive_str, idx, placeholder_poses
+        )
+        save_columnar_sample(
+            reference_dir / f"{sample_name}.npy",
+            {k: v for k, v in data_dict.items() if not k.startswith("kiss_odom_")},
+        )
+    for velo_file in velo_files[-2:]:
+        register_frame(velo_file)
+    w_Ts_si = np.asarray(odometry.poses)
+    for idx, sample_file in zip(seq_idxs, sorted(reference_dir.glob("*.npy"))):
+        content = load_sample_content(sample_file, CloudLoaderSaver())
+        content.update(create_kitti_raw.get_kiss_odometry(w_Ts_si, idx))
+        save_columnar_sample(sample_file, content)
+
+    # single pass flow of create_kitti_raw.main
+    target_dir = tmp_path / "kitti_raw"
+    target_dir.mkdir()
+    w_Ts_si = create_kitti_raw.compute_kiss_icp_poses(velo_files)
+    for idx in seq_idxs:
+        sample_name, data_dict = create_kitti_raw.create_kitti_raw_sample(
+            kitti, date, drive_str, idx, w_Ts_si
+        )
+        save_columnar_sample(target_dir / f"{sample_name}.npy", data_dict)
+
+    reference = get_sample_file_bytes(reference_dir)
+    assert len(reference) == NUM_FRAMES - 2
+    assert get_sample_file_bytes(target_dir) == reference
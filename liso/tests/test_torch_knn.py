@@ -0,0 +1,184 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("pynanoflann")
+
+from liso.slim.slim_loss.knn_graph import knn_graph  # noqa: E402
+from liso.slim.slim_loss.torch_knn import (  # noqa: E402
+    DEFAULT_MAX_NUM_CANDIDATES_PER_CHUNK,
+    DEFAULT_MAX_NUM_DISTS_PER_CHUNK,
+    DEFAULT_VOXEL_SIZE_M,
+    brute_force_knn_idxs,
+    voxel_hash_nearest_idxs,
+)
+
+# The torch backends must find neighbors as close as those of the pynanoflann
+# KD-tree of knn_graph. Indices may differ between equidistant references, so
+# the distances to the found neighbors are compared.
+BATCH_SIZE = 2
+NUM_POINTS = 4000
+# per batch element, the clouds of a batch are padded to the same size
+NUM_PADDING_POINTS = (100, 350)
+NUM_FAR_QUERIES = 50
+DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
+
+
+@pytest.fixture(scope="module")
+def clouds():
+    generator = torch.Generator().manual_seed(0)
+    # lidar like: dense close to the sensor, sparse far away
+    ranges = 40.0 * torch.rand(BATCH_SIZE, NUM_POINTS, 1, generator=generator)
+    ref_pts = ranges * torch.nn.functional.normalize(
+        torch.randn(BATCH_SIZE, NUM_POINTS, 3, generator=generator), dim=-1
+    )
+    query_pts = ref_pts + 0.3 * torch.randn(ref_pts.shape, generator=generator)
+    # queries without a reference in their 3x3x3 voxel neighborhood, far
+    # outside of the references or in the sparse outer shell
+    query_pts[:, :NUM_FAR_QUERIES] += 100.0
+    query_pts[:, NUM_FAR_QUERIES : 2 * NUM_FAR_QUERIES] *= 1.5
+    for batch_idx, num_padding_points in enumerate(NUM_PADDING_POINTS):
+        ref_pts[batch_idx, -num_padding_points:] = float("nan")
+        query_pts[batch_idx, -num_padding_points:] = float("nan")
+    # padding is not necessarily at the end, nor made of nan only
+    ref_pts[:, 1000:1010, 1] = float("inf")
+    query_pts[:, 2000:2010, 2] = float("-inf")
+    return ref_pts.to(DEVICE), query_pts.to(DEVICE)
+
+
+def get_nearest_dists(ref_pts, query_pts, nearest_idxs):
+    # nearest_idxs [B, N, 1] -> [B, N] distances of the queries to them
+    nearest_pts = torch.gather(ref_pts, 1, nearest_idxs.repeat(1, 1, 3))
+    return (nearest_pts - query_pts).norm(dim=-1)
+
+
+@pytest.fixture(scope="module")
+def nanoflann_dists(clouds):
+    ref_pts, query_pts = clouds
+    nearest_dists = torch.full(query_pts.shape[:2], float("nan"), device=DEVICE)
+    for batch_idx in range(BATCH_SIZE):
+        valid_ref_idxs = torch.nonzero(torch.isfinite(ref_pts[batch_idx]).all(dim=-1))
+        valid_query_idxs = torch.nonzero(
+            torch.isfinite(query_pts[batch_idx]).all(dim=-1)
+        )[:, 0]
+        nearest_valid_ref_idxs = knn_graph(
+            query_pts[batch_idx, valid_query_idxs],
+            index=ref_pts[batch_idx, valid_ref_idxs[:, 0]],
+            k=1,
+            loop=True,
+        )
+        nearest_dists[batch_idx, valid_query_idxs] = get_nearest_dists(
+            ref_pts[batch_idx : batch_idx + 1],
+            query_pts[batch_idx : batch_idx + 1, valid_query_idxs],
+            valid_ref_idxs[nearest_valid_ref_idxs[:, 0]][None],
+        )[0]
+    return nearest_dists
+
+
+def assert_no_padding_neighbors(ref_pts, knn_idxs, query_is_valid):
+    ref_is_valid = torch.isfinite(ref_pts).all(dim=-1)
+    batch_idxs = torch.arange(BATCH_SIZE, device=DEVICE)[:, None, None]
+    neighbor_is_valid = ref_is_valid[batch_idxs, knn_idxs]
+    assert neighbor_is_valid[query_is_valid].all(), "padding returned as neighbor"
+
+
+def assert_same_nearest_dists(clouds, nanoflann_dists, nearest_idxs):
+    ref_pts, query_pts = clouds
+    assert nearest_idxs.shape == (*query_pts.shape[:2], 1), nearest_idxs.shape
+    assert nearest_idxs.dtype == torch.long, nearest_idxs.dtype
+    query_is_valid = torch.isfinite(nanoflann_dists)
+    assert_no_padding_neighbors(ref_pts, nearest_idxs, query_is_valid)
+    dist_errors = (
+        get_nearest_dists(ref_pts, query_pts, nearest_idxs) - nanoflann_dists
+    )[query_is_valid].abs()
+    assert dist_errors.max().item() < 1e-4, dist_errors.max().item()
+
+
+def test_far_queries_need_fallback(nanoflann_dists):
+    # otherwise the voxel hash fallback to brute force would go untested
+    assert (nanoflann_dists[:, :NUM_FAR_QUERIES] > 50.0).all()
+    num_fallback_queries = (nanoflann_dists > DEFAULT_VOXEL_SIZE_M).sum().item()
+    assert num_fallback_queries > BATCH_SIZE * NUM_FAR_QUERIES, num_fallback_queries
+
+
+@pytest.mark.parametrize(
+    "max_num_dists_per_chunk",
+    # all queries in one chunk, chunks of 64 queries
+    [DEFAULT_MAX_NUM_DISTS_PER_CHUNK, 64 * BATCH_SIZE * NUM_POINTS],
+)
+def test_brute_force_matches_nanoflann(
+    clouds, nanoflann_dists, max_num_dists_per_chunk
+):
+    ref_pts, query_pts = clouds
+    nearest_idxs = brute_force_knn_idxs(
+        ref_pts, query_pts, max_num_dists_per_chunk=max_num_dists_per_chunk
+    )
+    assert_same_nearest_dists(clouds, nanoflann_dists, nearest_idxs)
+
+
+def test_brute_force_k_nearest_are_sorted(clouds):
+    ref_pts, query_pts = clouds
+    knn_idxs = brute_force_knn_idxs(ref_pts, query_pts, k=4)
+    assert knn_idxs.shape == (*query_pts.shape[:2], 4), knn_idxs.shape
+    query_is_valid = torch.isfinite(query_pts).all(dim=-1)
+    nearest_idxs = brute_force_knn_idxs(ref_pts, query_pts)
+    assert (knn_idxs[query_is_valid][:, 0] == nearest_idxs[query_is_valid][:, 0]).all()
+    knn_dists = torch.stack(
+        [
+            get_nearest_dists(ref_pts, query_pts, knn_idxs[..., i : i + 1])
+            for i in range(4)
+        ],
+        dim=-1,
+    )
+    assert (knn_dists[query_is_valid].diff(dim=-1) >= 0.0).all()
+
+
+def test_brute_force_padding(clouds):
+    ref_pts, query_pts = clouds
+    query_is_valid = torch.isfinite(query_pts).all(dim=-1)
+    assert (~query_is_valid).any(dim=-1).all()
+    knn_idxs = brute_force_knn_idxs(ref_pts, query_pts, k=4)
+    assert (knn_idxs[~query_is_valid] == 0).all()
+    assert_no_padding_neighbors(ref_pts, knn_idxs, query_is_valid)
+    # neighbors beyond the finite references
+    num_valid_refs = 3
+    few_ref_pts = torch.full_like(ref_pts, float("nan"))
+    few_ref_pts[:, 10 : 10 + num_valid_refs] = ref_pts[:, :num_valid_refs]
+    knn_idxs = brute_force_knn_idxs(few_ref_pts, query_pts, k=num_valid_refs + 2)
+    valid_knn_idxs = knn_idxs[query_is_valid]
+    assert (valid_knn_idxs[:, :num_valid_refs] >= 10).all()
+    assert (valid_knn_idxs[:, :num_valid_refs] < 10 + num_valid_refs).all()
+    assert (valid_knn_idxs[:, num_valid_refs:] == 0).all()
+
+
+@pytest.mark.parametrize(
+    "voxel_size_m,max_num_candidates_per_chunk",
+    [
+        (DEFAULT_VOXEL_SIZE_M, DEFAULT_MAX_NUM_CANDIDATES_PER_CHUNK),
+        # most queries exceed the budget and get a chunk of their own
+        (DEFAULT_VOXEL_SIZE_M, 16),
+        (0.25, 1000),
+        (4.0, DEFAULT_MAX_NUM_CANDIDATES_PER_CHUNK),
+    ],
+)
+def test_voxel_hash_matches_nanoflann(
+    clouds, nanoflann_dists, voxel_size_m, max_num_candidates_per_chunk
+):
+    ref_pts, query_pts = clouds
+    nearest_idxs = voxel_hash_nearest_idxs(
+        ref_pts,
+        query_pts,
+        voxel_size_m=voxel_size_m,
+        max_num_candidates_per_chunk=max_num_candidates_per_chunk,
+    )
+    assert_same_nearest_dists(clouds, nanoflann_dists, nearest_idxs)
+    # documented index of padding queries
+    assert (nearest_idxs[~torch.isfinite(nanoflann_dists)] == 0).all()
+
+
+def test_voxel_hash_without_valid_points(clouds):
+    ref_pts, query_pts = clouds
+    nearest_idxs = voxel_hash_nearest_idxs(
+        torch.full_like(ref_pts, float("nan")), query_pts
+    )
+    assert nearest_idxs.shape == (*query_pts.shape[:2], 1), nearest_idxs.shape
+    assert (nearest_idxs == 0).all()
@@ -23,7 +23,6 @@ from liso.datasets.nuscenes_torch_dataset import NuscenesDataset
 from liso.datasets.tartu_raw_torch_dataset import TartuRawDataset
 from liso.datasets.torch_dataset_commons import (
     LidarDataset,
-    get_points_in_boxes_mask,
     lidar_dataset_collate_fn,
     worker_init_fn,
 )
@@ -31,6 +30,10 @@ from liso.dataets.waymo_torch_dataset import WaymoDataset
 from liso.eval.eval_ours import count_box_points_in_kitti_annotated_fov, run_val
 from liso.kabsch.main_utils import get_network_input_pcls
 from liso.kabsch.mask_dataset import RecursiveDeviceMover
+from liso.kabsch.points_in_boxes import (
+    count_points_in_boxes,
+    get_points_in_boxes_sparse,
+)
 from liso.kabsch.shape_utils import (
     Shape,
     extract_box_motion_transform_without_sensor_odometry,
@@ -799,11 +802,13 @@ def track_boxes_on_data_sequence(
                         )
                         pred_boxes_for_num_points_filtering.pos = dummy_pos
 
-                    point_is_in_boxes_mask = get_points_in_boxes_mask(
+                    _, box_idxs = get_points_in_boxes_sparse(
                         pred_boxes_for_num_points_filtering,
                         homogenize_pcl(pcl_no_ground[:, :3]),
                     )
-                    num_points_in_box = point_is_in_boxes_mask.sum(dim=0)
+                    num_points_in_box = count_points_in_boxes(
+                        box_idxs, pred_boxes.shape[0]
+                    )
                     box_has_enough_points = (
                         num_points_in_box >= tracking_cfg.min_points_in_box
                     )
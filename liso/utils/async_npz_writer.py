@@ -0,0 +1,114 @@
+import threading
+import zipfile
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from pathlib import Path
+from typing import Any, Dict, List, Tuple, Union
+
+from liso.utils.file_utils import NPZ_CODECS, atomic_write_bytes, npz_bytes
+
+# Background writer for npz exports: compression and writing run in a few
+# threads (zlib, bz2 and lzma release the GIL) while the caller goes on with
+# the next forward pass. At most max_pending_writes arrays dicts are queued,
+# submit blocks while the queue is full, so host memory stays bounded if the
+# disk is slower than inference. Files are written atomically (see
+# atomic_write_bytes), so killed exports leave no truncated npz behind.
+
+
+class AsyncNpzWriter:
+    def __init__(
+        self,
+        num_workers: int = 2,
+        max_pending_writes: int = 8,
+        codec: str = "deflate",
+        compresslevel: int = None,
+    ):
+        assert num_workers > 0, num_workers
+        assert max_pending_writes >= num_workers, (max_pending_writes, num_workers)
+        assert codec in NPZ_CODECS, (codec, tuple(NPZ_CODECS))
+        self.codec = codec
+        self.compresslevel = compresslevel
+        self.pool = ThreadPoolExecutor(
+            max_workers=num_workers, thread_name_prefix="npz_writer"
+        )
+        self.free_slots = threading.BoundedSemaphore(max_pending_writes)
+        self.pending_writes: List[Tuple[Path, Future]] = []
+        # path -> (member names, file size) of every finished write
+        self.written_files: Dict[Path, Tuple[List[str], int]] = {}
+
+    def _write(self, path: Path, arrays: Dict[str, Any]) -> Tuple[List[str], int]:
+        payload = npz_bytes(arrays, codec=self.codec, compresslevel=self.compresslevel)
+        atomic_write_bytes(path, payload)
+        return [name + ".npy" for name in arrays], len(payload)
+
+    def _collect_finished_writes(self) -> List[Tuple[Path, BaseException]]:
+        failed_writes = []
+        still_pending_writes = []
+        for path, future in self.pending_writes:
+            if not future.done():
+                still_pending_writes.append((path, future))
+            elif future.exception() is not None:
+                failed_writes.append((path, future.exception()))
+            else:
+                self.written_files[path] = future.result()
+        self.pending_writes = still_pending_writes
+        return failed_writes
+
+    def submit(self, path: Union[Path, str], arrays: Dict[str, Any]):
+        """Queue arrays to be written to path, blocks while the queue is full.
+
+        The arrays must not be modified until they are written.
+        Raises if an earlier write failed.
+        """
+        failed_writes = self._collect_finished_writes()
+        if len(failed_writes) > 0:
+            path, exception = failed_writes[0]
+            raise RuntimeError(f"Failed to write {path}") from exception
+        self.free_slots.acquire()
+        try:
+            future = self.pool.submit(self._write, Path(path), arrays)
+        except BaseException:
+            self.free_slots.release()
+            raise
+        future.add_done_callback(lambda _: self.free_slots.release())
+        self.pending_writes.append((Path(path), future))
+
+    def flush(self, verify: bool = True) -> List[Path]:
+        """Wait for all queued writes, returns the paths written so far.
+
+        With verify, every written file is checked to exist with the written
+        size and members. Raises if a write failed or a file doesn't check out.
+        """
+        wait([future for _, future in self.pending_writes])
+        failed_writes = self._collect_finished_writes()
+        if verify:
+            for path, (member_names, num_bytes) in self.written_files.items():
+                try:
+                    with zipfile.ZipFile(path) as zip_file:
+                        assert zip_file.namelist() == member_names, (
+                            zip_file.namelist(),
+                            member_names,
+                        )
+                    assert path.stat().st_size == num_bytes, (
+                        path.stat().st_size,
+                        num_bytes,
+                    )
+                except (AssertionError, OSError, zipfile.BadZipFile) as exception:
+                    failed_writes.append((path, exception))
+        if len(failed_writes) > 0:
+            for path, exception in failed_writes[:10]:
+                print(f"Failed to write {path}: {exception!r}")
+            raise RuntimeError(
+                f"{len(failed_writes)} npz writes failed, first: {failed_writes[0][0]}"
+            ) from failed_writes[0][1]
+        return list(self.written_files)
+
+    def close(self):
+        self.pool.shutdown(wait=True)
+
+    def __enter__(self) -> "AsyncNpzWriter":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.flush()
+        self.close()
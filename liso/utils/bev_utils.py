@@ -38,6 +38,23 @@ def get_voxel_center_coords_m(bev_extent_m, net_output_shape_pix):
     return voxel_center_metric_coordinates
 
 
+def get_metric_voxel_center_axes(bev_range_x, bev_range_y, dataset_img_shape):
+    """Bit identical x (rows) and y (columns) of get_metric_voxel_center_coords."""
+    bev_extent_m = 0.5 * np.array(
+        [-bev_range_x, -bev_range_y, bev_range_x, bev_range_y]
+    )
+    bev_extent_size_m = bev_extent_m[2:] - bev_extent_m[:2]
+    axes = []
+    for axis, num_pix in enumerate(dataset_img_shape[:2]):
+        # same operations as get_voxel_center_coords_m, without the meshgrid
+        coords = np.arange(num_pix) + 0.5
+        coords /= num_pix
+        coords *= bev_extent_size_m[axis]
+        coords += bev_extent_m[axis]
+        axes.append(coords)
+    return tuple(axes)
+
+
 def get_bev_setup_params(cfg):
     bev_range_m_np = np.array(cfg.data.bev_range_m, np.float32)
     img_grid_size_np = np.array(cfg.data.img_grid_size).astype(np.int32)
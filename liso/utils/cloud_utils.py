@@ -1,6 +1,9 @@
-from typing import Callable, Dict
+import os
+from pathlib import Path
+from typing import Callable, Dict, Sequence, Union
 
 import numpy as np
+from liso.utils.shard_archive import ShardedArchiveReader, get_archive_dir
 
 
 class CloudLoaderSaver:
@@ -23,6 +26,17 @@ class CloudLoaderSaver:
         """
         return load_fn(path, **kwargs)
 
+    def sample_exists(self, path: str) -> bool:
+        return Path(path).exists()
+
+    def get_sample_fingerprint(self, path: str) -> str:
+        """Changes whenever the file is rewritten, without reading it."""
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return "missing"
+        return f"{stat.st_size}:{stat.st_mtime_ns}"
+
     def save_sample(
         self, save_fn: Callable, path: str, payload: Dict[str, np.ndarray], **kwargs
     ):
@@ -33,3 +47,46 @@ class CloudLoaderSaver:
         """
 
         save_fn(path, payload, **kwargs)
+
+
+class ShardedCloudLoaderSaver(CloudLoaderSaver):
+    """CloudLoaderSaver that serves files from sharded archives if packed there.
+
+    dataset_dirs are directories that have been packed with
+    liso.utils.shard_archive, paths below them are looked up in the archive
+    and fall back to the regular file if they are not a member.
+    """
+
+    def __init__(self, dataset_dirs: Sequence[Union[Path, str]]) -> None:
+        super().__init__()
+        self.archives = {
+            Path(dataset_dir): ShardedArchiveReader(get_archive_dir(dataset_dir))
+            for dataset_dir in dataset_dirs
+        }
+
+    def find_member(self, path: Union[Path, str]):
+        path = Path(path)
+        for dataset_dir, archive in self.archives.items():
+            try:
+                member_name = path.relative_to(dataset_dir).as_posix()
+            except ValueError:
+                continue
+            if member_name in archive:
+                return archive, member_name
+        return None, None
+
+    def sample_exists(self, path: str) -> bool:
+        archive, _ = self.find_member(path)
+        return archive is not None or super().sample_exists(path)
+
+    def get_sample_fingerprint(self, path: str) -> str:
+        archive, member_name = self.find_member(path)
+        if archive is None:
+            return super().get_sample_fingerprint(path)
+        return archive.get_member_fingerprint(member_name)
+
+    def load_sample(self, path: str, load_fn: Callable, **kwargs):
+        archive, member_name = self.find_member(path)
+        if archive is None:
+            return super().load_sample(path, load_fn, **kwargs)
+        return archive.load_sample(member_name, load_fn, **kwargs)
@@ -0,0 +1,116 @@
+import hashlib
+import io
+import json
+import os
+import tempfile
+import zipfile
+from pathlib import Path
+from typing import Any, Dict, Union
+
+import numpy as np
+from liso.utils.timing_utils import timed_stage
+
+
+def atomic_write_bytes(path: Union[Path, str], payload: bytes) -> None:
+    """Write payload to a temp file next to path, then rename it into place.
+
+    Readers (and reruns after a killed job) see either the old file or
+    the complete new one, never a partially written file.
+    """
+    path = Path(path)
+    fd, tmp_path = tempfile.mkstemp(
+        dir=path.parent, prefix=f".{path.name}.", suffix=".tmp"
+    )
+    try:
+        with os.fdopen(fd, "wb") as tmp_file:
+            tmp_file.write(payload)
+            tmp_file.flush()
+            os.fsync(tmp_file.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def remove_stale_tmp_files(directory: Union[Path, str]) -> int:
+    """Remove leftovers of atomic_write_bytes from writers that were killed."""
+    num_removed = 0
+    for tmp_file in Path(directory).glob(".*.tmp"):
+        tmp_file.unlink(missing_ok=True)
+        num_removed += 1
+    return num_removed
+
+
+def sha256_hexdigest(payload: bytes) -> str:
+    return hashlib.sha256(payload).hexdigest()
+
+
+def file_sha256_hexdigest(path: Union[Path, str], chunk_size=1 << 20) -> str:
+    checksum = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            checksum.update(chunk)
+    return checksum.hexdigest()
+
+
+def npy_bytes(payload: Any, allow_pickle=True) -> bytes:
+    buffer = io.BytesIO()
+    np.save(buffer, payload, allow_pickle=allow_pickle)
+    return buffer.getvalue()
+
+
+# zip codecs of npz files, np.load reads all of them
+NPZ_CODECS = {
+    "stored": zipfile.ZIP_STORED,
+    "deflate": zipfile.ZIP_DEFLATED,
+    "bzip2": zipfile.ZIP_BZIP2,
+    "lzma": zipfile.ZIP_LZMA,
+}
+
+
+def npz_bytes(
+    arrays: Dict[str, Any], codec: str = "deflate", compresslevel: int = None
+) -> bytes:
+    """In-memory np.savez with a choice of codec and compresslevel.
+
+    With the defaults the content equals that of np.savez_compressed.
+    compresslevel is ignored for "stored" and "lzma".
+    """
+    assert codec in NPZ_CODECS, (codec, tuple(NPZ_CODECS))
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(
+        buffer, "w", compression=NPZ_CODECS[codec], compresslevel=compresslevel
+    ) as zip_file:
+        for name, array in arrays.items():
+            with zip_file.open(name + ".npy", "w", force_zip64=True) as member:
+                np.lib.format.write_array(
+                    member, np.asanyarray(array), allow_pickle=False
+                )
+    return buffer.getvalue()
+
+
+def atomic_save_npy(path: Union[Path, str], payload: Any, allow_pickle=True) -> str:
+    """np.save replacement that writes atomically and returns the sha256 of the file.
+
+    Unlike np.save, no .npy suffix is appended to path.
+    """
+    with timed_stage("serialization"):
+        content = npy_bytes(payload, allow_pickle=allow_pickle)
+    with timed_stage("write"):
+        atomic_write_bytes(path, content)
+    return sha256_hexdigest(content)
+
+
+def load_json(path: Union[Path, str], default: Dict = None) -> Dict:
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return default
+
+
+def atomic_write_json(path: Union[Path, str], content: Dict) -> None:
+    atomic_write_bytes(
+        path, json.dumps(content, indent=1, sort_keys=True).encode("utf-8")
+    )
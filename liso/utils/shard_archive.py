@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+import io
+import os
+import time
+from argparse import ArgumentParser
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple, Union
+
+from liso.utils.file_utils import (
+    atomic_write_json,
+    file_sha256_hexdigest,
+    load_json,
+    sha256_hexdigest,
+)
+from tqdm import tqdm
+
+# A sharded archive replaces a directory with one file per sample by a few
+# large append-only shard files and a json offset index per writer:
+#   <archive_dir>/<writer_name>-<shard_idx>.shard
+#   <archive_dir>/index-<writer_name>.json
+#       {"shards": [shard file names],
+#        "members": {
+#            name: [shard_idx, offset, size, write_time_ns, sha256, source_mtime_ns]
+#        }}
+# Members hold the unmodified bytes of the file they replace (e.g. .npy, .npz),
+# named by their path relative to the replaced directory.
+# Writers never touch shards or indices of other writers, so creators may
+# run one writer per process without locking. If several writers hold a
+# member, readers serve the most recently written one (by write_time_ns,
+# time.time_ns() when the member was added). sha256 is that of the member
+# bytes, source_mtime_ns the mtime of the file a member was packed from
+# (None for members written by creators), together they let repacks find
+# files that were rewritten with the same size.
+
+
+def get_archive_dir(dataset_dir: Union[Path, str]) -> Path:
+    dataset_dir = Path(dataset_dir)
+    return dataset_dir.with_name(dataset_dir.name + ".shards")
+
+
+class ShardedArchiveWriter:
+    def __init__(
+        self,
+        archive_dir: Union[Path, str],
+        writer_name="writer",
+        max_shard_size_bytes=1 << 30,
+    ):
+        assert "/" not in writer_name, writer_name
+        self.archive_dir = Path(archive_dir)
+        self.archive_dir.mkdir(parents=True, exist_ok=True)
+        self.writer_name = writer_name
+        self.max_shard_size_bytes = max_shard_size_bytes
+        self.index_file = self.archive_dir / f"index-{writer_name}.json"
+        # appending to an existing archive continues with a fresh shard,
+        # committed shards are never modified
+        self.index = load_json(self.index_file, default={"shards": [], "members": {}})
+        self.pending_members = {}
+        self.shard_file = None
+        self.shard_size = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def _open_next_shard(self):
+        self.flush()
+        shard_name = f"{self.writer_name}-{len(self.index['shards']):05d}.shard"
+        self.index["shards"].append(shard_name)
+        self.shard_file = open(self.archive_dir / shard_name, "wb")
+        self.shard_size = 0
+
+    def add_bytes(
+        self, member_name: str, payload: bytes, source_mtime_ns: int = None
+    ) -> None:
+        if (
+            self.shard_file is None
+            or self.shard_size + len(payload) > self.max_shard_size_bytes
+        ):
+            self._open_next_shard()
+        self.shard_file.write(payload)
+        self.pending_members[member_name] = [
+            len(self.index["shards"]) - 1,
+            self.shard_size,
+            len(payload),
+            time.time_ns(),
+            sha256_hexdigest(payload),
+            source_mtime_ns,
+        ]
+        self.shard_size += len(payload)
+
+    def save_sample(
+        self, save_fn: Callable, member_name: str, payload, **kwargs
+    ) -> None:
+        """Same call signature as CloudLoaderSaver.save_sample."""
+        buffer = io.BytesIO()
+        save_fn(buffer, payload, **kwargs)
+        self.add_bytes(member_name, buffer.getvalue())
+
+    def flush(self) -> None:
+        """Make all members added so far durable and visible to readers."""
+        if self.shard_file is None:
+            return
+        self.shard_file.flush()
+        os.fsync(self.shard_file.fileno())
+        self.index["members"].update(self.pending_members)
+        self.pending_members = {}
+        atomic_write_json(self.index_file, self.index)
+
+    def close(self) -> None:
+        self.flush()
+        if self.shard_file is not None:
+            self.shard_file.close()
+            self.shard_file = None
+
+
+class ShardedArchiveReader:
+    def __init__(self, archive_dir: Union[Path, str]):
+        self.archive_dir = Path(archive_dir)
+        self.shard_files: List[Path] = []
+        self.members: Dict[str, Tuple[int, int, int]] = {}
+        self.member_sha256s: Dict[str, Optional[str]] = {}
+        self.member_source_mtimes_ns: Dict[str, Optional[int]] = {}
+        member_write_times_ns: Dict[str, int] = {}
+        # the most recently written member wins, members of archives written
+        # before write times were recorded count as oldest, among those later
+        # writers (in sorted order) win
+        for index_file in sorted(self.archive_dir.glob("index-*.json")):
+            index = load_json(index_file)
+            shard_offset = len(self.shard_files)
+            self.shard_files.extend(self.archive_dir / s for s in index["shards"])
+            for member_name, member in index["members"].items():
+                shard_idx, offset, size = member[:3]
+                write_time_ns = member[3] if len(member) > 3 else 0
+                if write_time_ns < member_write_times_ns.get(member_name, 0):
+                    continue
+                member_write_times_ns[member_name] = write_time_ns
+                self.members[member_name] = (shard_offset + shard_idx, offset, size)
+                self.member_sha256s[member_name] = (
+                    member[4] if len(member) > 4 else None
+                )
+                self.member_source_mtimes_ns[member_name] = (
+                    member[5] if len(member) > 5 else None
+                )
+        self._fds = {}
+        self._fds_pid = None
+
+    def __contains__(self, member_name: str) -> bool:
+        return member_name in self.members
+
+    def __len__(self) -> int:
+        return len(self.members)
+
+    def get_member_names(self) -> List[str]:
+        return sorted(self.members)
+
+    def _get_fd(self, shard_idx: int) -> int:
+        # file descriptors must not be shared with forked dataloader workers
+        if self._fds_pid != os.getpid():
+            self._fds = {}
+            self._fds_pid = os.getpid()
+        if shard_idx not in self._fds:
+            self._fds[shard_idx] = os.open(self.shard_files[shard_idx], os.O_RDONLY)
+        return self._fds[shard_idx]
+
+    def read_bytes(self, member_name: str) -> bytes:
+        shard_idx, offset, size = self.members[member_name]
+        payload = os.pread(self._get_fd(shard_idx), size, offset)
+        assert len(payload) == size, (member_name, len(payload), size)
+        return payload
+
+    def get_member_fingerprint(self, member_name: str) -> str:
+        shard_idx, offset, size = self.members[member_name]
+        shard_file = self.shard_files[shard_idx]
+        return f"{shard_file.name}:{offset}:{size}:{os.stat(shard_file).st_mtime_ns}"
+
+    def load_sample(self, member_name: str, load_fn: Callable, **kwargs):
+        """Same call signature as CloudLoaderSaver.load_sample."""
+        # members are read in one go, there is no file to memory map
+        kwargs.pop("mmap_mode", None)
+        return load_fn(io.BytesIO(self.read_bytes(member_name)), **kwargs)
+
+
+def main():
+    argparser = ArgumentParser(
+        description="Pack a directory with one file per sample into a sharded archive."
+    )
+    argparser.add_argument("dataset_dir", type=Path)
+    argparser.add_argument(
+        "--archive_dir",
+        type=Path,
+        default=None,
+        help="defaults to <dataset_dir>.shards next to the dataset dir",
+    )
+    argparser.add_argument("--pattern", default="**/*")
+    argparser.add_argument("--writer_name", default="pack")
+    argparser.add_argument("--max_shard_size_mb", default=1024, type=int)
+    args = argparser.parse_args()
+
+    archive_dir = args.archive_dir or get_archive_dir(args.dataset_dir)
+    # repacking after an update only appends new or changed files
+    packed = ShardedArchiveReader(archive_dir)
+
+    def needs_packing(member_file: Path) -> bool:
+        member_name = member_file.relative_to(args.dataset_dir).as_posix()
+        if member_name not in packed:
+            return True
+        member_stat = member_file.stat()
+        if packed.members[member_name][2] != member_stat.st_size:
+            return True
+        if packed.member_source_mtimes_ns[member_name] == member_stat.st_mtime_ns:
+            return False
+        # fixed size records (e.g. tartu samples) are rewritten with the same
+        # size, compare the content
+        packed_sha256 = packed.member_sha256s[member_name]
+        if packed_sha256 is None:
+            packed_sha256 = sha256_hexdigest(packed.read_bytes(member_name))
+        return file_sha256_hexdigest(member_file) != packed_sha256
+
+    member_files = sorted(
+        f
+        for f in args.dataset_dir.glob(args.pattern)
+        if f.is_file() and not f.name.startswith(".") and needs_packing(f)
+    )
+    with ShardedArchiveWriter(
+        archive_dir,
+        writer_name=args.writer_name,
+        max_shard_size_bytes=args.max_shard_size_mb << 20,
+    ) as writer:
+        for member_file in tqdm(member_files):
+            # mtime before reading, a concurrent rewrite gets repacked next time
+            source_mtime_ns = member_file.stat().st_mtime_ns
+            with open(member_file, "rb") as f:
+                writer.add_bytes(
+                    member_file.relative_to(args.dataset_dir).as_posix(),
+                    f.read(),
+                    source_mtime_ns=source_mtime_ns,
+                )
+        num_shards = len(writer.index["shards"])
+    print(f"Packed {len(member_files)} files into {num_shards} shards in {archive_dir}")
+
+
+if __name__ == "__main__":
+    main()
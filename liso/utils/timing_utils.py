@@ -1,5 +1,11 @@
 import functools
+import resource
 import time
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
 
 
 def timeit(func):
@@ -16,3 +22,141 @@ def timeit(func):
         return result
 
     return new_func
+
+
+# stages of the dataset creators, reported in this order
+CREATOR_STAGES = ("read", "ground_segmentation", "odometry", "serialization", "write")
+# 0.01 ms to 100 s, four bins per decade
+STAGE_HISTOGRAM_EDGES_MS = np.logspace(-2, 5, 29)
+
+
+class StageTimer:
+    """Collects per stage durations and frame counts of a long running job.
+
+    Code regions are attributed to a stage with timed_stage(name) once the
+    timer is activated, stages nest freely. Durations measured in worker
+    processes are collected with call_with_stage_timer and merged.
+    """
+
+    def __init__(self, name: str, progress_interval_s=60.0):
+        self.name = name
+        self.progress_interval_s = progress_interval_s
+        self.durations_s: Dict[str, List[float]] = defaultdict(list)
+        self.num_frames = 0
+        self.start_time = time.perf_counter()
+        self.last_progress_time = self.start_time
+
+    @contextmanager
+    def stage(self, stage_name: str):
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.durations_s[stage_name].append(time.perf_counter() - start_time)
+
+    def merge(self, durations_s: Dict[str, List[float]]) -> None:
+        for stage_name, stage_durations_s in durations_s.items():
+            self.durations_s[stage_name].extend(stage_durations_s)
+
+    def add_frames(self, num_frames=1) -> None:
+        self.num_frames += num_frames
+        if time.perf_counter() - self.last_progress_time >= self.progress_interval_s:
+            self.print_progress()
+
+    def get_stage_names(self) -> List[str]:
+        return [s for s in CREATOR_STAGES if s in self.durations_s] + sorted(
+            s for s in self.durations_s if s not in CREATOR_STAGES
+        )
+
+    def print_progress(self) -> None:
+        # one self contained line per report, readable in slurm logs
+        self.last_progress_time = time.perf_counter()
+        elapsed_s = self.last_progress_time - self.start_time
+        stage_strs = [
+            "{0}={1:.1f}ms".format(
+                stage_name,
+                1_000 * sum(self.durations_s[stage_name]) / max(self.num_frames, 1),
+            )
+            for stage_name in self.get_stage_names()
+        ]
+        print(
+            "[{0}] elapsed={1}s frames={2} fps={3:.2f} "
+            "per_frame: {4} max_rss={5:.2f}GB".format(
+                self.name,
+                int(elapsed_s),
+                self.num_frames,
+                self.num_frames / max(elapsed_s, 1e-9),
+                " ".join(stage_strs),
+                get_max_rss_gb(),
+            ),
+            flush=True,
+        )
+
+    def get_summary(self) -> Dict[str, Any]:
+        elapsed_s = time.perf_counter() - self.start_time
+        stages = {}
+        for stage_name in self.get_stage_names():
+            durations_ms = 1_000 * np.array(self.durations_s[stage_name])
+            histogram, _ = np.histogram(durations_ms, bins=STAGE_HISTOGRAM_EDGES_MS)
+            stages[stage_name] = {
+                "count": int(durations_ms.size),
+                "total_s": float(durations_ms.sum() / 1_000),
+                "mean_ms": float(durations_ms.mean()),
+                "p50_ms": float(np.percentile(durations_ms, 50)),
+                "p90_ms": float(np.percentile(durations_ms, 90)),
+                "p99_ms": float(np.percentile(durations_ms, 99)),
+                "max_ms": float(durations_ms.max()),
+                "histogram": histogram.tolist(),
+            }
+        return {
+            "name": self.name,
+            "wall_time_s": elapsed_s,
+            "num_frames": self.num_frames,
+            "frames_per_s": self.num_frames / max(elapsed_s, 1e-9),
+            "max_rss_gb": get_max_rss_gb(),
+            "histogram_edges_ms": STAGE_HISTOGRAM_EDGES_MS.tolist(),
+            "stages": stages,
+        }
+
+
+def get_max_rss_gb() -> float:
+    # peak resident memory of this process plus its finished worker processes,
+    # ru_maxrss is in KB on linux
+    max_rss_kb = (
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        + resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    )
+    return max_rss_kb / (1 << 20)
+
+
+_active_stage_timer: Optional[StageTimer] = None
+
+
+def set_active_stage_timer(stage_timer: Optional[StageTimer]) -> Optional[StageTimer]:
+    global _active_stage_timer
+    previous_stage_timer = _active_stage_timer
+    _active_stage_timer = stage_timer
+    return previous_stage_timer
+
+
+@contextmanager
+def timed_stage(stage_name: str):
+    """Attribute the enclosed code to stage_name, no-op without an active timer."""
+    if _active_stage_timer is None:
+        yield
+    else:
+        with _active_stage_timer.stage(stage_name):
+            yield
+
+
+def call_with_stage_timer(
+    func: Callable, *args, **kwargs
+) -> Tuple[Any, Dict[str, List[float]]]:
+    """Run func (e.g. inside a worker process) and return its stage durations."""
+    stage_timer = StageTimer(func.__name__)
+    previous_stage_timer = set_active_stage_timer(stage_timer)
+    try:
+        result = func(*args, **kwargs)
+    finally:
+        set_active_stage_timer(previous_stage_timer)
+    return result, dict(stage_timer.durations_s)